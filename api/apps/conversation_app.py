@@ -25,7 +25,8 @@ from flask_login import current_user, login_required
 from api import settings
 from api.db import LLMType
 from api.db.db_models import APIToken
-from api.db.services.conversation_service import ConversationService, structure_answer
+from api.db.db_models import Conversation
+from api.db.services.conversation_service import ConversationService, chat_messages, structure_answer
 from api.db.services.dialog_service import DialogService, ask, chat
 from api.db.services.knowledgebase_service import KnowledgebaseService
 from api.db.services.llm_service import LLMBundle
@@ -57,7 +58,7 @@ def set_conversation():
             e, conv = ConversationService.get_by_id(conv_id)
             if not e:
                 return get_data_error_result(message="Fail to update a conversation!")
-            conv = conv.to_dict()
+            conv = ConversationService.hydrate([conv.to_dict()])[0]
             return get_json_result(data=conv)
         except Exception as e:
             return server_error_response(e)
@@ -92,12 +93,12 @@ def get():
         else:
             return get_json_result(data=False, message="Only owner of conversation authorized for this operation.", code=settings.RetCode.OPERATING_ERROR)
 
-        for ref in conv.reference:
+        conv = ConversationService.hydrate([conv.to_dict()])[0]
+        for ref in conv["reference"]:
             if isinstance(ref, list):
                 continue
             ref["chunks"] = chunks_format(ref)
 
-        conv = conv.to_dict()
         conv["avatar"] = avatar
         return get_json_result(data=conv)
     except Exception as e:
@@ -155,7 +156,7 @@ def list_conversation():
             return get_json_result(data=False, message="Only owner of dialog authorized for this operation.", code=settings.RetCode.OPERATING_ERROR)
         convs = ConversationService.query(dialog_id=dialog_id, order_by=ConversationService.model.create_time, reverse=True)
 
-        convs = [d.to_dict() for d in convs]
+        convs = ConversationService.hydrate([d.to_dict() for d in convs])
         return get_json_result(data=convs)
     except Exception as e:
         return server_error_response(e)
@@ -166,37 +167,31 @@ def list_conversation():
 @validate_request("conversation_id", "messages")
 def completion():
     req = request.json
-    msg = []
-    for m in req["messages"]:
-        if m["role"] == "system":
-            continue
-        if m["role"] == "assistant" and not msg:
-            continue
-        msg.append(m)
+    msg = chat_messages(req["messages"])
     message_id = msg[-1].get("id")
     try:
         e, conv = ConversationService.get_by_id(req["conversation_id"])
         if not e:
             return get_data_error_result(message="Conversation not found!")
-        conv.message = deepcopy(req["messages"])
         e, dia = DialogService.get_by_id(conv.dialog_id)
         if not e:
             return get_data_error_result(message="Dialog not found!")
+        # The client sends the whole conversation; the stored messages it no longer has are deleted.
+        new_messages = ConversationService.sync_messages(conv, deepcopy(req["messages"]))
         del req["conversation_id"]
         del req["messages"]
 
-        if not conv.reference:
-            conv.reference = []
-        conv.reference = [r for r in conv.reference if r]
-        conv.reference.append({"chunks": [], "doc_aggs": []})
+        if conv.reference:
+            conv.reference = [r for r in conv.reference if r]
+        turn = Conversation(id=conv.id, message=new_messages, reference=[{"chunks": [], "doc_aggs": []}])
 
         def stream():
             nonlocal dia, msg, req, conv
             try:
                 for ans in chat(dia, msg, True, **req):
-                    ans = structure_answer(conv, ans, message_id, conv.id)
+                    ans = structure_answer(turn, ans, message_id, conv.id)
                     yield "data:" + json.dumps({"code": 0, "message": "", "data": ans}, ensure_ascii=False) + "\n\n"
-                ConversationService.update_by_id(conv.id, conv.to_dict())
+                ConversationService.append_turn(conv, turn.message, turn.reference[-1])
             except Exception as e:
                 traceback.print_exc()
                 yield "data:" + json.dumps({"code": 500, "message": str(e), "data": {"answer": "**ERROR**: " + str(e), "reference": []}}, ensure_ascii=False) + "\n\n"
@@ -213,8 +208,8 @@ def completion():
         else:
             answer = None
             for ans in chat(dia, msg, **req):
-                answer = structure_answer(conv, ans, message_id, conv.id)
-                ConversationService.update_by_id(conv.id, conv.to_dict())
+                answer = structure_answer(turn, ans, message_id, conv.id)
+                ConversationService.append_turn(conv, turn.message, turn.reference[-1])
                 break
             return get_json_result(data=answer)
     except Exception as e:
@@ -262,18 +257,9 @@ def delete_msg():
     if not e:
         return get_data_error_result(message="Conversation not found!")
 
-    conv = conv.to_dict()
-    for i, msg in enumerate(conv["message"]):
-        if req["message_id"] != msg.get("id", ""):
-            continue
-        assert conv["message"][i + 1]["id"] == req["message_id"]
-        conv["message"].pop(i)
-        conv["message"].pop(i)
-        conv["reference"].pop(max(0, i // 2 - 1))
-        break
-
-    ConversationService.update_by_id(conv["id"], conv)
-    return get_json_result(data=conv)
+    ConversationService.delete_message(conv.id, req["message_id"])
+    e, conv = ConversationService.get_by_id(conv.id)
+    return get_json_result(data=ConversationService.hydrate([conv.to_dict()])[0])
 
 
 @manager.route("/thumbup", methods=["POST"])  # noqa: F821
@@ -286,21 +272,20 @@ def thumbup():
         return get_data_error_result(message="Conversation not found!")
     up_down = req.get("thumbup")
     feedback = req.get("feedback", "")
-    conv = conv.to_dict()
-    for i, msg in enumerate(conv["message"]):
-        if req["message_id"] == msg.get("id", "") and msg.get("role", "") == "assistant":
-            if up_down:
-                msg["thumbup"] = True
-                if "feedback" in msg:
-                    del msg["feedback"]
-            else:
-                msg["thumbup"] = False
-                if feedback:
-                    msg["feedback"] = feedback
-            break
 
-    ConversationService.update_by_id(conv["id"], conv)
-    return get_json_result(data=conv)
+    def vote(msg):
+        if up_down:
+            msg["thumbup"] = True
+            if "feedback" in msg:
+                del msg["feedback"]
+        else:
+            msg["thumbup"] = False
+            if feedback:
+                msg["feedback"] = feedback
+
+    ConversationService.update_message(conv.id, req["message_id"], "assistant", vote)
+    e, conv = ConversationService.get_by_id(conv.id)
+    return get_json_result(data=ConversationService.hydrate([conv.to_dict()])[0])
 
 
 @manager.route("/ask", methods=["POST"])  # noqa: F821
@@ -129,6 +129,7 @@ def set_api_key():
                 api_base=llm_config["api_base"],
                 max_tokens=llm_config["max_tokens"]
             )
+    TenantLLMService.bump_config_version(current_user.id)
 
     return get_json_result(data=True)
 
@@ -286,6 +287,7 @@ def add_llm():
             [TenantLLM.tenant_id == current_user.id, TenantLLM.llm_factory == factory,
              TenantLLM.llm_name == llm["llm_name"]], llm):
         TenantLLMService.save(**llm)
+    TenantLLMService.bump_config_version(current_user.id)
 
     return get_json_result(data=True)
 
@@ -298,6 +300,7 @@ def delete_llm():
     TenantLLMService.filter_delete(
         [TenantLLM.tenant_id == current_user.id, TenantLLM.llm_factory == req["llm_factory"],
          TenantLLM.llm_name == req["llm_name"]])
+    TenantLLMService.bump_config_version(current_user.id)
     return get_json_result(data=True)
 
 
@@ -308,6 +311,7 @@ def delete_factory():
     req = request.json
     TenantLLMService.filter_delete(
         [TenantLLM.tenant_id == current_user.id, TenantLLM.llm_factory == req["llm_factory"]])
+    TenantLLMService.bump_config_version(current_user.id)
     return get_json_result(data=True)
 
 
@@ -49,6 +49,7 @@ from api.utils.validation_utils import (
     validate_and_parse_json_request,
     validate_and_parse_request_args,
 )
+from graphrag import graph_store
 from rag.nlp import search
 from rag.settings import PAGERANK_FLD
 
@@ -522,6 +523,7 @@ def delete_knowledge_graph(tenant_id,dataset_id):
             code=settings.RetCode.AUTHENTICATION_ERROR
         )
     _, kb = KnowledgebaseService.get_by_id(dataset_id)
+    graph_store.remove_graph(kb.tenant_id, dataset_id)
     settings.docStoreConn.delete({"knowledge_graph_kwd": ["graph", "subgraph", "entity", "relation"]}, search.index_name(kb.tenant_id), dataset_id)
 
     return get_result(data=True)
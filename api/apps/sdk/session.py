@@ -495,6 +495,7 @@ def list_session(tenant_id, chat_id):
     convs = ConversationService.get_list(chat_id, page_number, items_per_page, orderby, desc, id, name, user_id)
     if not convs:
         return get_result(data=[])
+    convs = ConversationService.hydrate(convs)
     for conv in convs:
         conv["messages"] = conv.pop("message")
         infos = conv["messages"]
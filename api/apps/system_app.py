@@ -21,7 +21,9 @@ from flask_login import login_required, current_user
 
 from api.db.db_models import APIToken
 from api.db.services.api_service import APITokenService
+from api.db.services.dialog_service import speculation_stats
 from api.db.services.knowledgebase_service import KnowledgebaseService
+from api.db.services.tenant_llm_service import usage_accumulator
 from api.db.services.user_service import UserTenantService
 from api import settings
 from api.utils import current_timestamp, datetime_format
@@ -32,6 +34,7 @@ from api.utils.api_utils import (
     generate_confirmation_token,
 )
 from api.versions import get_ragflow_version
+from rag.utils import llm_cache
 from rag.utils.storage_factory import STORAGE_IMPL, STORAGE_IMPL_TYPE
 from timeit import default_timer as timer
 
@@ -165,6 +168,12 @@ def status():
     except Exception:
         logging.exception("get task executor heartbeats failed!")
     res["task_executor_heartbeats"] = task_executor_heartbeats
+    # Token usage counted but not written to the database yet.
+    res["llm_usage"] = {"pending_tokens": usage_accumulator.pending_tokens()}
+    # How often retrieval with the raw follow-up question could be kept, see CHAT_SPECULATIVE_THRESHOLD.
+    res["chat_speculation"] = speculation_stats()
+    # Hit rates of the LLM response cache per use case.
+    res["llm_cache"] = llm_cache.stats()
 
     return get_json_result(data=res)
 
@@ -727,6 +727,7 @@ class Task(DataBaseModel):
     retry_count = IntegerField(default=0)
     digest = TextField(null=True, help_text="task digest", default="")
     chunk_ids = LongTextField(null=True, help_text="chunk ids", default="")
+    page_profile = JSONField(null=True, help_text="doc_probe profiles of the pages of the task")
 
 
 class Dialog(DataBaseModel):
@@ -776,6 +777,29 @@ class Conversation(DataBaseModel):
         db_table = "conversation"
 
 
+class ConversationMessage(DataBaseModel):
+    id = CharField(max_length=32, primary_key=True)
+    conversation_id = CharField(max_length=32, null=False, index=True)
+    seq = IntegerField(default=0, index=True)
+    kind = CharField(max_length=16, null=False, default="message", help_text="message|reference", index=True)
+    message_id = CharField(max_length=64, null=True, index=True)
+    content = JSONField(null=True, default={})
+    tokens = IntegerField(null=True, help_text="token count of the message content")
+
+    class Meta:
+        db_table = "conversation_message"
+
+
+class ConversationChunk(DataBaseModel):
+    conversation_id = CharField(max_length=32, null=False, index=True)
+    chunk_id = CharField(max_length=64, null=False)
+    chunk = JSONField(null=True, default={})
+
+    class Meta:
+        db_table = "conversation_chunk"
+        primary_key = CompositeKey("conversation_id", "chunk_id")
+
+
 class APIToken(DataBaseModel):
     tenant_id = CharField(max_length=32, null=False, index=True)
     token = CharField(max_length=255, null=False, index=True)
@@ -1020,4 +1044,12 @@ def migrate_db():
         migrate(migrator.add_column("dialog", "meta_data_filter", JSONField(null=True, default={})))
     except Exception:
         pass
+    try:
+        migrate(migrator.add_column("conversation_message", "tokens", IntegerField(null=True, help_text="token count of the message content")))
+    except Exception:
+        pass
+    try:
+        migrate(migrator.add_column("task", "page_profile", JSONField(null=True, help_text="doc_probe profiles of the pages of the task")))
+    except Exception:
+        pass
     logging.disable(logging.NOTSET)
\ No newline at end of file
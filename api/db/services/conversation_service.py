@@ -13,20 +13,46 @@
 #  See the License for the specific language governing permissions and
 #  limitations under the License.
 #
+import os
+import re
 import time
+from collections import defaultdict
+from datetime import datetime
 from uuid import uuid4
+
+import xxhash
+from peewee import fn
+
 from api.db import StatusEnum
-from api.db.db_models import Conversation, DB
+from api.db.db_models import Conversation, ConversationChunk, ConversationMessage, DB
 from api.db.services.api_service import API4ConversationService
 from api.db.services.common_service import CommonService
 from api.db.services.dialog_service import DialogService, chat
-from api.utils import get_uuid
+from api.utils import current_timestamp, datetime_format, get_uuid
 import json
 
-from rag.prompts import chunks_format
+from rag.prompts import chunks_format, count_tokens, remember_token_count
+
+# The prompt of an answer is built from at most this many of the last messages of the conversation.
+CHAT_HISTORY_MESSAGES = int(os.environ.get("CHAT_HISTORY_MESSAGES", 64))
+# Fields of a reference chunk that depend on the question; the rest is stored once per conversation.
+REFERENCE_TURN_FIELDS = ("similarity", "vector_similarity", "term_similarity")
+
+
+def _prompt_text(message):
+    # A message as the prompt of an answer quotes it, without its citation marks.
+    return re.sub(r"##\d+\$\$", "", message.get("content") or "")
 
 
 class ConversationService(CommonService):
+    """
+    Each turn appends its messages and the reference of its answer to a conversation, as rows of
+    ConversationMessage; the chunks of the references are stored once per conversation, in
+    ConversationChunk, and the reference rows only keep their ids. A conversation not written
+    since, or written as a whole with `update_by_id`, keeps them in its `message` and
+    `reference` columns instead. `hydrate` gives the lists of either.
+    """
+
     model = Conversation
 
     @classmethod
@@ -48,6 +74,268 @@ class ConversationService(CommonService):
 
         return list(sessions.dicts())
 
+    @staticmethod
+    def _chunk_key(chunk: dict) -> str:
+        key = chunk.get("id") or chunk.get("chunk_id")
+        if not key:
+            key = xxhash.xxh64(json.dumps(chunk, ensure_ascii=False, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+        return str(key)[:64]
+
+    @classmethod
+    def _split_reference(cls, reference, chunks: dict):
+        """The reference row of `reference`; its chunks go to `chunks` (key -> chunk)."""
+        if not isinstance(reference, dict) or not isinstance(reference.get("chunks"), list):
+            return reference
+        stub = {k: v for k, v in reference.items() if k != "chunks"}
+        stub["chunks"] = []
+        for ck in reference["chunks"]:
+            key = cls._chunk_key(ck)
+            chunks[key] = {k: v for k, v in ck.items() if k not in REFERENCE_TURN_FIELDS}
+            stub["chunks"].append({"key": key, **{k: ck[k] for k in REFERENCE_TURN_FIELDS if k in ck}})
+        return stub
+
+    @staticmethod
+    def _join_reference(stub, chunks: dict):
+        if not isinstance(stub, dict) or not isinstance(stub.get("chunks"), list):
+            return stub
+        reference = {k: v for k, v in stub.items() if k != "chunks"}
+        reference["chunks"] = [{**chunks.get(c["key"], {}), **{k: v for k, v in c.items() if k != "key"}} for c in stub["chunks"]]
+        return reference
+
+    @classmethod
+    def _last_seq(cls, conv_id):
+        return ConversationMessage.select(fn.MAX(ConversationMessage.seq)).where(ConversationMessage.conversation_id == conv_id).scalar()
+
+    @classmethod
+    def _drop_rows(cls, conv_ids):
+        ConversationMessage.delete().where(ConversationMessage.conversation_id.in_(conv_ids)).execute()
+        ConversationChunk.delete().where(ConversationChunk.conversation_id.in_(conv_ids)).execute()
+
+    @classmethod
+    @DB.connection_context()
+    def append_turn(cls, conv, messages: list[dict], reference=None):
+        """
+        Append `messages` and, if given, the `reference` of the answer to a conversation. A conversation
+        still kept in its columns (as `conv` was read) is moved to rows first.
+        """
+        rows, chunks = [], {}
+        now, date = current_timestamp(), datetime_format(datetime.now())
+
+        def add(seq, kind, content):
+            if kind == "reference":
+                content = cls._split_reference(content, chunks)
+            is_message = kind == "message" and isinstance(content, dict)
+            rows.append({"id": get_uuid(), "conversation_id": conv.id, "seq": seq, "kind": kind,
+                         "message_id": content.get("id") if is_message else None,
+                         "tokens": count_tokens(_prompt_text(content)) if is_message else None,
+                         "content": content, "create_time": now, "create_date": date, "update_time": now, "update_date": date})
+
+        with DB.atomic():
+            last = cls._last_seq(conv.id)
+            if last is None and (conv.message or conv.reference):
+                with DB.lock(f"conversation_rows_{conv.id}", 10):
+                    last = cls._last_seq(conv.id)
+                    if last is None:
+                        last = -1
+                        for kind, items in (("message", conv.message or []), ("reference", conv.reference or [])):
+                            for item in items:
+                                last += 1
+                                add(last, kind, item)
+                        cls.model.update(message=[], reference=[]).where(cls.model.id == conv.id).execute()
+            last = -1 if last is None else last
+            for m in messages:
+                last += 1
+                add(last, "message", m)
+            if reference is not None:
+                last += 1
+                add(last, "reference", reference)
+            for i in range(0, len(rows), 100):
+                ConversationMessage.insert_many(rows[i:i + 100]).execute()
+            chunk_rows = [{"conversation_id": conv.id, "chunk_id": k, "chunk": v, "create_time": now, "create_date": date,
+                           "update_time": now, "update_date": date} for k, v in chunks.items()]
+            for i in range(0, len(chunk_rows), 100):
+                ConversationChunk.insert_many(chunk_rows[i:i + 100]).on_conflict_ignore().execute()
+            cls.model.update(update_time=now, update_date=date).where(cls.model.id == conv.id).execute()
+
+    @classmethod
+    @DB.connection_context()
+    def recent_messages(cls, conv, limit=CHAT_HISTORY_MESSAGES) -> list[dict]:
+        """
+        The last `limit` messages of a conversation, without reading the others. Their stored
+        token counts are remembered, so that fitting them in a prompt does not count them again.
+        """
+        rows = list(ConversationMessage.select(ConversationMessage.content, ConversationMessage.tokens)
+                    .where(ConversationMessage.conversation_id == conv.id, ConversationMessage.kind == "message")
+                    .order_by(ConversationMessage.seq.desc(), ConversationMessage.create_time.desc())
+                    .limit(limit))
+        for r in rows:
+            if r.tokens is not None and isinstance(r.content, dict):
+                remember_token_count(_prompt_text(r.content), r.tokens)
+        if rows:
+            return [r.content for r in reversed(rows)]
+        return (conv.message or [])[-limit:]
+
+    @staticmethod
+    def _same_message(m, stored_id, stored_content):
+        # Messages are told apart by id; one without (a prologue, an old client) by what it says.
+        if m.get("id") and stored_id:
+            return m["id"] == stored_id
+        return isinstance(stored_content, dict) and m.get("role") == stored_content.get("role") and m.get("content") == stored_content.get("content")
+
+    @classmethod
+    @DB.connection_context()
+    def sync_messages(cls, conv, messages: list[dict]) -> list[dict]:
+        """
+        The messages of `messages`, the whole conversation as a client has it, that are not stored:
+        those after its longest common prefix with the stored messages. The stored messages after
+        that prefix, which the client dropped (e.g. to regenerate an answer), are deleted, with the
+        references of their answers.
+        """
+        rows = list(ConversationMessage.select(ConversationMessage.id, ConversationMessage.kind, ConversationMessage.message_id)
+                    .where(ConversationMessage.conversation_id == conv.id)
+                    .order_by(ConversationMessage.seq, ConversationMessage.create_time))
+        if rows:
+            message_rows = [r for r in rows if r.kind == "message"]
+            anonymous = {r.id: r.content for r in ConversationMessage.select(ConversationMessage.id, ConversationMessage.content)
+                         .where(ConversationMessage.conversation_id == conv.id, ConversationMessage.kind == "message",
+                                ConversationMessage.message_id.is_null())}
+            stored = [(r.message_id, anonymous.get(r.id)) for r in message_rows]
+        else:
+            stored = [(m.get("id"), m) for m in conv.message or []]
+
+        n = 0
+        while n < min(len(messages), len(stored)) and cls._same_message(messages[n], *stored[n]):
+            n += 1
+        if n == len(stored):
+            return messages[n:]
+
+        # One reference per answer, the prologue before the first question has none.
+        answers = sum(1 for i, m in enumerate(messages[:n]) if m.get("role") == "assistant" and any(q.get("role") == "user" for q in messages[:i]))
+        if rows:
+            drop = [r.id for r in message_rows[n:]] + [r.id for r in [r for r in rows if r.kind == "reference"][answers:]]
+            ConversationMessage.delete().where(ConversationMessage.id.in_(drop)).execute()
+        else:
+            conv.message = (conv.message or [])[:n]
+            conv.reference = (conv.reference or [])[:answers]
+            cls.update_by_id(conv.id, {"message": conv.message, "reference": conv.reference})
+        return messages[n:]
+
+    @classmethod
+    @DB.connection_context()
+    def hydrate(cls, convs: list[dict]) -> list[dict]:
+        """Fill the `message` and `reference` lists of conversations (as dicts) kept in rows."""
+        ids = [c["id"] for c in convs]
+        if not ids:
+            return convs
+        lists = defaultdict(lambda: {"message": [], "reference": []})
+        for r in (ConversationMessage.select(ConversationMessage.conversation_id, ConversationMessage.kind, ConversationMessage.content)
+                  .where(ConversationMessage.conversation_id.in_(ids))
+                  .order_by(ConversationMessage.seq, ConversationMessage.create_time)):
+            lists[r.conversation_id][r.kind].append(r.content)
+        if not lists:
+            return convs
+        chunks = defaultdict(dict)
+        for r in ConversationChunk.select().where(ConversationChunk.conversation_id.in_(list(lists.keys()))):
+            chunks[r.conversation_id][r.chunk_id] = r.chunk
+        for c in convs:
+            if c["id"] not in lists:
+                continue
+            c["message"] = lists[c["id"]]["message"]
+            c["reference"] = [cls._join_reference(ref, chunks[c["id"]]) for ref in lists[c["id"]]["reference"]]
+        return convs
+
+    @classmethod
+    @DB.connection_context()
+    def update_message(cls, conv_id, message_id, role, update):
+        """Apply `update` to the first message with this id and role, in place; False if there is none."""
+        for r in (ConversationMessage.select()
+                  .where(ConversationMessage.conversation_id == conv_id, ConversationMessage.kind == "message",
+                         ConversationMessage.message_id == message_id)
+                  .order_by(ConversationMessage.seq)):
+            if r.content.get("role") == role:
+                update(r.content)
+                ConversationMessage.update(content=r.content, tokens=count_tokens(_prompt_text(r.content)),
+                                           update_time=current_timestamp(), update_date=datetime_format(datetime.now())
+                                           ).where(ConversationMessage.id == r.id).execute()
+                return True
+        e, conv = cls.get_by_id(conv_id)
+        if not e or cls._last_seq(conv_id) is not None:
+            return False
+        for m in conv.message or []:
+            if m.get("id") == message_id and m.get("role") == role:
+                update(m)
+                cls.update_by_id(conv_id, {"message": conv.message})
+                return True
+        return False
+
+    @classmethod
+    @DB.connection_context()
+    def delete_message(cls, conv_id, message_id):
+        """Delete a question, the answer after it, and the reference of that answer."""
+        rows = list(ConversationMessage.select(ConversationMessage.id, ConversationMessage.kind, ConversationMessage.message_id)
+                    .where(ConversationMessage.conversation_id == conv_id)
+                    .order_by(ConversationMessage.seq, ConversationMessage.create_time))
+        if not rows:
+            e, conv = cls.get_by_id(conv_id)
+            if not e:
+                return
+            conv = conv.to_dict()
+            for i, msg in enumerate(conv["message"]):
+                if message_id != msg.get("id", ""):
+                    continue
+                assert conv["message"][i + 1]["id"] == message_id
+                conv["message"].pop(i)
+                conv["message"].pop(i)
+                conv["reference"].pop(max(0, i // 2 - 1))
+                break
+            cls.update_by_id(conv["id"], conv)
+            return
+
+        messages = [r for r in rows if r.kind == "message"]
+        references = [r for r in rows if r.kind == "reference"]
+        for i, r in enumerate(messages):
+            if message_id != (r.message_id or ""):
+                continue
+            assert messages[i + 1].message_id == message_id
+            drop = [r.id, messages[i + 1].id]
+            if max(0, i // 2 - 1) < len(references):
+                drop.append(references[max(0, i // 2 - 1)].id)
+            ConversationMessage.delete().where(ConversationMessage.id.in_(drop)).execute()
+            break
+
+    @classmethod
+    @DB.connection_context()
+    def update_by_id(cls, pid, data):
+        # A conversation written as a whole is kept in its columns again.
+        if "message" in data or "reference" in data:
+            with DB.atomic():
+                if cls._last_seq(pid) is not None:
+                    current = cls.hydrate([{"id": pid}])[0]
+                    data.setdefault("message", current["message"])
+                    data.setdefault("reference", current["reference"])
+                    cls._drop_rows([pid])
+                return super().update_by_id(pid, data)
+        return super().update_by_id(pid, data)
+
+    @classmethod
+    @DB.connection_context()
+    def delete_by_id(cls, pid):
+        with DB.atomic():
+            cls._drop_rows([pid])
+            return super().delete_by_id(pid)
+
+
+def chat_messages(messages: list[dict]) -> list[dict]:
+    """The messages an answer is generated from: no system message, starting with a question, at most CHAT_HISTORY_MESSAGES."""
+    msg = []
+    for m in messages[-CHAT_HISTORY_MESSAGES:]:
+        if m["role"] == "system":
+            continue
+        if m["role"] == "assistant" and not msg:
+            continue
+        msg.append(m)
+    return msg
+
 
 def structure_answer(conv, ans, message_id, session_id):
     reference = ans["reference"]
@@ -108,35 +396,27 @@ def completion(tenant_id, chat_id, question, name="New session", session_id=None
         raise LookupError("Session does not exist")
 
     conv = conv[0]
-    msg = []
     question = {
         "content": question,
         "role": "user",
         "id": str(uuid4())
     }
-    conv.message.append(question)
-    for m in conv.message:
-        if m["role"] == "system":
-            continue
-        if m["role"] == "assistant" and not msg:
-            continue
-        msg.append(m)
+    msg = chat_messages(ConversationService.recent_messages(conv) + [question])
     message_id = msg[-1].get("id")
     e, dia = DialogService.get_by_id(conv.dialog_id)
 
     kb_ids = kwargs.get("kb_ids",[])
     dia.kb_ids = list(set(dia.kb_ids + kb_ids))
-    if not conv.reference:
-        conv.reference = []
-    conv.message.append({"role": "assistant", "content": "", "id": message_id})
-    conv.reference.append({"chunks": [], "doc_aggs": []})
+    # Only the messages and the reference of this turn are written.
+    turn = Conversation(id=conv.id, message=[question, {"role": "assistant", "content": "", "id": message_id}],
+                        reference=[{"chunks": [], "doc_aggs": []}])
 
     if stream:
         try:
             for ans in chat(dia, msg, True, **kwargs):
-                ans = structure_answer(conv, ans, message_id, session_id)
+                ans = structure_answer(turn, ans, message_id, session_id)
                 yield "data:" + json.dumps({"code": 0, "data": ans}, ensure_ascii=False) + "\n\n"
-            ConversationService.update_by_id(conv.id, conv.to_dict())
+            ConversationService.append_turn(conv, turn.message, turn.reference[-1])
         except Exception as e:
             yield "data:" + json.dumps({"code": 500, "message": str(e),
                                         "data": {"answer": "**ERROR**: " + str(e), "reference": []}},
@@ -146,8 +426,8 @@ def completion(tenant_id, chat_id, question, name="New session", session_id=None
     else:
         answer = None
         for ans in chat(dia, msg, False, **kwargs):
-            answer = structure_answer(conv, ans, message_id, session_id)
-            ConversationService.update_by_id(conv.id, conv.to_dict())
+            answer = structure_answer(turn, ans, message_id, session_id)
+            ConversationService.append_turn(conv, turn.message, turn.reference[-1])
             break
         yield answer
 
@@ -14,15 +14,19 @@
 #  limitations under the License.
 #
 import binascii
+import json
 import logging
+import os
 import re
 import time
+from concurrent.futures import ThreadPoolExecutor
 from copy import deepcopy
 from datetime import datetime
 from functools import partial
 from timeit import default_timer as timer
 
-from langfuse import Langfuse
+import numpy as np
+import xxhash
 from peewee import fn
 
 from agentic_reasoning import DeepResearcher
@@ -32,18 +36,34 @@ from api.db.db_models import DB, Dialog
 from api.db.services.common_service import CommonService
 from api.db.services.document_service import DocumentService
 from api.db.services.knowledgebase_service import KnowledgebaseService
-from api.db.services.langfuse_service import TenantLangfuseService
 from api.db.services.llm_service import LLMBundle
 from api.db.services.tenant_llm_service import TenantLLMService
 from api.utils import current_timestamp, datetime_format
 from rag.app.resume import forbidden_select_fields4resume
 from rag.app.tag import label_question
 from rag.nlp.search import index_name
-from rag.prompts import chunks_format, citation_prompt, cross_languages, full_question, kb_prompt, keyword_extraction, message_fit_in
+from rag.prompts import chunks_format, citation_prompt, count_tokens, cross_languages, fit_history, full_question, history_summary, kb_prompt, keyword_extraction
 from rag.prompts.prompts import gen_meta_filter
-from rag.utils import num_tokens_from_string, rmSpace
+from rag.utils import llm_cache, num_tokens_from_string, rmSpace
+from rag.utils.redis_conn import REDIS_CONN
 from rag.utils.tavily_conn import Tavily
 
+# The LLM rewrites of a question (multi-turn refinement, translation, keywords, metadata filter)
+# are reused for the same inputs within this many seconds.
+CHAT_REFINE_CACHE_TTL = int(os.environ.get("CHAT_REFINE_CACHE_TTL", 3600))
+# Follow-up questions are retrieved with the raw last message while the LLM refines them; the chunks
+# found are kept when the refined question embeds within this cosine similarity of the raw one.
+CHAT_SPECULATIVE_RETRIEVAL = int(os.environ.get("CHAT_SPECULATIVE_RETRIEVAL", 1))
+CHAT_SPECULATIVE_THRESHOLD = float(os.environ.get("CHAT_SPECULATIVE_THRESHOLD", 0.9))
+SPECULATION_STATS_KEY = "chat_speculation"
+# History that no longer fits in the prompt is summarised into the system message. A summary is
+# cached by the messages it covers and extended only when more history is left out.
+CHAT_HISTORY_SUMMARY = int(os.environ.get("CHAT_HISTORY_SUMMARY", 0))
+CHAT_HISTORY_SUMMARY_TTL = 7 * 24 * 3600
+# Dialogs with `semantic_cache` in their prompt config answer a question with the cached answer to
+# one this similar (cosine of their embeddings), e.g. for FAQ bots.
+CHAT_SEMANTIC_CACHE_THRESHOLD = float(os.environ.get("CHAT_SEMANTIC_CACHE_THRESHOLD", 0.95))
+
 
 class DialogService(CommonService):
     model = Dialog
@@ -294,6 +314,105 @@ def meta_filter(metas: dict, filters: list[dict]):
     return doc_ids
 
 
+def _cached_refinement(stage, tenant_id, func, *key):
+    """`func()`, cached in the LLM cache of the tenant under `stage` and `key`, the inputs its result depends on."""
+    k = llm_cache.key(stage, tenant_id, *key)
+    try:
+        cached = llm_cache.get(stage, k)
+        if cached:
+            return json.loads(cached)
+    except Exception:
+        logging.exception(f"_cached_refinement get {k}")
+    res = func()
+    llm_cache.put(stage, k, json.dumps(res, ensure_ascii=False), CHAT_REFINE_CACHE_TTL)
+    return res
+
+
+def _fit_history(chat_mdl, msg, max_length, scope=(), ids=None):
+    """
+    message_fit_in for a system message followed by the conversation, with the part of the history
+    left out summarised into the system message when CHAT_HISTORY_SUMMARY is on. Summaries are only
+    shared within `scope` (tenant, dialog, model), and by messages with the same `ids` (those of
+    msg[1:], unique to a conversation).
+    """
+    used, kept, evicted = fit_history(msg, max_length)
+    if not CHAT_HISTORY_SUMMARY or not evicted or len(msg) < 3 or msg[0]["role"] != "system":
+        return used, kept
+
+    system, history, last = msg[0], msg[1:-1], msg[-1]
+    ids = ids or [None] * len(history)
+    # keys[i] identifies the summary of the conversation up to history[i], by the messages ending
+    # there rather than by all of them, as the history passed in is a window of the last messages.
+    keys = []
+    for i in range(len(history)):
+        hasher = xxhash.xxh64("\0".join(str(v) for v in scope).encode("utf-8"))
+        for j in range(max(0, i - 3), i + 1):
+            hasher.update(f"{ids[j]}\0{history[j]['role']}\0{history[j]['content']}\0".encode("utf-8", "surrogatepass"))
+        keys.append(f"chat_history_summary:{hasher.hexdigest()}")
+    summary, k = "", 0
+    for i, cached in reversed(list(enumerate(REDIS_CONN.mget(keys)))):
+        if cached:
+            summary, k = cached.decode("utf-8") if isinstance(cached, bytes) else cached, i + 1
+            break
+
+    def with_summary():
+        content = system["content"]
+        if summary:
+            content += f"\n\n### Summary of the earlier conversation:\n{summary}"
+        return [{"role": "system", "content": content}] + history[k:] + [last]
+
+    used, kept, evicted = fit_history(with_summary(), max_length)
+    if not evicted:
+        return used, kept
+
+    # Leave the newest history within 60% of what the system and last messages leave, starting
+    # with a user message, and summarise the rest; the next turns then reuse the summary.
+    budget = (max_length - count_tokens(system["content"]) - count_tokens(last["content"]) - 512) * 0.6
+    k2, tokens = len(history), 0
+    while k2 > k and tokens + count_tokens(history[k2 - 1]["content"]) < budget:
+        k2 -= 1
+        tokens += count_tokens(history[k2]["content"])
+    while k2 < len(history) and history[k2]["role"] != "user":
+        k2 += 1
+    if k2 > k:
+        summary = history_summary(chat_mdl, summary, history[k:k2])
+        if summary:
+            REDIS_CONN.set(keys[k2 - 1], summary, CHAT_HISTORY_SUMMARY_TTL)
+        k = k2
+    used, kept, _ = fit_history(with_summary(), max_length)
+    return used, kept
+
+
+def _record_speculation(accepted: bool, similarity: float, saved_ms: float):
+    try:
+        pipeline = REDIS_CONN.REDIS.pipeline(transaction=False)
+        pipeline.hincrby(SPECULATION_STATS_KEY, "total", 1)
+        pipeline.hincrby(SPECULATION_STATS_KEY, "accepted", int(accepted))
+        pipeline.hincrbyfloat(SPECULATION_STATS_KEY, "saved_ms", saved_ms)
+        # Similarities by tenths, to see where a threshold would fall.
+        pipeline.hincrby(SPECULATION_STATS_KEY, f"similarity_{min(9, max(0, int(similarity * 10)))}", 1)
+        pipeline.execute()
+    except Exception:
+        logging.exception("_record_speculation")
+
+
+def speculation_stats() -> dict:
+    """Acceptance rate and latency saved by speculative retrieval, over all the chats so far."""
+    try:
+        stats = {k.decode() if isinstance(k, bytes) else k: float(v) for k, v in REDIS_CONN.REDIS.hgetall(SPECULATION_STATS_KEY).items()}
+    except Exception:
+        logging.exception("speculation_stats")
+        return {}
+    total = int(stats.get("total", 0))
+    return {
+        "threshold": CHAT_SPECULATIVE_THRESHOLD,
+        "total": total,
+        "acceptance_rate": stats.get("accepted", 0) / total if total else 0,
+        "saved_ms_per_chat": stats.get("saved_ms", 0) / total if total else 0,
+        "similarity_histogram": [int(stats.get(f"similarity_{i}", 0)) for i in range(10)],
+    }
+
+
 def chat(dialog, messages, stream=True, **kwargs):
     assert messages[-1]["role"] == "user", "The last content of this conversation is not from user."
     if not dialog.kb_ids and not dialog.prompt_config.get("tavily_api_key"):
@@ -312,23 +431,20 @@ def chat(dialog, messages, stream=True, **kwargs):
 
     check_llm_ts = timer()
 
-    langfuse_tracer = None
-    trace_context = {}
-    langfuse_keys = TenantLangfuseService.filter_by_tenant(tenant_id=dialog.tenant_id)
-    if langfuse_keys:
-        langfuse = Langfuse(public_key=langfuse_keys.public_key, secret_key=langfuse_keys.secret_key, host=langfuse_keys.host)
-        if langfuse.auth_check():
-            langfuse_tracer = langfuse
-            trace_id = langfuse_tracer.create_trace_id()
-            trace_context = {"trace_id": trace_id}
-
-    check_langfuse_tracer_ts = timer()
     kbs, embd_mdl, rerank_mdl, chat_mdl, tts_mdl = get_models(dialog)
     toolcall_session, tools = kwargs.get("toolcall_session"), kwargs.get("tools")
     if toolcall_session and tools:
         chat_mdl.bind_tools(toolcall_session, tools)
     bind_models_ts = timer()
 
+    # The bundle carries the tenant's Langfuse client, authenticated once and cached with the model.
+    langfuse_tracer = chat_mdl.langfuse
+    trace_context = {}
+    if langfuse_tracer:
+        trace_context = {"trace_id": langfuse_tracer.create_trace_id()}
+    check_langfuse_tracer_ts = timer()
+    stage_ts = {}
+
     retriever = settings.retrievaler
     questions = [m["content"] for m in messages if m["role"] == "user"][-3:]
     attachments = kwargs["doc_ids"].split(",") if "doc_ids" in kwargs else []
@@ -353,37 +469,142 @@ def chat(dialog, messages, stream=True, **kwargs):
         if p["key"] not in kwargs:
             prompt_config["system"] = prompt_config["system"].replace("{%s}" % p["key"], " ")
 
-    if len(questions) > 1 and prompt_config.get("refine_multiturn"):
-        questions = [full_question(dialog.tenant_id, dialog.llm_id, messages)]
-    else:
-        questions = questions[-1:]
-
-    if prompt_config.get("cross_languages"):
-        questions = [cross_languages(dialog.tenant_id, dialog.llm_id, questions[0], prompt_config["cross_languages"])]
-
-    if dialog.meta_data_filter:
-        metas = DocumentService.get_meta_by_kbs(dialog.kb_ids)
-        if dialog.meta_data_filter.get("method") == "auto":
-            filters = gen_meta_filter(chat_mdl, metas, questions[-1])
-            attachments.extend(meta_filter(metas, filters))
-            if not attachments:
-                attachments = None
-        elif dialog.meta_data_filter.get("method") == "manual":
-            attachments.extend(meta_filter(metas, dialog.meta_data_filter["manual"]))
-            if not attachments:
-                attachments = None
-
-    if prompt_config.get("keyword", False):
-        questions[-1] += keyword_extraction(chat_mdl, questions[-1])
+    tenant_ids = list(set([kb.tenant_id for kb in kbs]))
+
+    def timed(name, func, *args, **kwargs):
+        st = timer()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            stage_ts[name] = (timer() - st) * 1000
+
+    def chunk_retrieval(question, doc_ids):
+        return retriever.retrieval(
+            question,
+            embd_mdl,
+            tenant_ids,
+            dialog.kb_ids,
+            1,
+            dialog.top_n,
+            dialog.similarity_threshold,
+            dialog.vector_similarity_weight,
+            doc_ids=doc_ids,
+            top=dialog.top_k,
+            aggs=False,
+            rerank_mdl=rerank_mdl,
+            rank_feature=timed("label_question_ms", label_question, question, kbs),
+        )
+
+    # Retrieval does not wait for the LLM to refine a follow-up question: it starts with the raw
+    # last message, and its result is used if the refined question turns out to mean the same.
+    speculation = {}
+    if (CHAT_SPECULATIVE_RETRIEVAL and len(questions) > 1 and prompt_config.get("refine_multiturn") and embd_mdl
+            and not dialog.meta_data_filter and not prompt_config.get("reasoning", False)
+            and attachments is not None and "knowledge" in [p["key"] for p in prompt_config["parameters"]]):
+        # Not waited for when the speculation is rejected.
+        speculation_exe = ThreadPoolExecutor(max_workers=2)
+        speculation["start"] = timer()
+        speculation["vector"] = speculation_exe.submit(embd_mdl.encode_queries, questions[-1])
+        speculation["chunks"] = speculation_exe.submit(timed, "speculative_retrieval_ms", chunk_retrieval, questions[-1], list(attachments))
+        speculation_exe.shutdown(wait=False)
+
+    # The question is rewritten first; the metadata filter and the keywords only need
+    # the rewritten question and are generated concurrently.
+    with ThreadPoolExecutor(max_workers=3) as exe:
+        metas_future = exe.submit(DocumentService.get_meta_by_kbs, dialog.kb_ids) if dialog.meta_data_filter else None
+        # The prompts of full_question and gen_meta_filter resolve relative dates with today's date.
+        today = datetime.now().date().isoformat()
+        if len(questions) > 1 and prompt_config.get("refine_multiturn"):
+            questions = [_cached_refinement("full_question", dialog.tenant_id, partial(full_question, dialog.tenant_id, dialog.llm_id, messages),
+                                            dialog.llm_id, [(m["role"], m["content"]) for m in messages], today)]
+        else:
+            questions = questions[-1:]
+
+        if prompt_config.get("cross_languages"):
+            questions = [_cached_refinement("cross_languages", dialog.tenant_id, partial(cross_languages, dialog.tenant_id, dialog.llm_id, questions[0], prompt_config["cross_languages"]),
+                                            dialog.llm_id, questions[0], prompt_config["cross_languages"])]
+        stage_ts["rewrite"] = timer()
+
+        keyword_future = None
+        if prompt_config.get("keyword", False):
+            keyword_future = exe.submit(_cached_refinement, "keyword_extraction", dialog.tenant_id, partial(keyword_extraction, chat_mdl, questions[-1]), dialog.llm_id, questions[-1])
+        if dialog.meta_data_filter:
+            metas = metas_future.result()
+            if dialog.meta_data_filter.get("method") == "auto":
+                filters = _cached_refinement("gen_meta_filter", dialog.tenant_id, partial(gen_meta_filter, chat_mdl, metas, questions[-1]), dialog.llm_id, questions[-1], metas, today)
+                attachments.extend(meta_filter(metas, filters))
+                if not attachments:
+                    attachments = None
+            elif dialog.meta_data_filter.get("method") == "manual":
+                attachments.extend(meta_filter(metas, dialog.meta_data_filter["manual"]))
+                if not attachments:
+                    attachments = None
+        if keyword_future:
+            questions[-1] += keyword_future.result()
 
     refine_question_ts = timer()
 
+    if speculation:
+        try:
+            raw_vec, _ = speculation["vector"].result()
+            refined_vec, _ = embd_mdl.encode_queries(" ".join(questions))
+            speculation["refined_vector"] = refined_vec
+            raw_vec, refined_vec = np.array(raw_vec, dtype=np.float64), np.array(refined_vec, dtype=np.float64)
+            similarity = float(raw_vec @ refined_vec / (np.linalg.norm(raw_vec) * np.linalg.norm(refined_vec) or 1))
+        except Exception:
+            logging.exception("speculative retrieval")
+            similarity = 0.
+        speculation["accepted"] = similarity >= CHAT_SPECULATIVE_THRESHOLD
+        check_ms = (timer() - refine_question_ts) * 1000
+        saved_ms = -check_ms
+        if speculation["accepted"]:
+            try:
+                speculation["kbinfos"] = speculation["chunks"].result()
+                # Retrieval overlapped the refinement instead of following it.
+                saved_ms += min((refine_question_ts - speculation["start"]) * 1000, stage_ts["speculative_retrieval_ms"])
+            except Exception:
+                logging.exception("speculative retrieval")
+                speculation["accepted"] = False
+        stage_ts["speculation_similarity"] = similarity
+        stage_ts["speculation_accepted"] = speculation["accepted"]
+        stage_ts["speculation_saved_ms"] = saved_ms
+        _record_speculation(speculation["accepted"], similarity, saved_ms)
+        refine_question_ts = timer()
+
+    # Answers are cached by question in the scope of the dialog settings, the request parameters and
+    # the conversation so far; with `semantic_cache`, the answer to a similar enough question is used too.
+    answer_cache = None
+    if prompt_config.get("semantic_cache") and embd_mdl and not prompt_config.get("reasoning", False):
+        question = " ".join(questions)
+        history = xxhash.xxh64(json.dumps([(m["role"], m["content"]) for m in messages[:-1] if m["role"] != "system"], ensure_ascii=False)).hexdigest()
+        scope = (dialog.id, dialog.update_time, history, sorted(attachments or []), sorted((k, str(v)) for k, v in kwargs.items()))
+        cache_key = llm_cache.key("chat", dialog.tenant_id, scope, question)
+
+        def embed():
+            if speculation.get("refined_vector") is not None:
+                return speculation["refined_vector"]
+            return embd_mdl.encode_queries(question)[0]
+
+        try:
+            cached, vector = llm_cache.semantic_get("chat", dialog.tenant_id, scope, cache_key, embed, CHAT_SEMANTIC_CACHE_THRESHOLD)
+        except Exception:
+            logging.exception("chat answer cache")
+            cached, vector = None, None
+        if cached is not None:
+            res = json.loads(cached)
+            res["metrics"] = {"total_ms": (timer() - chat_start_ts) * 1000, "cached": True}
+            res["created_at"] = time.time()
+            res["audio_binary"] = tts(tts_mdl, res["answer"])
+            yield res
+            return
+        if vector is not None:
+            answer_cache = (scope, cache_key, vector)
+
     thought = ""
     kbinfos = {"total": 0, "chunks": [], "doc_aggs": []}
     knowledges = []
 
     if attachments is not None and "knowledge" in [p["key"] for p in prompt_config["parameters"]]:
-        tenant_ids = list(set([kb.tenant_id for kb in kbs]))
         knowledges = []
         if prompt_config.get("reasoning", False):
             reasoner = DeepResearcher(
@@ -399,31 +620,27 @@ def chat(dialog, messages, stream=True, **kwargs):
                 elif stream:
                     yield think
         else:
-            if embd_mdl:
-                kbinfos = retriever.retrieval(
-                    " ".join(questions),
-                    embd_mdl,
-                    tenant_ids,
-                    dialog.kb_ids,
-                    1,
-                    dialog.top_n,
-                    dialog.similarity_threshold,
-                    dialog.vector_similarity_weight,
-                    doc_ids=attachments,
-                    top=dialog.top_k,
-                    aggs=False,
-                    rerank_mdl=rerank_mdl,
-                    rank_feature=label_question(" ".join(questions), kbs),
-                )
-            if prompt_config.get("tavily_api_key"):
-                tav = Tavily(prompt_config["tavily_api_key"])
-                tav_res = tav.retrieve_chunks(" ".join(questions))
-                kbinfos["chunks"].extend(tav_res["chunks"])
-                kbinfos["doc_aggs"].extend(tav_res["doc_aggs"])
-            if prompt_config.get("use_kg"):
-                ck = settings.kg_retrievaler.retrieval(" ".join(questions), tenant_ids, dialog.kb_ids, embd_mdl, LLMBundle(dialog.tenant_id, LLMType.CHAT))
-                if ck["content_with_weight"]:
-                    kbinfos["chunks"].insert(0, ck)
+            question = " ".join(questions)
+            # Chunk, web and knowledge graph retrievals are independent of each other.
+            with ThreadPoolExecutor(max_workers=3) as exe:
+                chunks_future = None
+                if speculation.get("accepted"):
+                    kbinfos = speculation["kbinfos"]
+                elif embd_mdl:
+                    chunks_future = exe.submit(timed, "chunk_retrieval_ms", chunk_retrieval, question, attachments)
+                tavily_future = exe.submit(timed, "tavily_ms", Tavily(prompt_config["tavily_api_key"]).retrieve_chunks, question) if prompt_config.get("tavily_api_key") else None
+                kg_future = exe.submit(timed, "kg_retrieval_ms", settings.kg_retrievaler.retrieval, question, tenant_ids, dialog.kb_ids, embd_mdl,
+                                       LLMBundle(dialog.tenant_id, LLMType.CHAT)) if prompt_config.get("use_kg") else None
+                if chunks_future:
+                    kbinfos = chunks_future.result()
+                if tavily_future:
+                    tav_res = tavily_future.result()
+                    kbinfos["chunks"].extend(tav_res["chunks"])
+                    kbinfos["doc_aggs"].extend(tav_res["doc_aggs"])
+                if kg_future:
+                    ck = kg_future.result()
+                    if ck["content_with_weight"]:
+                        kbinfos["chunks"].insert(0, ck)
 
             knowledges = kb_prompt(kbinfos, max_tokens)
 
@@ -443,14 +660,26 @@ def chat(dialog, messages, stream=True, **kwargs):
     if knowledges and (prompt_config.get("quote", True) and kwargs.get("quote", True)):
         prompt4citation = citation_prompt()
     msg.extend([{"role": m["role"], "content": re.sub(r"##\d+\$\$", "", m["content"])} for m in messages if m["role"] != "system"])
-    used_token_count, msg = message_fit_in(msg, int(max_tokens * 0.95))
+    used_token_count, msg = _fit_history(chat_mdl, msg, int(max_tokens * 0.95), (dialog.tenant_id, dialog.id, dialog.llm_id),
+                                         [m.get("id") for m in messages if m["role"] != "system"])
     assert len(msg) >= 2, f"message_fit_in has bug: {msg}"
     prompt = msg[0]["content"]
 
     if "max_tokens" in gen_conf:
         gen_conf["max_tokens"] = min(gen_conf["max_tokens"], max_tokens - used_token_count)
 
-    def decorate_answer(answer):
+    quote = bool(knowledges and (prompt_config.get("quote", True) and kwargs.get("quote", True)))
+
+    def citation_stream():
+        return retriever.citation_stream(
+            [ck["content_ltks"] for ck in kbinfos["chunks"]],
+            [ck["vector"] for ck in kbinfos["chunks"]],
+            embd_mdl,
+            tkweight=1 - dialog.vector_similarity_weight,
+            vtweight=dialog.vector_similarity_weight,
+        )
+
+    def decorate_answer(answer, citations=None):
         nonlocal embd_mdl, prompt_config, knowledges, kwargs, kbinfos, prompt, retrieval_ts, questions, langfuse_tracer
 
         refs = []
@@ -460,17 +689,11 @@ def chat(dialog, messages, stream=True, **kwargs):
             think = ans[0] + "</think>"
             answer = ans[1]
 
-        if knowledges and (prompt_config.get("quote", True) and kwargs.get("quote", True)):
+        if quote:
             idx = set([])
             if embd_mdl and not re.search(r"\[ID:([0-9]+)\]", answer):
-                answer, idx = retriever.insert_citations(
-                    answer,
-                    [ck["content_ltks"] for ck in kbinfos["chunks"]],
-                    [ck["vector"] for ck in kbinfos["chunks"]],
-                    embd_mdl,
-                    tkweight=1 - dialog.vector_similarity_weight,
-                    vtweight=dialog.vector_similarity_weight,
-                )
+                # The citations of a streamed answer were mostly found while it was generated.
+                answer, idx = (citations or citation_stream()).finish(answer)
             else:
                 for match in re.finditer(r"\[ID:([0-9]+)\]", answer):
                     i = int(match.group(1))
@@ -496,13 +719,27 @@ def chat(dialog, messages, stream=True, **kwargs):
 
         total_time_cost = (finish_chat_ts - chat_start_ts) * 1000
         check_llm_time_cost = (check_llm_ts - chat_start_ts) * 1000
-        check_langfuse_tracer_cost = (check_langfuse_tracer_ts - check_llm_ts) * 1000
-        bind_embedding_time_cost = (bind_models_ts - check_langfuse_tracer_ts) * 1000
-        refine_question_time_cost = (refine_question_ts - bind_models_ts) * 1000
+        check_langfuse_tracer_cost = (check_langfuse_tracer_ts - bind_models_ts) * 1000
+        bind_embedding_time_cost = (bind_models_ts - check_llm_ts) * 1000
+        refine_question_time_cost = (refine_question_ts - check_langfuse_tracer_ts) * 1000
         retrieval_time_cost = (retrieval_ts - refine_question_ts) * 1000
         generate_result_time_cost = (finish_chat_ts - retrieval_ts) * 1000
 
         tk_num = num_tokens_from_string(think + answer)
+        metrics = {
+            "total_ms": total_time_cost,
+            "check_llm_ms": check_llm_time_cost,
+            "check_langfuse_tracer_ms": check_langfuse_tracer_cost,
+            "bind_models_ms": bind_embedding_time_cost,
+            "refine_question_ms": refine_question_time_cost,
+            "rewrite_question_ms": (stage_ts.get("rewrite", refine_question_ts) - check_langfuse_tracer_ts) * 1000,
+            "retrieval_ms": retrieval_time_cost,
+            **{k: v for k, v in stage_ts.items() if k.endswith("_ms") or k.startswith("speculation_")},
+            "generate_answer_ms": generate_result_time_cost,
+            "generated_tokens": tk_num,
+            "tokens_per_second": int(tk_num / (generate_result_time_cost / 1000.0)) if generate_result_time_cost else 0,
+        }
+        logging.info(f"chat metrics: {json.dumps({k: round(v, 3) if isinstance(v, float) else v for k, v in metrics.items()})}")
         prompt += "\n\n### Query:\n%s" % " ".join(questions)
         prompt = (
             f"{prompt}\n\n"
@@ -526,7 +763,15 @@ def chat(dialog, messages, stream=True, **kwargs):
             langfuse_generation.update(output=langfuse_output)
             langfuse_generation.end()
 
-        return {"answer": think + answer, "reference": refs, "prompt": re.sub(r"\n", "  \n", prompt), "created_at": time.time()}
+        res = {"answer": think + answer, "reference": refs, "prompt": re.sub(r"\n", "  \n", prompt), "metrics": metrics, "created_at": time.time()}
+        if answer_cache and answer.find("**ERROR**") < 0:
+            scope, cache_key, vector = answer_cache
+            try:
+                llm_cache.semantic_put("chat", dialog.tenant_id, scope, cache_key, vector,
+                                       json.dumps({k: res[k] for k in ("answer", "reference", "prompt")}, ensure_ascii=False))
+            except Exception:
+                logging.exception("chat answer cache")
+        return res
 
     if langfuse_tracer:
         langfuse_generation = langfuse_tracer.start_generation(
@@ -536,6 +781,18 @@ def chat(dialog, messages, stream=True, **kwargs):
     if stream:
         last_ans = ""
         answer = ""
+        # Citations are put into the streamed answer as its sentences complete; the chunks
+        # they refer to are only sent with the final answer.
+        citations = citation_stream() if quote and embd_mdl else None
+
+        def cited(answer):
+            if not citations:
+                return answer
+            head, sep, body = answer.rpartition("</think>")
+            if not sep and "<think>" in answer:
+                return answer
+            return head + sep + citations.update(body)
+
         for ans in chat_mdl.chat_streamly(prompt + prompt4citation, msg[1:], gen_conf):
             if thought:
                 ans = re.sub(r"^.*</think>", "", ans, flags=re.DOTALL)
@@ -544,11 +801,11 @@ def chat(dialog, messages, stream=True, **kwargs):
             if num_tokens_from_string(delta_ans) < 16:
                 continue
             last_ans = answer
-            yield {"answer": thought + answer, "reference": {}, "audio_binary": tts(tts_mdl, delta_ans)}
+            yield {"answer": thought + cited(answer), "reference": {}, "audio_binary": tts(tts_mdl, delta_ans)}
         delta_ans = answer[len(last_ans) :]
         if delta_ans:
-            yield {"answer": thought + answer, "reference": {}, "audio_binary": tts(tts_mdl, delta_ans)}
-        yield decorate_answer(thought + answer)
+            yield {"answer": thought + cited(answer), "reference": {}, "audio_binary": tts(tts_mdl, delta_ans)}
+        yield decorate_answer(thought + answer, citations)
     else:
         answer = chat_mdl.chat(prompt + prompt4citation, msg[1:], gen_conf)
         user_content = msg[-1].get("content", "[content not available]")
@@ -15,8 +15,11 @@
 #
 import json
 import logging
+import os
 import random
 import re
+import threading
+from collections import OrderedDict
 from concurrent.futures import ThreadPoolExecutor
 from copy import deepcopy
 from datetime import datetime
@@ -34,12 +37,20 @@ from api.db.db_utils import bulk_insert_into_db
 from api.db.services.common_service import CommonService
 from api.db.services.knowledgebase_service import KnowledgebaseService
 from api.utils import current_timestamp, get_format_time, get_uuid
+from graphrag import graph_cache
 from rag.nlp import rag_tokenizer, search
 from rag.settings import get_svr_queue_name, SVR_CONSUMER_GROUP_NAME
+from rag.utils.parse_artifacts import remove_artifacts
 from rag.utils.redis_conn import REDIS_CONN
 from rag.utils.storage_factory import STORAGE_IMPL
 from rag.utils.doc_store_conn import OrderByExpr
 
+# Meta fields of the documents retrieved lately, for the knowledge bases used lately.
+DOC_META_CACHE_SIZE = int(os.environ.get("DOC_META_CACHE_SIZE", 256))
+DOC_META_CACHE_DOCS = 4096
+_doc_meta_cache = OrderedDict()
+_doc_meta_lock = threading.Lock()
+
 
 class DocumentService(CommonService):
     model = Document
@@ -263,6 +274,7 @@ class DocumentService(CommonService):
                 if STORAGE_IMPL.obj_exist(doc.kb_id, doc.thumbnail):
                     STORAGE_IMPL.rm(doc.kb_id, doc.thumbnail)
             settings.docStoreConn.delete({"doc_id": doc.id}, search.index_name(tenant_id), doc.kb_id)
+            remove_artifacts(doc.kb_id, doc.id)
 
             graph_source = settings.docStoreConn.getFields(
                 settings.docStoreConn.search(["source_id"], [], {"kb_id": doc.kb_id, "knowledge_graph_kwd": ["graph"]}, [], OrderByExpr(), 0, 1, search.index_name(tenant_id), [doc.kb_id]), ["source_id"]
@@ -276,6 +288,7 @@ class DocumentService(CommonService):
                                              search.index_name(tenant_id), doc.kb_id)
                 settings.docStoreConn.delete({"kb_id": doc.kb_id, "knowledge_graph_kwd": ["entity", "relation", "graph", "subgraph", "community_report"], "must_not": {"exists": "source_id"}},
                                              search.index_name(tenant_id), doc.kb_id)
+                graph_cache.bump_version(doc.kb_id)
         except Exception:
             pass
         return cls.delete_by_id(doc.id)
@@ -572,7 +585,57 @@ class DocumentService(CommonService):
     @classmethod
     @DB.connection_context()
     def update_meta_fields(cls, doc_id, meta_fields):
-        return cls.update_by_id(doc_id, {"meta_fields": meta_fields})
+        num = cls.update_by_id(doc_id, {"meta_fields": meta_fields})
+        e, doc = cls.get_by_id(doc_id)
+        if e:
+            REDIS_CONN.incr(f"doc_meta_version:{doc.kb_id}")
+        return num
+
+    @classmethod
+    @DB.connection_context()
+    def get_meta_fields(cls, doc_kbs):
+        """
+        The meta fields of documents, given as (doc_id, kb_id) pairs, by document id. They are
+        cached per knowledge base for as long as its `doc_meta_version` counter does not change.
+        """
+        by_kb = {}
+        for doc_id, kb_id in doc_kbs:
+            by_kb.setdefault(kb_id, set()).add(doc_id)
+        kb_ids = [kb_id for kb_id in by_kb if kb_id]
+        versions = dict(zip(kb_ids, REDIS_CONN.mget([f"doc_meta_version:{kb_id}" for kb_id in kb_ids]) if kb_ids else []))
+        meta, missing = {}, set()
+        with _doc_meta_lock:
+            for kb_id, doc_ids in by_kb.items():
+                hit = _doc_meta_cache.get(kb_id) if kb_id else None
+                if hit is None or hit[0] != versions.get(kb_id):
+                    missing |= doc_ids
+                    continue
+                _doc_meta_cache.move_to_end(kb_id)
+                for doc_id in doc_ids:
+                    if doc_id in hit[1]:
+                        meta[doc_id] = hit[1][doc_id]
+                    else:
+                        missing.add(doc_id)
+        if not missing:
+            return meta
+
+        fetched = {}
+        for r in cls.model.select(cls.model.id, cls.model.kb_id, cls.model.meta_fields).where(cls.model.id.in_(list(missing))):
+            meta[r.id] = r.meta_fields
+            fetched.setdefault(r.kb_id, {})[r.id] = r.meta_fields
+        with _doc_meta_lock:
+            for kb_id, docs in fetched.items():
+                if kb_id not in versions:
+                    continue
+                hit = _doc_meta_cache.get(kb_id)
+                if hit is None or hit[0] != versions[kb_id] or len(hit[1]) > DOC_META_CACHE_DOCS:
+                    hit = (versions[kb_id], {})
+                hit[1].update(docs)
+                _doc_meta_cache[kb_id] = hit
+                _doc_meta_cache.move_to_end(kb_id)
+            while len(_doc_meta_cache) > DOC_META_CACHE_SIZE:
+                _doc_meta_cache.popitem(last=False)
+        return meta
 
     @classmethod
     @DB.connection_context()
@@ -18,9 +18,14 @@ import logging
 import re
 from functools import partial
 from typing import Generator
+
+import anyio
+
 from api.db.db_models import LLM
 from api.db.services.common_service import CommonService
 from api.db.services.tenant_llm_service import LLM4Tenant, TenantLLMService
+from rag.llm import rerank_service
+from rag.utils import llm_cache
 
 
 class LLMService(CommonService):
@@ -98,7 +103,7 @@ class LLMBundle(LLM4Tenant):
 
         embeddings, used_tokens = self.mdl.encode(texts)
         llm_name = getattr(self, "llm_name", None)
-        if not TenantLLMService.increase_usage(self.tenant_id, self.llm_type, used_tokens, llm_name):
+        if not TenantLLMService.record_usage(self.tenant_id, self.llm_type, used_tokens, llm_name):
             logging.error("LLMBundle.encode can't update token usage for {}/EMBEDDING used_tokens: {}".format(self.tenant_id, used_tokens))
 
         if self.langfuse:
@@ -113,7 +118,7 @@ class LLMBundle(LLM4Tenant):
 
         emd, used_tokens = self.mdl.encode_queries(query)
         llm_name = getattr(self, "llm_name", None)
-        if not TenantLLMService.increase_usage(self.tenant_id, self.llm_type, used_tokens, llm_name):
+        if not TenantLLMService.record_usage(self.tenant_id, self.llm_type, used_tokens, llm_name):
             logging.error("LLMBundle.encode_queries can't update token usage for {}/EMBEDDING used_tokens: {}".format(self.tenant_id, used_tokens))
 
         if self.langfuse:
@@ -122,12 +127,17 @@ class LLMBundle(LLM4Tenant):
 
         return emd, used_tokens
 
-    def similarity(self, query: str, texts: list):
+    def similarity(self, query: str, texts: list, ids: list | None = None):
+        """
+        Scores of `texts` against `query`, truncated to RERANK_MAX_TOKENS. With the chunk `ids` of the
+        texts, the scores cached for them are reused (see rerank_service.similarity).
+        """
         if self.langfuse:
             generation = self.langfuse.start_generation(trace_context=self.trace_context, name="similarity", model=self.llm_name, input={"query": query, "texts": texts})
 
-        sim, used_tokens = self.mdl.similarity(query, texts)
-        if not TenantLLMService.increase_usage(self.tenant_id, self.llm_type, used_tokens):
+        sim, used_tokens = rerank_service.similarity(self.mdl, self.tenant_id, self.llm_name, query, texts, ids)
+
+        if not TenantLLMService.record_usage(self.tenant_id, self.llm_type, used_tokens):
             logging.error("LLMBundle.similarity can't update token usage for {}/RERANK used_tokens: {}".format(self.tenant_id, used_tokens))
 
         if self.langfuse:
@@ -141,7 +151,7 @@ class LLMBundle(LLM4Tenant):
             generation = self.langfuse.start_generation(trace_context=self.trace_context, name="describe", metadata={"model": self.llm_name})
 
         txt, used_tokens = self.mdl.describe(image)
-        if not TenantLLMService.increase_usage(self.tenant_id, self.llm_type, used_tokens):
+        if not TenantLLMService.record_usage(self.tenant_id, self.llm_type, used_tokens):
             logging.error("LLMBundle.describe can't update token usage for {}/IMAGE2TEXT used_tokens: {}".format(self.tenant_id, used_tokens))
 
         if self.langfuse:
@@ -155,7 +165,7 @@ class LLMBundle(LLM4Tenant):
             generation = self.language.start_generation(trace_context=self.trace_context, name="describe_with_prompt", metadata={"model": self.llm_name, "prompt": prompt})
 
         txt, used_tokens = self.mdl.describe_with_prompt(image, prompt)
-        if not TenantLLMService.increase_usage(self.tenant_id, self.llm_type, used_tokens):
+        if not TenantLLMService.record_usage(self.tenant_id, self.llm_type, used_tokens):
             logging.error("LLMBundle.describe can't update token usage for {}/IMAGE2TEXT used_tokens: {}".format(self.tenant_id, used_tokens))
 
         if self.langfuse:
@@ -169,7 +179,7 @@ class LLMBundle(LLM4Tenant):
             generation = self.langfuse.start_generation(trace_context=self.trace_context, name="transcription", metadata={"model": self.llm_name})
 
         txt, used_tokens = self.mdl.transcription(audio)
-        if not TenantLLMService.increase_usage(self.tenant_id, self.llm_type, used_tokens):
+        if not TenantLLMService.record_usage(self.tenant_id, self.llm_type, used_tokens):
             logging.error("LLMBundle.transcription can't update token usage for {}/SEQUENCE2TXT used_tokens: {}".format(self.tenant_id, used_tokens))
 
         if self.langfuse:
@@ -184,7 +194,7 @@ class LLMBundle(LLM4Tenant):
 
         for chunk in self.mdl.tts(text):
             if isinstance(chunk, int):
-                if not TenantLLMService.increase_usage(self.tenant_id, self.llm_type, chunk, self.llm_name):
+                if not TenantLLMService.record_usage(self.tenant_id, self.llm_type, chunk, self.llm_name):
                     logging.error("LLMBundle.tts can't update token usage for {}/TTS".format(self.tenant_id))
                 return
             yield chunk
@@ -223,7 +233,29 @@ class LLMBundle(LLM4Tenant):
             use_kwargs = {k: v for k, v in kwargs.items() if k in keyword_args}
         return use_kwargs
         
-    def chat(self, system: str, history: list, gen_conf: dict = {}, **kwargs) -> str:
+    def _cache_key(self, cache, system, history, gen_conf):
+        # Answers using tools depend on more than the messages.
+        if not cache or (self.is_tools and self.mdl.is_tools):
+            return None
+        return llm_cache.key(cache, self.tenant_id, self.llm_name, system, history, gen_conf)
+
+    @staticmethod
+    def _cache_answer(cache, key, txt):
+        if key and isinstance(txt, str) and txt.find("**ERROR**") < 0:
+            llm_cache.put(cache, key, txt)
+
+    def chat(self, system: str, history: list, gen_conf: dict = {}, cache: str | None = None, **kwargs) -> str:
+        """The answer of the model; with `cache`, a use case of llm_cache, the answers to the same messages are reused."""
+        key = self._cache_key(cache, system, history, gen_conf)
+        if key:
+            txt = llm_cache.get(cache, key)
+            if txt is not None:
+                return txt
+        txt = self._chat(system, history, gen_conf, **kwargs)
+        self._cache_answer(cache, key, txt)
+        return txt
+
+    def _chat(self, system: str, history: list, gen_conf: dict = {}, **kwargs) -> str:
         if self.langfuse:
             generation = self.langfuse.start_generation(trace_context=self.trace_context, name="chat", model=self.llm_name, input={"system": system, "history": history})
 
@@ -238,7 +270,7 @@ class LLMBundle(LLM4Tenant):
         if not self.verbose_tool_use:
             txt = re.sub(r"<tool_call>.*?</tool_call>", "", txt, flags=re.DOTALL)
 
-        if isinstance(txt, int) and not TenantLLMService.increase_usage(self.tenant_id, self.llm_type, used_tokens, self.llm_name):
+        if isinstance(txt, int) and not TenantLLMService.record_usage(self.tenant_id, self.llm_type, used_tokens, self.llm_name):
             logging.error("LLMBundle.chat can't update token usage for {}/CHAT llm_name: {}, used_tokens: {}".format(self.tenant_id, self.llm_name, used_tokens))
 
         if self.langfuse:
@@ -247,6 +279,76 @@ class LLMBundle(LLM4Tenant):
 
         return txt
 
+    async def async_chat(self, system: str, history: list, gen_conf: dict = {}, cache: str | None = None, **kwargs) -> str:
+        """`chat` for async callers, awaiting the model on the event loop where it supports it."""
+        key = self._cache_key(cache, system, history, gen_conf)
+        if key:
+            txt = await anyio.to_thread.run_sync(llm_cache.get, cache, key)
+            if txt is not None:
+                return txt
+        txt = await self._async_chat(system, history, gen_conf, **kwargs)
+        if key:
+            await anyio.to_thread.run_sync(self._cache_answer, cache, key, txt)
+        return txt
+
+    async def _async_chat(self, system: str, history: list, gen_conf: dict = {}, **kwargs) -> str:
+        if (self.is_tools and self.mdl.is_tools) or not hasattr(self.mdl, "async_chat"):
+            return await anyio.to_thread.run_sync(partial(self._chat, system, history, gen_conf, **kwargs))
+        if self.langfuse:
+            generation = self.langfuse.start_generation(trace_context=self.trace_context, name="chat", model=self.llm_name, input={"system": system, "history": history})
+
+        chat_partial = partial(self.mdl.async_chat, system, history, gen_conf)
+        use_kwargs = self._clean_param(chat_partial, **kwargs)
+        txt, used_tokens = await chat_partial(**use_kwargs)
+        txt = self._remove_reasoning_content(txt)
+
+        if not self.verbose_tool_use:
+            txt = re.sub(r"<tool_call>.*?</tool_call>", "", txt, flags=re.DOTALL)
+
+        if used_tokens and not TenantLLMService.record_usage(self.tenant_id, self.llm_type, used_tokens, self.llm_name):
+            logging.error("LLMBundle.async_chat can't update token usage for {}/CHAT llm_name: {}, used_tokens: {}".format(self.tenant_id, self.llm_name, used_tokens))
+
+        if self.langfuse:
+            generation.update(output={"output": txt}, usage_details={"total_tokens": used_tokens})
+            generation.end()
+
+        return txt
+
+    async def async_chat_streamly(self, system: str, history: list, gen_conf: dict = {}, **kwargs):
+        """`chat_streamly` as an async generator of the answer so far."""
+        if (self.is_tools and self.mdl.is_tools) or not hasattr(self.mdl, "async_chat_streamly"):
+            stream = self.chat_streamly(system, history, gen_conf, **kwargs)
+            done = object()
+            while (ans := await anyio.to_thread.run_sync(next, stream, done)) is not done:
+                yield ans
+            return
+        if self.langfuse:
+            generation = self.langfuse.start_generation(trace_context=self.trace_context, name="chat_streamly", model=self.llm_name, input={"system": system, "history": history})
+
+        ans = ""
+        total_tokens = 0
+        chat_partial = partial(self.mdl.async_chat_streamly, system, history, gen_conf)
+        use_kwargs = self._clean_param(chat_partial, **kwargs)
+        async for txt in chat_partial(**use_kwargs):
+            if isinstance(txt, int):
+                total_tokens = txt
+                break
+
+            if txt.endswith("</think>"):
+                ans = ans.rstrip("</think>")
+
+            if not self.verbose_tool_use:
+                txt = re.sub(r"<tool_call>.*?</tool_call>", "", txt, flags=re.DOTALL)
+
+            ans += txt
+            yield ans
+
+        if self.langfuse:
+            generation.update(output={"output": ans}, usage_details={"total_tokens": total_tokens})
+            generation.end()
+        if total_tokens > 0 and not TenantLLMService.record_usage(self.tenant_id, self.llm_type, total_tokens, self.llm_name):
+            logging.error("LLMBundle.async_chat_streamly can't update token usage for {}/CHAT llm_name: {}, used_tokens: {}".format(self.tenant_id, self.llm_name, total_tokens))
+
     def chat_streamly(self, system: str, history: list, gen_conf: dict = {}, **kwargs):
         if self.langfuse:
             generation = self.langfuse.start_generation(trace_context=self.trace_context, name="chat_streamly", model=self.llm_name, input={"system": system, "history": history})
@@ -275,5 +377,5 @@ class LLMBundle(LLM4Tenant):
             yield ans
 
         if total_tokens > 0:
-            if not TenantLLMService.increase_usage(self.tenant_id, self.llm_type, txt, self.llm_name):
+            if not TenantLLMService.record_usage(self.tenant_id, self.llm_type, txt, self.llm_name):
                 logging.error("LLMBundle.chat_streamly can't update token usage for {}/CHAT llm_name: {}, content: {}".format(self.tenant_id, self.llm_name, txt))
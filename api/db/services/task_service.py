@@ -20,7 +20,6 @@ import xxhash
 from datetime import datetime
 
 from api.db.db_utils import bulk_insert_into_db
-from deepdoc.parser import PdfParser
 from peewee import JOIN
 from api.db.db_models import DB, File2Document, File
 from api.db import StatusEnum, FileType, TaskStatus
@@ -28,9 +27,10 @@ from api.db.db_models import Task, Document, Knowledgebase, Tenant
 from api.db.services.common_service import CommonService
 from api.db.services.document_service import DocumentService
 from api.utils import current_timestamp, get_uuid
-from deepdoc.parser.excel_parser import RAGFlowExcelParser
 from rag.settings import get_svr_queue_name
+from rag.utils.doc_probe import probe_storage
 from rag.utils.storage_factory import STORAGE_IMPL
+from rag.utils.task_scheduler import TASK_COST_AWARE_SPLIT, order_by_expected_cost, page_cost, split_by_cost, split_fixed, table_rows_per_task
 from rag.utils.redis_conn import REDIS_CONN
 from api import settings
 from rag.nlp import search
@@ -324,46 +324,60 @@ def queue_tasks(doc: dict, bucket: str, name: str, priority: int):
         priority (int, optional): Priority level for task queueing (default is 0).
     
     Note:
-        - For PDF documents, tasks are created per page range based on configuration
-        - For Excel documents, tasks are created per row range
+        - For PDF documents, tasks are created per page range based on configuration; with
+          TASK_COST_AWARE_SPLIT, ranges are balanced by estimated page cost (see rag.utils.task_scheduler)
+        - For Excel documents, tasks are created per row range, fewer rows per task for wide sheets
+        - Page and row numbers come from rag.utils.doc_probe, which only reads the needed byte ranges
+        - Tasks are queued shortest expected job first
         - Task digests are calculated for optimization and reuse
-        - Previous task chunks may be reused if available
+        - Previous task chunks may be reused if available; tasks that cannot reuse them
+          still reuse the OCR, sections and vectors of unchanged stages (see rag.utils.parse_artifacts)
     """
     def new_task():
         return {"id": get_uuid(), "doc_id": doc["id"], "progress": 0.0, "from_page": 0, "to_page": 100000000}
 
     parse_task_array = []
+    task_costs = {}
 
     if doc["type"] == FileType.PDF.value:
-        file_bin = STORAGE_IMPL.get(bucket, name)
         do_layout = doc["parser_config"].get("layout_recognize", "DeepDOC")
-        pages = PdfParser.total_page_number(doc["name"], file_bin)
-        if pages is None:
-            pages = 0
         page_size = doc["parser_config"].get("task_page_size") or 12
         if doc["parser_id"] == "paper":
             page_size = doc["parser_config"].get("task_page_size") or 22
         if doc["parser_id"] in ["one", "knowledge_graph"] or do_layout != "DeepDOC":
             page_size = 10 ** 9
+        cost_aware = TASK_COST_AWARE_SPLIT and page_size < 10 ** 9
+        meta = probe_storage(STORAGE_IMPL, bucket, name, doc["name"], page_profile=cost_aware)
+        pages = meta.get("pages")
+        if pages is None:
+            pages = 0
+        costs = [page_cost(p) for p in meta["page_profile"]] if meta.get("page_profile") else None
         page_ranges = doc["parser_config"].get("pages") or [(1, 10 ** 5)]
         for s, e in page_ranges:
             s -= 1
             s = max(0, s)
             e = min(e - 1, pages)
-            for p in range(s, e, page_size):
+            ranges = split_by_cost(costs, s, e, page_size) if costs else split_fixed(s, e, page_size)
+            for from_page, to_page, cost in ranges:
                 task = new_task()
-                task["from_page"] = p
-                task["to_page"] = min(p + page_size, e)
+                task["from_page"] = from_page
+                task["to_page"] = to_page
+                if meta.get("page_profile"):
+                    # Kept with the task, so that task_scheduler can replay the recorded tasks.
+                    task["page_profile"] = meta["page_profile"][from_page:to_page]
                 parse_task_array.append(task)
+                task_costs[task["id"]] = cost
 
     elif doc["parser_id"] == "table":
-        file_bin = STORAGE_IMPL.get(bucket, name)
-        rn = RAGFlowExcelParser.row_number(doc["name"], file_bin)
-        for i in range(0, rn, 3000):
+        meta = probe_storage(STORAGE_IMPL, bucket, name, doc["name"])
+        rn = meta.get("rows") or 0
+        rows_per_task = table_rows_per_task(meta.get("columns"))
+        for i in range(0, rn, rows_per_task):
             task = new_task()
             task["from_page"] = i
-            task["to_page"] = min(i + 3000, rn)
+            task["to_page"] = min(i + rows_per_task, rn)
             parse_task_array.append(task)
+            task_costs[task["id"]] = task["to_page"] - i
     else:
         parse_task_array.append(new_task())
 
@@ -401,8 +415,9 @@ def queue_tasks(doc: dict, bucket: str, name: str, priority: int):
     bulk_insert_into_db(Task, parse_task_array, True)
     DocumentService.begin2parse(doc["id"])
 
-    unfinished_task_array = [task for task in parse_task_array if task["progress"] < 1.0]
+    unfinished_task_array = order_by_expected_cost([task for task in parse_task_array if task["progress"] < 1.0], task_costs)
     for unfinished_task in unfinished_task_array:
+        unfinished_task = {k: v for k, v in unfinished_task.items() if k != "page_profile"}
         assert REDIS_CONN.queue_product(
             get_svr_queue_name(priority), message=unfinished_task
         ), "Can't access Redis. Please check the Redis' status."
@@ -13,7 +13,13 @@
 #  See the License for the specific language governing permissions and
 #  limitations under the License.
 #
+import atexit
+import copy
 import logging
+import os
+import threading
+import time
+from collections import defaultdict
 from langfuse import Langfuse
 from api import settings
 from api.db import LLMType
@@ -22,6 +28,16 @@ from api.db.services.common_service import CommonService
 from api.db.services.langfuse_service import TenantLangfuseService
 from api.db.services.user_service import TenantService
 from rag.llm import ChatModel, CvModel, EmbeddingModel, RerankModel, Seq2txtModel, TTSModel
+from rag.utils.redis_conn import REDIS_CONN, RedisDistributedLock
+
+# Model instances, configs and Langfuse clients are reused by the LLM bundles of a tenant
+# for this many seconds, or until its model settings change.
+LLM_INSTANCE_CACHE_TTL = int(os.environ.get("LLM_INSTANCE_CACHE_TTL", 300))
+LLM_INSTANCE_CACHE_SIZE = 256
+LLM_USAGE_FLUSH_INTERVAL = int(os.environ.get("LLM_USAGE_FLUSH_INTERVAL", 5))
+
+_instances = {}
+_instances_lock = threading.Lock()
 
 
 class LLMFactoriesService(CommonService):
@@ -133,6 +149,10 @@ class TenantLLMService(CommonService):
     @DB.connection_context()
     def model_instance(cls, tenant_id, llm_type, llm_name=None, lang="Chinese", **kwargs):
         model_config = TenantLLMService.get_model_config(tenant_id, llm_type, llm_name)
+        return cls.model_instance_from_config(model_config, llm_type, lang, **kwargs)
+
+    @staticmethod
+    def model_instance_from_config(model_config, llm_type, lang="Chinese", **kwargs):
         kwargs.update({"provider": model_config["llm_factory"]})
         if llm_type == LLMType.EMBEDDING.value:
             if model_config["llm_factory"] not in EmbeddingModel:
@@ -167,14 +187,48 @@ class TenantLLMService(CommonService):
                 base_url=model_config["api_base"],
             )
 
+    @staticmethod
+    def bump_config_version(tenant_id):
+        """Drop the model instances of a tenant cached in every process; call after changing its model settings."""
+        REDIS_CONN.incr(f"llm_config_version:{tenant_id}")
+
     @classmethod
-    @DB.connection_context()
-    def increase_usage(cls, tenant_id, llm_type, used_tokens, llm_name=None):
-        e, tenant = TenantService.get_by_id(tenant_id)
-        if not e:
-            logging.error(f"Tenant not found: {tenant_id}")
-            return 0
+    def cached_model(cls, tenant_id, llm_type, llm_name=None, lang="Chinese", **kwargs):
+        """
+        (model instance, model config, Langfuse client or None) of a tenant's model, shared by
+        the bundles of the process. Callers get a shallow copy of the instance: it shares the
+        HTTP client, with its connection pool, while tools bound to it stay per bundle.
+        """
+        key = (tenant_id, str(llm_type), llm_name, lang, tuple(sorted((k, repr(v)) for k, v in kwargs.items())))
+        version = REDIS_CONN.get(f"llm_config_version:{tenant_id}")
+        with _instances_lock:
+            hit = _instances.get(key)
+        if not hit or hit[0] != version or time.time() - hit[1] > LLM_INSTANCE_CACHE_TTL:
+            model_config = cls.get_model_config(tenant_id, llm_type, llm_name)
+            mdl = cls.model_instance_from_config(model_config, llm_type, lang, **kwargs)
+            langfuse = None
+            langfuse_keys = TenantLangfuseService.filter_by_tenant(tenant_id=tenant_id)
+            if langfuse_keys:
+                langfuse = Langfuse(public_key=langfuse_keys.public_key, secret_key=langfuse_keys.secret_key, host=langfuse_keys.host)
+                if not langfuse.auth_check():
+                    langfuse = None
+            hit = (version, time.time(), mdl, model_config, langfuse)
+            if mdl:
+                with _instances_lock:
+                    _instances.pop(key, None)
+                    _instances[key] = hit
+                    while len(_instances) > LLM_INSTANCE_CACHE_SIZE:
+                        _instances.pop(next(iter(_instances)))
+        _, _, mdl, model_config, langfuse = hit
+        if mdl:
+            mdl = copy.copy(mdl)
+            for k, v in vars(mdl).items():
+                if isinstance(v, (list, dict)):
+                    setattr(mdl, k, copy.copy(v))
+        return mdl, model_config, langfuse
 
+    @staticmethod
+    def _usage_model_name(tenant, llm_type, llm_name=None):
         llm_map = {
             LLMType.EMBEDDING.value: tenant.embd_id if not llm_name else llm_name,
             LLMType.SPEECH2TEXT.value: tenant.asr_id,
@@ -183,8 +237,17 @@ class TenantLLMService(CommonService):
             LLMType.RERANK.value: tenant.rerank_id if not llm_name else llm_name,
             LLMType.TTS.value: tenant.tts_id if not llm_name else llm_name,
         }
+        return llm_map.get(llm_type)
+
+    @classmethod
+    @DB.connection_context()
+    def increase_usage(cls, tenant_id, llm_type, used_tokens, llm_name=None):
+        e, tenant = TenantService.get_by_id(tenant_id)
+        if not e:
+            logging.error(f"Tenant not found: {tenant_id}")
+            return 0
 
-        mdlnm = llm_map.get(llm_type)
+        mdlnm = cls._usage_model_name(tenant, llm_type, llm_name)
         if mdlnm is None:
             logging.error(f"LLM type error: {llm_type}")
             return 0
@@ -203,6 +266,33 @@ class TenantLLMService(CommonService):
 
         return num
 
+    @classmethod
+    @DB.connection_context()
+    def increase_usage_many(cls, usage: dict):
+        """`increase_usage` of (tenant_id, llm_type, llm_name) -> used tokens, in one transaction."""
+        tenants = {t.id: t for t in TenantService.get_by_ids(list({tenant_id for tenant_id, _, _ in usage}))}
+        updates = defaultdict(int)
+        for (tenant_id, llm_type, llm_name), used_tokens in usage.items():
+            if tenant_id not in tenants:
+                logging.error(f"Tenant not found: {tenant_id}")
+                continue
+            mdlnm = cls._usage_model_name(tenants[tenant_id], llm_type, llm_name)
+            if mdlnm is None:
+                logging.error(f"LLM type error: {llm_type}")
+                continue
+            updates[(tenant_id, *TenantLLMService.split_model_name_and_factory(mdlnm))] += used_tokens
+        with DB.atomic():
+            for (tenant_id, llm_name, llm_factory), used_tokens in updates.items():
+                cls.model.update(used_tokens=cls.model.used_tokens + used_tokens).where(
+                    cls.model.tenant_id == tenant_id, cls.model.llm_name == llm_name, cls.model.llm_factory == llm_factory if llm_factory else True
+                ).execute()
+        return len(updates)
+
+    @staticmethod
+    def record_usage(tenant_id, llm_type, used_tokens, llm_name=None):
+        """Count token usage without waiting for the database; see UsageAccumulator."""
+        return usage_accumulator.add(tenant_id, llm_type, used_tokens, llm_name)
+
     @classmethod
     @DB.connection_context()
     def get_openai_models(cls):
@@ -229,24 +319,110 @@ class TenantLLMService(CommonService):
             return llm.model_type
 
 
+class UsageAccumulator:
+    """
+    Token usage of the models, added up in memory and flushed every LLM_USAGE_FLUSH_INTERVAL
+    seconds by a background thread: first into a Redis hash, where it survives the process,
+    then out of Redis into the database by one process at a time, in one transaction.
+
+    Usage recorded since the last flush is lost if the process is killed; usage moved out
+    of Redis is counted again if the flushing process dies between the database commit and
+    the removal of what it moved (at least once).
+    """
+
+    PENDING_KEY = "llm_usage:pending"
+    FLUSHING_KEY = "llm_usage:flushing"
+    LOCK_KEY = "llm_usage:flush_lock"
+
+    def __init__(self):
+        self._pending = defaultdict(int)
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def add(self, tenant_id, llm_type, used_tokens, llm_name=None):
+        if not isinstance(used_tokens, int) or used_tokens <= 0:
+            return True
+        with self._lock:
+            self._pending[f"{tenant_id}|{llm_type}|{llm_name or ''}"] += used_tokens
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="llm_usage_flusher", daemon=True)
+                self._thread.start()
+                atexit.register(self.flush)
+        return True
+
+    def pending_tokens(self) -> int:
+        """Tokens counted but not in the database yet, of this process and in Redis."""
+        with self._lock:
+            local = sum(self._pending.values())
+        try:
+            in_redis = sum(int(v) for k in [self.PENDING_KEY, self.FLUSHING_KEY] for v in REDIS_CONN.REDIS.hvals(k))
+        except Exception:
+            in_redis = 0
+        return local + in_redis
+
+    def _run(self):
+        while True:
+            time.sleep(LLM_USAGE_FLUSH_INTERVAL)
+            try:
+                self.flush()
+            except Exception:
+                logging.exception("UsageAccumulator.flush got exception")
+
+    def _push(self):
+        with self._lock:
+            pending, self._pending = self._pending, defaultdict(int)
+        if not pending:
+            return
+        try:
+            pipeline = REDIS_CONN.REDIS.pipeline(transaction=True)
+            for k, v in pending.items():
+                pipeline.hincrby(self.PENDING_KEY, k, v)
+            pipeline.execute()
+        except Exception:
+            with self._lock:
+                for k, v in pending.items():
+                    self._pending[k] += v
+            raise
+
+    def flush(self):
+        self._push()
+        lock = RedisDistributedLock(self.LOCK_KEY, timeout=60, blocking_timeout=0)
+        if not lock.acquire():
+            return
+        try:
+            # Usage moved out of Redis by a flush that died is applied before any new one.
+            if not REDIS_CONN.exist(self.FLUSHING_KEY):
+                if not REDIS_CONN.exist(self.PENDING_KEY):
+                    return
+                REDIS_CONN.REDIS.rename(self.PENDING_KEY, self.FLUSHING_KEY)
+            usage = {}
+            for k, v in REDIS_CONN.REDIS.hgetall(self.FLUSHING_KEY).items():
+                k = k.decode("utf-8") if isinstance(k, bytes) else k
+                tenant_id, llm_type, llm_name = k.split("|", 2)
+                usage[(tenant_id, llm_type, llm_name or None)] = int(v)
+            if usage:
+                TenantLLMService.increase_usage_many(usage)
+            REDIS_CONN.delete(self.FLUSHING_KEY)
+            logging.debug(f"Flushed {sum(usage.values())} tokens of usage of {len(usage)} models")
+        finally:
+            lock.release()
+
+
+usage_accumulator = UsageAccumulator()
+
+
 class LLM4Tenant:
     def __init__(self, tenant_id, llm_type, llm_name=None, lang="Chinese", **kwargs):
         self.tenant_id = tenant_id
         self.llm_type = llm_type
         self.llm_name = llm_name
-        self.mdl = TenantLLMService.model_instance(tenant_id, llm_type, llm_name, lang=lang, **kwargs)
+        self.mdl, model_config, self.langfuse = TenantLLMService.cached_model(tenant_id, llm_type, llm_name, lang=lang, **kwargs)
         assert self.mdl, "Can't find model for {}/{}/{}".format(tenant_id, llm_type, llm_name)
-        model_config = TenantLLMService.get_model_config(tenant_id, llm_type, llm_name)
         self.max_length = model_config.get("max_tokens", 8192)
 
         self.is_tools = model_config.get("is_tools", False)
         self.verbose_tool_use = kwargs.get("verbose_tool_use")
 
-        langfuse_keys = TenantLangfuseService.filter_by_tenant(tenant_id=tenant_id)
-        self.langfuse = None
-        if langfuse_keys:
-            langfuse = Langfuse(public_key=langfuse_keys.public_key, secret_key=langfuse_keys.secret_key, host=langfuse_keys.host)
-            if langfuse.auth_check():
-                self.langfuse = langfuse
-                trace_id = self.langfuse.create_trace_id()
-                self.trace_context = {"trace_id": trace_id}
\ No newline at end of file
+        if self.langfuse:
+            trace_id = self.langfuse.create_trace_id()
+            self.trace_context = {"trace_id": trace_id}
\ No newline at end of file
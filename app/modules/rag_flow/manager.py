@@ -38,6 +38,7 @@ from rag.app.tag import chunk as tag_chunk
 
 # Import necessary for the conversion function
 from deepdoc.parser.pdf_parser import RAGFlowPdfParser
+from rag.utils.doc_probe import probe
 
 
 class Manager:
@@ -51,6 +52,7 @@ class Manager:
         self.tokens = data.chunkingTokenSize if data.chunkingTokenSize else 512
         self.layout = data.chunkingLayout if data.chunkingLayout else "DeepDOC"
         self.output = data.outputFile if data.outputFile else None
+        self.file_info = {}
         # self.kb_id=data.kb_id
     
     def _convert_to_eml(self, original_filename, original_binary, callback):
@@ -125,6 +127,7 @@ Content-Transfer-Encoding: 8bit
 
             return {
                 "chunks": chunks,
+                "fileInfo": self.file_info,
             }
 
         except Exception as e:
@@ -221,11 +224,16 @@ Content-Transfer-Encoding: 8bit
             print(f"❌ File not found: {file_path}")
             return
 
+        # Page/row counts only need the file trailer or sheet headers, not a full parse.
+        with open(file_path, 'rb') as f:
+            self.file_info = probe(os.path.basename(file_path), f=f)
+
         chunks = self.extract_chunks(
             pdf_path= file_path,
             method=self.method,
             token_size=self.tokens,
-            layout=self.layout
+            layout=self.layout,
+            to_page=self.file_info.get("pages") or 100000
         )
 
         if self.output:
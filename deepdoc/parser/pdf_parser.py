@@ -372,6 +372,35 @@ class RAGFlowPdfParser:
             self.boxes[i]["bottom"] += \
                 self.page_cum_height[self.boxes[i]["page_number"] - 1]
 
+    LAYOUT_STATE = ["boxes", "page_layout", "mean_height", "mean_width", "page_cum_height", "lefted_chars",
+                    "garbages", "is_english", "outlines", "total_page", "page_from", "image_zoomin"]
+
+    def _layout_state(self):
+        """Parser state right after `_layouts_rec`, without the page images which are cheap to render again."""
+        return {k: getattr(self, k, None) for k in self.LAYOUT_STATE}
+
+    def _restore_layout_state(self, fnm, state, page_from=0, page_to=299):
+        """Restore a `_layout_state` snapshot: only the page images are rendered, OCR and layout recognition are skipped."""
+        with sys.modules[LOCK_KEY_pdfplumber]:
+            with (pdfplumber.open(fnm) if isinstance(fnm, str) else pdfplumber.open(BytesIO(fnm))) as pdf:
+                self.page_images = [p.to_image(resolution=72 * state["image_zoomin"], antialias=True).annotated for p in
+                                    pdf.pages[page_from:page_to]]
+        for k, v in state.items():
+            setattr(self, k, v)
+        assert len(self.page_cum_height) == len(self.page_images) + 1
+
+    def _reuse_layouts(self, fnm, artifacts, zoomin=3, page_from=0, page_to=299, drop=True):
+        """Restore the OCR and layouts that `artifacts` (rag.utils.parse_artifacts) kept for this page range, if any."""
+        state = artifacts.load("layouts", {"zoomin": zoomin, "drop": drop}) if artifacts else None
+        if not state:
+            return False
+        self._restore_layout_state(fnm, state, page_from, page_to)
+        return True
+
+    def _save_layouts(self, artifacts, zoomin=3, drop=True):
+        if artifacts:
+            artifacts.save("layouts", self._layout_state(), {"zoomin": zoomin, "drop": drop})
+
     def _text_merge(self):
         # merge adjusted boxes
         bxs = self.boxes
@@ -1014,6 +1043,7 @@ class RAGFlowPdfParser:
         self.page_cum_height = [0]
         self.page_layout = []
         self.page_from = page_from
+        self.image_zoomin = zoomin
         start = timer()
         try:
             with sys.modules[LOCK_KEY_pdfplumber]:
@@ -0,0 +1,191 @@
+#
+#  Copyright 2025 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+"""
+Candidate generation for entity resolution.
+
+Instead of testing every pair of same-typed entities, names are put in buckets by
+blocking keys and only names sharing a bucket are tested with `is_similarity`:
+
+- Every key embeds the digit bigrams of the name. Names whose digit bigrams differ
+  never pass the digit rule of `is_similarity`, so they never share a bucket.
+- Character set rule (any name that is not English): names of 3 or fewer distinct
+  characters are keyed by each pair of their characters; longer ones by the prefix
+  of their characters, rarest first, that any set sharing 80% of them must hit.
+  Both are exact: no pair passing the rule is missed.
+- Edit distance rule (English names): the normalized name with up to one character
+  deleted, which catches every edit distance of 1, plus MinHash LSH bands over
+  character trigrams for more distant spellings.
+
+Buckets grown beyond ENTITY_BLOCK_MAX_BUCKET names are skipped, as their key says
+little about the names in them.
+"""
+
+import logging
+import os
+import re
+from collections import Counter, defaultdict
+from itertools import combinations
+
+import editdistance
+import numpy as np
+import xxhash
+
+from rag.nlp import is_english
+
+ENTITY_BLOCK_MAX_BUCKET = int(os.environ.get("ENTITY_BLOCK_MAX_BUCKET", "2000"))
+# Names longer than this are only blocked by MinHash, their deletion neighbourhood is too large.
+DELETION_MAX_LEN = 48
+MINHASH_BANDS = 8
+MINHASH_ROWS = 3
+SIMILARITY_RATIO = 0.8
+
+_MERSENNE_PRIME = (1 << 61) - 1
+_rng = np.random.RandomState(1)
+_PERM_A = _rng.randint(1, 1 << 31, MINHASH_BANDS * MINHASH_ROWS).astype(np.uint64)
+_PERM_B = _rng.randint(0, 1 << 31, MINHASH_BANDS * MINHASH_ROWS).astype(np.uint64)
+
+
+def _2gram_set(s):
+    return {s[i:i + 2] for i in range(len(s) - 1)}
+
+
+def has_digit_in_2gram_diff(a, b):
+    diff = _2gram_set(a) ^ _2gram_set(b)
+    return any(any(c.isdigit() for c in pair) for pair in diff)
+
+
+def is_similarity(a, b):
+    if has_digit_in_2gram_diff(a, b):
+        return False
+    return _similar_spelling(a, b, is_english(a), is_english(b))
+
+
+def _similar_spelling(a, b, english_a, english_b):
+    if english_a and english_b:
+        if editdistance.eval(a, b) <= min(len(a), len(b)) // 2:
+            return True
+        return False
+
+    a, b = set(a), set(b)
+    max_l = max(len(a), len(b))
+    if max_l < 4:
+        return len(a & b) > 1
+
+    return len(a & b) * 1. / max_l >= SIMILARITY_RATIO
+
+
+def _digit_signature(name):
+    return "".join(sorted(g for g in _2gram_set(name) if any(c.isdigit() for c in g)))
+
+
+def _min_overlap(size):
+    """Smallest overlap with a set of `size` characters that `is_similarity` accepts."""
+    return next(o for o in range(1, size + 1) if o * 1. / size >= SIMILARITY_RATIO)
+
+
+def _normalize(name):
+    return re.sub(r"[^a-z0-9]+", " ", name.lower()).strip()
+
+
+def _minhash_bands(text):
+    padded = f"  {text} "
+    grams = {padded[i:i + 3] for i in range(len(padded) - 2)}
+    hashes = np.array([xxhash.xxh32_intdigest(g.encode("utf-8")) for g in grams], dtype=np.uint64)
+    signature = ((np.outer(hashes, _PERM_A) + _PERM_B) % _MERSENNE_PRIME).min(axis=0)
+    return [tuple(signature[i * MINHASH_ROWS:(i + 1) * MINHASH_ROWS].tolist()) for i in range(MINHASH_BANDS)]
+
+
+class BlockingIndex:
+    """Blocking keys of the names of one entity type."""
+
+    def __init__(self, names):
+        self.english = {n: is_english(n) for n in names}
+        # Character set buckets of English names are only looked up from non-English names.
+        self.set_buckets = {True: defaultdict(list), False: defaultdict(list)}
+        self.edit_buckets = defaultdict(list)
+        char_freq = Counter(c for n in names if not self.english[n] for c in set(n))
+        self.char_rank = {c: i for i, (c, _) in enumerate(sorted(char_freq.items(), key=lambda x: (x[1], x[0])))}
+        self.keys = {}
+        for n in names:
+            set_keys, edit_keys = self._keys(n)
+            self.keys[n] = (set_keys, edit_keys)
+            for k in set_keys:
+                self.set_buckets[self.english[n]][k].append(n)
+            for k in edit_keys:
+                self.edit_buckets[k].append(n)
+
+    def _set_keys(self, name, digits):
+        chars = sorted(set(name), key=lambda c: (self.char_rank.get(c, -1), c))
+        if len(chars) < 4:
+            return [(digits, "p", a + b) for a, b in combinations(sorted(chars), 2)]
+        return [(digits, "c", c) for c in chars[:len(chars) - _min_overlap(len(chars)) + 1]]
+
+    def _keys(self, name):
+        digits = _digit_signature(name)
+        set_keys = self._set_keys(name, digits)
+        if not self.english[name]:
+            return set_keys, []
+        norm = _normalize(name) or name
+        edit_keys = [(digits, "b", i, band) for i, band in enumerate(_minhash_bands(norm))]
+        if len(norm) <= DELETION_MAX_LEN:
+            edit_keys.append((digits, "d", norm))
+            edit_keys.extend((digits, "d", norm[:i] + norm[i + 1:]) for i in range(len(norm)))
+        return set_keys, edit_keys
+
+    def _bucket(self, buckets, key):
+        names = buckets.get(key, [])
+        if len(names) > ENTITY_BLOCK_MAX_BUCKET:
+            logging.debug(f"Skip blocking key {key} of {len(names)} entities")
+            return []
+        return names
+
+    def neighbours(self, name):
+        set_keys, edit_keys = self.keys[name]
+        found = set()
+        # English-English pairs are judged by edit distance, all others by character set.
+        for english in ([False] if self.english[name] else [True, False]):
+            for k in set_keys:
+                found.update(self._bucket(self.set_buckets[english], k))
+        for k in edit_keys:
+            found.update(self._bucket(self.edit_buckets, k))
+        found.discard(name)
+        return found
+
+
+def candidate_pairs(names, subgraph_nodes, similar=None):
+    """
+    Sorted pairs (a, b), a < b, of `names` touching `subgraph_nodes` that `similar`
+    (`is_similarity` by default) accepts; the pairs `itertools.combinations` would find,
+    but only looked for among the names sharing a blocking key.
+    """
+    queries = [n for n in names if n in subgraph_nodes]
+    if not queries:
+        return []
+    index = BlockingIndex(names)
+    if similar is None:
+        # Names sharing a key have the same digit bigrams, `is_similarity` without the digit rule is enough.
+        def similar(a, b):
+            return _similar_spelling(a, b, index.english[a], index.english[b])
+    seen, pairs = set(), []
+    for a in queries:
+        for b in index.neighbours(a):
+            pair = (a, b) if a < b else (b, a)
+            if pair in seen:
+                continue
+            seen.add(pair)
+            if similar(*pair):
+                pairs.append(pair)
+    return sorted(pairs)
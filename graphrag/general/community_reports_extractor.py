@@ -7,11 +7,13 @@ Reference:
 
 import logging
 import json
+import os
 import re
 from typing import Callable
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 import networkx as nx
 import pandas as pd
+import xxhash
 
 from api.utils.api_utils import timeout
 from graphrag.general import leiden
@@ -19,17 +21,29 @@ from graphrag.general.community_report_prompt import COMMUNITY_REPORT_PROMPT
 from graphrag.general.extractor import Extractor
 from graphrag.general.leiden import add_community_info2graph
 from rag.llm.chat_model import Base as CompletionLLM
-from graphrag.utils import perform_variable_replacements, dict_has_keys_with_types, chat_limiter
+from graphrag.utils import perform_variable_replacements, dict_has_keys_with_types, chat_limiter, TokenBudget
 from rag.utils import num_tokens_from_string
 import trio
 
 
+COMMUNITY_REPORT_TOKEN_BUDGET = int(os.environ.get("COMMUNITY_REPORT_TOKEN_BUDGET", 65536))
+
+
 @dataclass
 class CommunityReportsResult:
     """Community reports result class definition."""
 
     output: list[str]
     structured_output: list[dict]
+    # Member sets of the previous reports still valid, not regenerated.
+    reused: list[frozenset] = field(default_factory=list)
+    total: int = 0
+    # Nodes whose community attributes changed.
+    changed_nodes: set[str] = field(default_factory=set)
+
+
+def _node_fingerprint(graph: nx.Graph, n: str) -> str:
+    return xxhash.xxh64(f"{graph.nodes[n].get('description', '')}|{graph.nodes[n].get('rank', 0)}".encode("utf-8")).hexdigest()
 
 
 class CommunityReportsExtractor(Extractor):
@@ -50,23 +64,51 @@ class CommunityReportsExtractor(Extractor):
         self._extraction_prompt = COMMUNITY_REPORT_PROMPT
         self._max_report_length = max_report_length or 1500
 
-    async def __call__(self, graph: nx.Graph, callback: Callable | None = None):
+    async def __call__(self, graph: nx.Graph, callback: Callable | None = None, previous_reports: dict[frozenset, str] | None = None):
+        """
+        Detect communities, warm-started from the previous partition kept in the node attributes,
+        and write the report of each community. The report of a community in `previous_reports`
+        (member set -> title) is reused when none of its members changed since it was written.
+        """
+        previous_reports = previous_reports or {}
         for node_degree in graph.degree:
             graph.nodes[str(node_degree[0])]["rank"] = int(node_degree[1])
+        before = {n: (attrs.get("community"), attrs.get("community_fp"), attrs.get("communities")) for n, attrs in graph.nodes(data=True)}
+
+        communities: dict[str, dict[str, list]] = leiden.run(graph, {"starting_communities": leiden.starting_communities(graph)})
+        leiden.set_community_attrs(graph, communities)
+        stale = set()
+        for n in graph.nodes:
+            fp = _node_fingerprint(graph, n)
+            if graph.nodes[n].get("community_fp") != fp:
+                stale.add(n)
+                graph.nodes[n]["community_fp"] = fp
+            graph.nodes[n].pop("communities", None)
+
+        todo, reused = [], []
+        for level, comm in communities.items():
+            logging.info(f"Level {level}: Community: {len(comm.keys())}")
+            for cm_id, cm in comm.items():
+                if len(cm["nodes"]) < 2:
+                    continue
+                members = frozenset(cm["nodes"])
+                if members in previous_reports and not members & stale:
+                    reused.append(members)
+                    add_community_info2graph(graph, cm["nodes"], previous_reports[members])
+                else:
+                    todo.append((cm_id, cm))
+        total = len(todo) + len(reused)
+        if callback:
+            callback(msg=f"Communities: {total}, reusing {len(reused)} reports, regenerating {len(todo)} ({len(todo) / max(1, total):.0%}).")
 
-        communities: dict[str, dict[str, list]] = leiden.run(graph, {})
-        total = sum([len(comm.items()) for _, comm in communities.items()])
         res_str = []
         res_dict = []
         over, token_count = 0, 0
-        @timeout(120)
-        async def extract_community_report(community):
-            nonlocal res_str, res_dict, over, token_count
+        budget = TokenBudget(COMMUNITY_REPORT_TOKEN_BUDGET)
+
+        def community_prompt(community):
             cm_id, cm = community
-            weight = cm["weight"]
             ents = cm["nodes"]
-            if len(ents) < 2:
-                return
             ent_list = [{"entity": ent, "description": graph.nodes[ent]["description"]} for ent in ents]
             ent_df = pd.DataFrame(ent_list)
 
@@ -89,17 +131,35 @@ class CommunityReportsExtractor(Extractor):
                 "entity_df": ent_df.to_csv(index_label="id"),
                 "relation_df": rela_df.to_csv(index_label="id")
             }
-            text = perform_variable_replacements(self._extraction_prompt, variables=prompt_variables)
-            async with chat_limiter:
-                try:
-                    with trio.move_on_after(80) as cancel_scope:
-                        response = await trio.to_thread.run_sync( self._chat, text, [{"role": "user", "content": "Output:"}], {})
-                    if cancel_scope.cancelled_caught:
-                        logging.warning("extract_community_report._chat timeout, skipping...")
-                        return
-                except Exception as e:
-                    logging.error(f"extract_community_report._chat failed: {e}")
-                    return
+            return perform_variable_replacements(self._extraction_prompt, variables=prompt_variables)
+
+        @timeout(120)
+        async def report_chat(text):
+            try:
+                with trio.move_on_after(80) as cancel_scope:
+                    response = await self._async_chat(text, [{"role": "user", "content": "Output:"}], {})
+                if cancel_scope.cancelled_caught:
+                    logging.warning("extract_community_report._chat timeout, skipping...")
+                    return None
+            except Exception as e:
+                logging.error(f"extract_community_report._chat failed: {e}")
+                return None
+            return response
+
+        async def extract_community_report(community, text, tokens):
+            nonlocal res_str, res_dict, over, token_count
+            cm_id, cm = community
+            weight = cm["weight"]
+            ents = cm["nodes"]
+            # Only the chat is timed, not the wait for the token budget and a chat slot.
+            await budget.acquire(tokens)
+            try:
+                async with chat_limiter:
+                    response = await report_chat(text)
+            finally:
+                budget.release(tokens)
+            if response is None:
+                return
             token_count += num_tokens_from_string(text + response)
             response = re.sub(r"^[^\{]*", "", response)
             response = re.sub(r"[^\}]*$", "", response)
@@ -127,20 +187,27 @@ class CommunityReportsExtractor(Extractor):
             res_dict.append(response)
             over += 1
             if callback:
-                callback(msg=f"Communities: {over}/{total}, used tokens: {token_count}")
+                callback(msg=f"Communities: {over}/{len(todo)}, used tokens: {token_count}")
 
+        prompts = [(community, community_prompt(community)) for community in todo]
+        prompts = [(community, text, num_tokens_from_string(text)) for community, text in prompts]
+        # Largest prompts first, so that the long calls do not end up running last and alone.
+        prompts.sort(key=lambda x: x[2], reverse=True)
         st = trio.current_time()
         async with trio.open_nursery() as nursery:
-            for level, comm in communities.items():
-                logging.info(f"Level {level}: Community: {len(comm.keys())}")
-                for community in comm.items():
-                    nursery.start_soon(extract_community_report, community)
+            for community, text, tokens in prompts:
+                nursery.start_soon(extract_community_report, community, text, tokens)
         if callback:
             callback(msg=f"Community reports done in {trio.current_time() - st:.2f}s, used tokens: {token_count}")
 
+        changed_nodes = {n for n, attrs in graph.nodes(data=True)
+                         if before.get(n) != (attrs.get("community"), attrs.get("community_fp"), attrs.get("communities"))}
         return CommunityReportsResult(
             structured_output=res_dict,
             output=res_str,
+            reused=reused,
+            total=total,
+            changed_nodes=changed_nodes,
         )
 
     def _get_text_output(self, parsed_output: dict) -> str:
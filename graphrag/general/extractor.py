@@ -13,25 +13,59 @@
 #  See the License for the specific language governing permissions and
 #  limitations under the License.
 #
+import json
 import logging
+import os
 import re
 from collections import defaultdict, Counter
 from copy import deepcopy
 from typing import Callable
 import trio
 import networkx as nx
+import xxhash
 
 from api.utils.api_utils import timeout
 from graphrag.general.graph_prompt import SUMMARIZE_DESCRIPTIONS_PROMPT
-from graphrag.utils import get_llm_cache, set_llm_cache, handle_single_entity_extraction, \
-    handle_single_relationship_extraction, split_string_by_multi_markers, flat_uniq_list, chat_limiter, get_from_to, GraphChange
+from graphrag.utils import handle_single_entity_extraction, \
+    handle_single_relationship_extraction, split_string_by_multi_markers, flat_uniq_list, chat_limiter, get_from_to, GraphChange, \
+    get_llm_cache, set_llm_cache
 from rag.llm.chat_model import Base as CompletionLLM
 from rag.prompts import message_fit_in
-from rag.utils import truncate
+from rag.utils import num_tokens_from_string, truncate
 
 GRAPH_FIELD_SEP = "<SEP>"
 DEFAULT_ENTITY_TYPES = ["organization", "person", "geo", "event", "category"]
 ENTITY_EXTRACTION_MAX_GLEANINGS = 2
+# Consecutive chunks are extracted together in one prompt up to this many tokens; 0 extracts them one by one.
+GRAPH_EXTRACTION_PACK_TOKENS = int(os.environ.get("GRAPH_EXTRACTION_PACK_TOKENS", 1024))
+# Gleaning stops once a round adds less than this share of the records already extracted, on average.
+GLEANING_MIN_YIELD = 0.1
+# Once stopped, one content in this many still gleans, to keep measuring the yield.
+GLEANING_PROBE_EVERY = 8
+
+# Description summaries being generated, so that identical ones requested meanwhile wait for them.
+_summaries_in_flight = {}
+
+
+class GleaningBudget:
+    """Gleaning rounds adapted to the records they add over the contents of one extraction."""
+
+    def __init__(self, max_gleanings: int):
+        self.max_gleanings = max_gleanings
+        self.mean_yield = None
+        self.skipped = 0
+
+    def should_glean(self, round_idx: int) -> bool:
+        if round_idx >= self.max_gleanings:
+            return False
+        if self.mean_yield is None or self.mean_yield >= GLEANING_MIN_YIELD:
+            return True
+        self.skipped += 1
+        return self.skipped % GLEANING_PROBE_EVERY == 0
+
+    def observe(self, records_before: int, records_added: int):
+        y = records_added / max(1, records_before)
+        self.mean_yield = y if self.mean_yield is None else 0.8 * self.mean_yield + 0.2 * y
 
 
 class Extractor:
@@ -46,28 +80,99 @@ class Extractor:
         self._llm = llm_invoker
         self._language = language
         self._entity_types = entity_types or DEFAULT_ENTITY_TYPES
+        self._max_gleanings = ENTITY_EXTRACTION_MAX_GLEANINGS
+        self._gleaning = GleaningBudget(self._max_gleanings)
+        # Set by the graph extractors, to parse their records.
+        self._tuple_delimiter = None
+        self._record_delimiters = []
 
     @timeout(60*5)
     def _chat(self, system, history, gen_conf={}):
         hist = deepcopy(history)
         conf = deepcopy(gen_conf)
-        response = get_llm_cache(self._llm.llm_name, system, hist, conf)
-        if response:
-            return response
         _, system_msg = message_fit_in([{"role": "system", "content": system}], int(self._llm.max_length * 0.92))
         for attempt in range(3):
             try:
-                response = self._llm.chat(system_msg[0]["content"], hist, conf)
+                response = self._llm.chat(system_msg[0]["content"], deepcopy(hist), conf, cache="graph")
                 response = re.sub(r"^.*</think>", "", response, flags=re.DOTALL)
                 if response.find("**ERROR**") >= 0:
                     raise Exception(response)
-                set_llm_cache(self._llm.llm_name, system, response, history, gen_conf)
+                return response
             except Exception as e:
                 logging.exception(e)
                 if attempt == 2:
                     raise
 
-        return response
+    async def _async_chat(self, system, history, gen_conf={}):
+        """
+        `_chat` awaiting the LLM on the event loop rather than holding a worker thread per call,
+        bounded to the same 5 minutes.
+        """
+        hist = deepcopy(history)
+        conf = deepcopy(gen_conf)
+        _, system_msg = message_fit_in([{"role": "system", "content": system}], int(self._llm.max_length * 0.92))
+        with trio.fail_after(60*5):
+            for attempt in range(3):
+                try:
+                    response = await self._llm.async_chat(system_msg[0]["content"], deepcopy(hist), conf, cache="graph")
+                    response = re.sub(r"^.*</think>", "", response, flags=re.DOTALL)
+                    if response.find("**ERROR**") >= 0:
+                        raise Exception(response)
+                    return response
+                except Exception as e:
+                    logging.exception(e)
+                    if attempt == 2:
+                        raise
+
+    def _parse_records(self, text: str) -> list[str]:
+        records = []
+        for record in split_string_by_multi_markers(text, self._record_delimiters):
+            record = re.search(r"\((.*)\)", record)
+            if record is None:
+                continue
+            records.append(record.group(1))
+        return records
+
+    def _pack_chunks(self, chunks: list[str]) -> list[str]:
+        """Consecutive chunks joined up to GRAPH_EXTRACTION_PACK_TOKENS, so small chunks share one extraction."""
+        max_tokens = int(self._llm.max_length * 0.8)
+        packs, pack, pack_tokens = [], [], 0
+        for ck in chunks:
+            ck = truncate(ck, max_tokens)
+            tokens = num_tokens_from_string(ck)
+            if pack and pack_tokens + tokens > min(GRAPH_EXTRACTION_PACK_TOKENS, max_tokens):
+                packs.append("\n\n".join(pack))
+                pack, pack_tokens = [], 0
+            pack.append(ck)
+            pack_tokens += tokens
+        if pack:
+            packs.append("\n\n".join(pack))
+        return packs
+
+    def _extraction_cache_args(self, content: str):
+        # The records of a content, in the "graph" LLM cache, by everything the extraction depends on.
+        return (self._llm.llm_name, content,
+                ["graph_extraction", type(self).__module__, type(self).__name__, sorted(self._entity_types), self._language],
+                {"max_gleanings": self._max_gleanings})
+
+    async def _process_single_content(self, chunk_key_dp: tuple[str, str], chunk_seq: int, num_chunks: int, out_results):
+        """
+        Extract the entities and relations of a content, reusing its records extracted before if any.
+        The graph extractors implement `_extract_records(content)`, returning the records and the tokens used.
+        """
+        chunk_key, content = chunk_key_dp
+        llmnm, txt, history, genconf = self._extraction_cache_args(content)
+        tenant_id = getattr(self._llm, "tenant_id", None)
+        cached = await trio.to_thread.run_sync(lambda: get_llm_cache(llmnm, txt, history, genconf, "graph", tenant_id))
+        if cached:
+            records, token_count = json.loads(cached), 0
+        else:
+            records, token_count = await self._extract_records(content)
+            await trio.to_thread.run_sync(lambda: set_llm_cache(llmnm, txt, json.dumps(records, ensure_ascii=False), history, genconf, "graph", tenant_id))
+        maybe_nodes, maybe_edges = self._entities_and_relations(chunk_key, records, self._tuple_delimiter)
+        out_results.append((maybe_nodes, maybe_edges, token_count))
+        if self.callback:
+            self.callback(0.5+0.1*len(out_results)/num_chunks, msg = f"Entities extraction of chunk {chunk_seq} {len(out_results)}/{num_chunks} done{' (cached)' if cached else ''}, {len(maybe_nodes)} nodes, {len(maybe_edges)} edges, {token_count} tokens.")
 
     def _entities_and_relations(self, chunk_key: str, records: list, tuple_delimiter: str):
         maybe_nodes = defaultdict(list)
@@ -102,10 +207,13 @@ class Extractor:
         self.callback = callback
         start_ts = trio.current_time()
         out_results = []
+        self._gleaning = GleaningBudget(self._max_gleanings)
+        packs = self._pack_chunks(chunks)
+        if callback and len(packs) < len(chunks):
+            callback(msg=f"Extracting {len(chunks)} chunks in {len(packs)} prompts.")
         async with trio.open_nursery() as nursery:
-            for i, ck in enumerate(chunks):
-                ck = truncate(ck, int(self._llm.max_length*0.8))
-                nursery.start_soon(self._process_single_content, (doc_id, ck), i, len(chunks), out_results)
+            for i, ck in enumerate(packs):
+                nursery.start_soon(self._process_single_content, (doc_id, ck), i, len(packs), out_results)
 
         maybe_nodes = defaultdict(list)
         maybe_edges = defaultdict(list)
@@ -248,7 +356,21 @@ class Extractor:
             language=self._language,
         )
         use_prompt = prompt_template.format(**context_base)
-        logging.info(f"Trigger summary: {entity_or_relation_name}")
-        async with chat_limiter:
-            summary = await trio.to_thread.run_sync(lambda: self._chat(use_prompt, [{"role": "user", "content": "Output: "}]))
-        return summary
+        k = xxhash.xxh64(f"{self._llm.llm_name}|{use_prompt}".encode("utf-8")).hexdigest()
+        pending = _summaries_in_flight.get(k)
+        if pending:
+            await pending["done"].wait()
+            if "summary" in pending:
+                return pending["summary"]
+        pending = {"done": trio.Event()}
+        _summaries_in_flight[k] = pending
+        try:
+            logging.info(f"Trigger summary: {entity_or_relation_name}")
+            async with chat_limiter:
+                summary = await self._async_chat(use_prompt, [{"role": "user", "content": "Output: "}])
+            pending["summary"] = summary
+            return summary
+        finally:
+            pending["done"].set()
+            if _summaries_in_flight.get(k) is pending:
+                del _summaries_in_flight[k]
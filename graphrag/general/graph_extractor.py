@@ -5,15 +5,13 @@ Reference:
  - [graphrag](https://github.com/microsoft/graphrag)
 """
 
-import re
 from typing import Any
 from dataclasses import dataclass
 import tiktoken
-import trio
 
 from graphrag.general.extractor import Extractor, ENTITY_EXTRACTION_MAX_GLEANINGS
 from graphrag.general.graph_prompt import GRAPH_EXTRACTION_PROMPT, CONTINUE_PROMPT, LOOP_PROMPT
-from graphrag.utils import ErrorHandlerFn, perform_variable_replacements, chat_limiter, split_string_by_multi_markers
+from graphrag.utils import ErrorHandlerFn, perform_variable_replacements, chat_limiter
 from rag.llm.chat_model import Base as CompletionLLM
 import networkx as nx
 from rag.utils import num_tokens_from_string
@@ -96,29 +94,32 @@ class GraphExtractor(Extractor):
             self._completion_delimiter_key: DEFAULT_COMPLETION_DELIMITER,
             self._entity_types_key: ",".join(entity_types),
         }
+        self._tuple_delimiter = self._prompt_variables[self._tuple_delimiter_key]
+        self._record_delimiters = [self._prompt_variables[self._record_delimiter_key], self._prompt_variables[self._completion_delimiter_key]]
 
-    async def _process_single_content(self, chunk_key_dp: tuple[str, str], chunk_seq: int, num_chunks: int, out_results):
+    async def _extract_records(self, content: str) -> tuple[list[str], int]:
         token_count = 0
-        chunk_key = chunk_key_dp[0]
-        content = chunk_key_dp[1]
         variables = {
             **self._prompt_variables,
             self._input_text_key: content,
         }
         hint_prompt = perform_variable_replacements(self._extraction_prompt, variables=variables)
         async with chat_limiter:
-            response = await trio.to_thread.run_sync(lambda: self._chat(hint_prompt, [{"role": "user", "content": "Output:"}], {}))
+            response = await self._async_chat(hint_prompt, [{"role": "user", "content": "Output:"}], {})
         token_count += num_tokens_from_string(hint_prompt + response)
 
         results = response or ""
         history = [{"role": "system", "content": hint_prompt}, {"role": "user", "content": response}]
 
-        # Repeat to ensure we maximize entity count
+        # Repeat to ensure we maximize entity count, as long as the rounds keep adding records
         for i in range(self._max_gleanings):
+            if not self._gleaning.should_glean(i):
+                break
             history.append({"role": "user", "content": CONTINUE_PROMPT})
             async with chat_limiter:
-                response = await trio.to_thread.run_sync(lambda: self._chat("", history, {}))
+                response = await self._async_chat("", history, {})
             token_count += num_tokens_from_string("\n".join([m["content"] for m in history]) + response)
+            self._gleaning.observe(len(self._parse_records(results)), len(self._parse_records(response or "")))
             results += response or ""
 
             # if this is the final glean, don't bother updating the continuation flag
@@ -127,24 +128,10 @@ class GraphExtractor(Extractor):
             history.append({"role": "assistant", "content": response})
             history.append({"role": "user", "content": LOOP_PROMPT})
             async with chat_limiter:
-                continuation = await trio.to_thread.run_sync(lambda: self._chat("", history))
+                continuation = await self._async_chat("", history)
             token_count += num_tokens_from_string("\n".join([m["content"] for m in history]) + response)
             if continuation != "Y":
                 break
             history.append({"role": "assistant", "content": "Y"})
 
-        records = split_string_by_multi_markers(
-            results,
-            [self._prompt_variables[self._record_delimiter_key], self._prompt_variables[self._completion_delimiter_key]],
-        )
-        rcds = []
-        for record in records:
-            record = re.search(r"\((.*)\)", record)
-            if record is None:
-                continue
-            rcds.append(record.group(1))
-        records = rcds
-        maybe_nodes, maybe_edges = self._entities_and_relations(chunk_key, records, self._prompt_variables[self._tuple_delimiter_key])
-        out_results.append((maybe_nodes, maybe_edges, token_count))
-        if self.callback:
-            self.callback(0.5+0.1*len(out_results)/num_chunks, msg = f"Entities extraction of chunk {chunk_seq} {len(out_results)}/{num_chunks} done, {len(maybe_nodes)} nodes, {len(maybe_edges)} edges, {token_count} tokens.")
+        return self._parse_records(results), token_count
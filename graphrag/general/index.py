@@ -30,12 +30,15 @@ from graphrag.utils import (
     graph_merge,
     get_graph,
     set_graph,
+    graph_change_to_chunks,
+    commit_graph,
     chunk_id,
     does_graph_contains,
     tidy_graph,
     GraphChange,
 )
 from rag.nlp import rag_tokenizer, search
+from rag.utils.doc_store_conn import OrderByExpr
 from rag.utils.redis_conn import RedisDistributedLock
 
 
@@ -75,8 +78,6 @@ async def run_graphrag(
         return
 
     graphrag_task_lock = RedisDistributedLock(f"graphrag_task_{kb_id}", lock_value=doc_id, timeout=1200)
-    await graphrag_task_lock.spin_acquire()
-    callback(msg=f"run_graphrag {doc_id} graphrag_task_lock acquired")
 
     try:
         subgraph_nodes = set(subgraph.nodes())
@@ -87,6 +88,7 @@ async def run_graphrag(
             subgraph,
             embedding_model,
             callback,
+            graphrag_task_lock,
         )
         assert new_graph is not None
 
@@ -198,31 +200,67 @@ async def generate_subgraph(
     return subgraph
 
 
+MERGE_SUBGRAPH_ATTEMPTS = 3
+
+
 @timeout(60*3)
-async def merge_subgraph(
-    tenant_id: str,
-    kb_id: str,
-    doc_id: str,
-    subgraph: nx.Graph,
-    embedding_model,
-    callback,
-):
-    start = trio.current_time()
+async def _merge_with_graph(tenant_id: str, kb_id: str, subgraph: nx.Graph, embedding_model, callback):
+    """The global graph with the subgraph merged in, its change and the chunks of the change."""
     change = GraphChange()
     old_graph = await get_graph(tenant_id, kb_id, subgraph.graph["source_id"])
     if old_graph is not None:
         logging.info("Merge with an exiting graph...................")
         tidy_graph(old_graph, callback)
-        new_graph = graph_merge(old_graph, subgraph, change)
+        new_graph = graph_merge(old_graph, subgraph.copy(), change)
     else:
-        new_graph = subgraph
+        new_graph = subgraph.copy()
         change.added_updated_nodes = set(new_graph.nodes())
         change.added_updated_edges = set(new_graph.edges())
     pr = nx.pagerank(new_graph)
     for node_name, pagerank in pr.items():
         new_graph.nodes[node_name]["pagerank"] = pagerank
 
-    await set_graph(tenant_id, kb_id, embedding_model, new_graph, change, callback)
+    chunks = await graph_change_to_chunks(kb_id, embedding_model, new_graph, change, callback)
+    return new_graph, change, chunks
+
+
+@timeout(60*3, 1)
+async def _commit_merge(tenant_id: str, kb_id: str, new_graph: nx.Graph, change: GraphChange, chunks, callback):
+    return await commit_graph(tenant_id, kb_id, new_graph, change, chunks, callback)
+
+
+async def merge_subgraph(
+    tenant_id: str,
+    kb_id: str,
+    doc_id: str,
+    subgraph: nx.Graph,
+    embedding_model,
+    callback,
+    graphrag_task_lock: RedisDistributedLock,
+):
+    """
+    Merge a document subgraph into the global graph. The merge and the embedding of its
+    change run without the lock; the lock is only held to commit, which fails if another
+    task committed in the meantime, in which case the merge is redone on the newer graph.
+    The last attempt merges under the lock. Returns with the lock held.
+    Waiting for the lock is not bounded by the timeouts of the merge and the commit.
+    """
+    start = trio.current_time()
+    for attempt in range(MERGE_SUBGRAPH_ATTEMPTS):
+        last_attempt = attempt == MERGE_SUBGRAPH_ATTEMPTS - 1
+        if last_attempt:
+            await graphrag_task_lock.spin_acquire()
+            callback(msg=f"run_graphrag {doc_id} graphrag_task_lock acquired")
+        new_graph, change, chunks = await _merge_with_graph(tenant_id, kb_id, subgraph, embedding_model, callback)
+        if not last_attempt:
+            await graphrag_task_lock.spin_acquire()
+            callback(msg=f"run_graphrag {doc_id} graphrag_task_lock acquired")
+        if await _commit_merge(tenant_id, kb_id, new_graph, change, chunks, callback):
+            break
+        if last_attempt:
+            raise Exception(f"The knowledge graph of {kb_id} was changed concurrently, please retry.")
+        graphrag_task_lock.release()
+        callback(msg=f"The knowledge graph of {kb_id} was changed by another task, merging {doc_id} again.")
     now = trio.current_time()
     callback(
         msg=f"merging subgraph for doc {doc_id} into the global graph done in {now - start:.2f} seconds."
@@ -267,17 +305,19 @@ async def extract_community(
     callback,
 ):
     start = trio.current_time()
+    previous_ids = await get_community_reports(tenant_id, kb_id)
     ext = CommunityReportsExtractor(
         llm_bdl,
     )
-    cr = await ext(graph, callback=callback)
+    cr = await ext(graph, callback=callback, previous_reports={members: title for members, (title, _) in previous_ids.items()})
     community_structure = cr.structured_output
     community_reports = cr.output
     doc_ids = graph.graph["source_id"]
 
     now = trio.current_time()
     callback(
-        msg=f"Graph extracted {len(cr.structured_output)} communities in {now - start:.2f}s."
+        msg=f"Graph extracted {cr.total} communities, regenerated {len(cr.structured_output)} reports "
+            f"({len(cr.structured_output) / max(1, cr.total):.0%}) in {now - start:.2f}s."
     )
     start = now
     chunks = []
@@ -307,13 +347,6 @@ async def extract_community(
         )
         chunks.append(chunk)
 
-    await trio.to_thread.run_sync(
-        lambda: settings.docStoreConn.delete(
-            {"knowledge_graph_kwd": "community_report", "kb_id": kb_id},
-            search.index_name(tenant_id),
-            kb_id,
-        )
-    )
     es_bulk_size = 4
     for b in range(0, len(chunks), es_bulk_size):
         doc_store_result = await trio.to_thread.run_sync(lambda: settings.docStoreConn.insert(chunks[b:b + es_bulk_size], search.index_name(tenant_id), kb_id))
@@ -321,8 +354,48 @@ async def extract_community(
             error_message = f"Insert chunk error: {doc_store_result}, please check log file and Elasticsearch/Infinity status!"
             raise Exception(error_message)
 
+    # Reports of communities that changed, or that are gone, are replaced.
+    for members in cr.reused:
+        if previous_ids[members][1]:
+            previous_ids[members][1].pop()
+    stale_ids = sorted(id for _, ids in previous_ids.values() for id in ids)
+    if stale_ids:
+        await trio.to_thread.run_sync(
+            lambda: settings.docStoreConn.delete({"id": stale_ids}, search.index_name(tenant_id), kb_id)
+        )
+
+    # Keep the partition in the node attributes, to warm-start the next detection.
+    if cr.changed_nodes:
+        change = GraphChange(added_updated_nodes=cr.changed_nodes)
+        if not await commit_graph(tenant_id, kb_id, graph, change, [], callback, subgraphs=False):
+            raise Exception(f"The knowledge graph of {kb_id} was changed concurrently, please retry.")
+
     now = trio.current_time()
     callback(
-        msg=f"Graph indexed {len(cr.structured_output)} communities in {now - start:.2f}s."
+        msg=f"Graph indexed {len(cr.structured_output)} communities, kept {len(cr.reused)} reports, removed {len(stale_ids)} in {now - start:.2f}s."
     )
     return community_structure, community_reports
+
+
+async def get_community_reports(tenant_id: str, kb_id: str) -> dict[frozenset, tuple[str, list[str]]]:
+    """Member set -> (title, chunk ids) of the community reports of a knowledge base."""
+    flds = ["entities_kwd", "docnm_kwd"]
+    reports = {}
+    bs = 1024
+    for i in range(0, 1024*bs, bs):
+        es_res = await trio.to_thread.run_sync(lambda: settings.docStoreConn.search(flds, [],
+                                 {"kb_id": kb_id, "knowledge_graph_kwd": ["community_report"]},
+                                 [],
+                                 OrderByExpr(),
+                                 i, bs, search.index_name(tenant_id), [kb_id]
+                                 ))
+        es_res = settings.docStoreConn.getFields(es_res, flds)
+        if len(es_res) == 0:
+            break
+        for id, d in es_res.items():
+            entities = d.get("entities_kwd") or []
+            if isinstance(entities, str):
+                entities = [entities]
+            title, ids = reports.setdefault(frozenset(entities), (d.get("docnm_kwd", ""), []))
+            ids.append(id)
+    return reports
@@ -74,6 +74,7 @@ def _compute_leiden_communities(
         max_cluster_size: int,
         use_lcc: bool,
         seed=0xDEADBEEF,
+        starting_communities: dict[str, int] | None = None,
 ) -> dict[int, dict[str, int]]:
     """Return Leiden root communities."""
     results: dict[int, dict[str, int]] = {}
@@ -81,9 +82,14 @@ def _compute_leiden_communities(
         return results
     if use_lcc:
         graph = stable_largest_connected_component(graph)
+        if starting_communities:
+            starting_communities = {html.unescape(n.upper().strip()): c for n, c in starting_communities.items()}
+    if starting_communities:
+        starting_communities = {n: c for n, c in starting_communities.items() if graph.has_node(n)}
 
     community_mapping = hierarchical_leiden(
-        graph, max_cluster_size=max_cluster_size, random_seed=seed
+        graph, max_cluster_size=max_cluster_size, random_seed=seed,
+        starting_communities=starting_communities or None,
     )
     for partition in community_mapping:
         results[partition.level] = results.get(partition.level, {})
@@ -109,6 +115,7 @@ def run(graph: nx.Graph, args: dict[str, Any]) -> dict[int, dict[str, dict]]:
         max_cluster_size=max_cluster_size,
         use_lcc=use_lcc,
         seed=args.get("seed", 0xDEADBEEF),
+        starting_communities=args.get("starting_communities"),
     )
     levels = args.get("levels")
 
@@ -141,6 +148,26 @@ def run(graph: nx.Graph, args: dict[str, Any]) -> dict[int, dict[str, dict]]:
     return results_by_level
 
 
+def starting_communities(graph: nx.Graph) -> dict[str, int]:
+    """The root communities of the previous run, kept in the `community` node attribute, to warm-start Leiden."""
+    return {n: int(attrs["community"]["0"]) for n, attrs in graph.nodes(data=True) if "0" in attrs.get("community", {})}
+
+
+def set_community_attrs(graph: nx.Graph, communities: dict[int, dict[str, dict]]) -> set[str]:
+    """Keep the community of each node per level in its `community` attribute; returns the nodes whose communities changed."""
+    assignment = {n: {} for n in graph.nodes}
+    for level, comms in communities.items():
+        for cm_id, cm in comms.items():
+            for n in cm["nodes"]:
+                assignment[n][str(level)] = cm_id
+    changed = set()
+    for n, community in assignment.items():
+        if graph.nodes[n].get("community", {}) != community:
+            graph.nodes[n]["community"] = community
+            changed.add(n)
+    return changed
+
+
 def add_community_info2graph(graph: nx.Graph, nodes: list[str], community_title):
     for n in nodes:
         if "communities" not in graph.nodes[n]:
@@ -0,0 +1,189 @@
+#
+#  Copyright 2025 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+"""
+Process-local cache of knowledge base graphs for retrieval.
+
+A graph is kept as compressed sparse rows: the neighbours of node `i` are
+`indices[indptr[i]:indptr[i + 1]]`, heaviest edge first, so neighbourhood queries
+are array slices instead of document store searches.
+
+Every write of a graph bumps a version counter in Redis (`bump_version`); a cached
+graph is used as long as the counter still reads what it read when the graph was
+loaded, and for at most GRAPH_CACHE_TTL seconds in case a bump was lost.
+"""
+
+import logging
+import os
+import threading
+import time
+from collections import defaultdict, deque
+
+import numpy as np
+
+from rag.utils.redis_conn import REDIS_CONN
+
+GRAPH_CACHE_SIZE = int(os.environ.get("GRAPH_CACHE_SIZE", "8"))
+GRAPH_CACHE_TTL = int(os.environ.get("GRAPH_CACHE_TTL", "600"))
+# Bounds the work of one personalized PageRank, in pushes.
+PPR_MAX_PUSHES = 20000
+
+_cache = {}
+_cache_lock = threading.Lock()
+_load_locks = defaultdict(threading.Lock)
+
+
+class CSRGraph:
+    """Read-only adjacency of an undirected graph, with the node attributes retrieval needs."""
+
+    def __init__(self, graph):
+        self.nodes = list(graph.nodes)
+        self.index = {n: i for i, n in enumerate(self.nodes)}
+        n = len(self.nodes)
+        src, dst, wts = [], [], []
+        for f, t, attrs in graph.edges(data=True):
+            i, j = self.index[f], self.index[t]
+            if i == j:
+                continue
+            w = float(attrs.get("weight", 1) or 1)
+            src += [i, j]
+            dst += [j, i]
+            wts += [w, w]
+        src = np.array(src, dtype=np.int64)
+        dst = np.array(dst, dtype=np.int64)
+        wts = np.array(wts, dtype=np.float64)
+        order = np.lexsort((-wts, src))
+        self.indices = dst[order]
+        self.weights = wts[order]
+        self.indptr = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(np.bincount(src, minlength=n), out=self.indptr[1:])
+        self.degree = np.bincount(src, weights=wts, minlength=n)
+        self.pagerank = np.array([float(graph.nodes[x].get("pagerank", 0)) for x in self.nodes], dtype=np.float64)
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def neighbours(self, i):
+        s, e = self.indptr[i], self.indptr[i + 1]
+        return self.indices[s:e], self.weights[s:e]
+
+    def personalized_pagerank(self, seeds: dict[str, float], teleport=0.15, eps=1e-4) -> dict[int, float]:
+        """
+        PageRank personalized on the seed nodes (name -> weight), approximated by pushing
+        residual mass from the seeds outwards (Andersen, Chung, Lang), so the cost depends
+        on `eps` and the neighbourhood of the seeds, not on the size of the graph.
+        """
+        seeds = {self.index[n]: w for n, w in seeds.items() if n in self.index and w > 0}
+        total = sum(seeds.values())
+        if not total:
+            return {}
+        p = defaultdict(float)
+        r = defaultdict(float, {i: w / total for i, w in seeds.items()})
+        queue = deque(r.keys())
+        pushes = 0
+        while queue and pushes < PPR_MAX_PUSHES:
+            u = queue.popleft()
+            ru = r[u]
+            deg = self.degree[u]
+            if ru < eps * deg:
+                continue
+            pushes += 1
+            r[u] = 0.
+            if not deg:
+                p[u] += ru
+                continue
+            p[u] += teleport * ru
+            nbrs, wts = self.neighbours(u)
+            share = (1 - teleport) * ru / deg
+            for v, w in zip(nbrs.tolist(), wts.tolist()):
+                before = r[v]
+                r[v] = before + share * w
+                if before < eps * self.degree[v] <= r[v]:
+                    queue.append(v)
+        return dict(p)
+
+    def expand(self, seeds: dict[str, float], hops=2, fanout=4) -> dict[str, list[dict]]:
+        """
+        Paths of up to `hops` edges from each seed node, in the `n_hop_ents` format
+        ({"path": [names], "weights": [edge weights]}). At each step a path is extended
+        to its `fanout` neighbours scoring the highest personalized PageRank times edge
+        weight, so the paths head to the part of the graph most related to all the seeds.
+        """
+        ppr = self.personalized_pagerank(seeds)
+        res = {}
+        for name in seeds:
+            if name not in self.index:
+                continue
+            paths = []
+            frontier = [([self.index[name]], [])]
+            for hop in range(hops):
+                extended = []
+                for path, wts in frontier:
+                    nbrs, nbr_wts = self.neighbours(path[-1])
+                    scored = sorted(((ppr.get(v, 0.) * w, v, w) for v, w in zip(nbrs.tolist(), nbr_wts.tolist()) if v not in path),
+                                    reverse=True)[:fanout]
+                    if not scored and hop:
+                        paths.append((path, wts))
+                    extended.extend((path + [v], wts + [w]) for _, v, w in scored)
+                frontier = extended
+            paths.extend(frontier)
+            res[name] = [{"path": [self.nodes[i] for i in path], "weights": wts} for path, wts in paths]
+        return res
+
+
+def _version_key(kb_id):
+    return f"graph_version:{kb_id}"
+
+
+def bump_version(kb_id):
+    """Invalidate the cached graphs of a knowledge base in every process; call after writing its graph."""
+    REDIS_CONN.incr(_version_key(kb_id))
+
+
+def _fresh(kb_id, version):
+    with _cache_lock:
+        hit = _cache.pop(kb_id, None)
+        if hit and hit[0] == version and time.time() - hit[1] < GRAPH_CACHE_TTL:
+            _cache[kb_id] = hit
+            return hit
+    return None
+
+
+def get(kb_id, loader) -> CSRGraph | None:
+    """
+    The cached graph of a knowledge base, loaded with `loader()` (an nx.Graph, or None
+    when the knowledge base has no graph) if missing or stale. `loader` raises when the
+    graph can't be loaded, which is not cached: the next call tries again.
+    """
+    version = REDIS_CONN.get(_version_key(kb_id))
+    hit = _fresh(kb_id, version)
+    if hit:
+        return hit[2]
+
+    with _load_locks[kb_id]:
+        hit = _fresh(kb_id, version)
+        if hit:
+            return hit[2]
+        st = time.time()
+        graph = loader()
+        csr = CSRGraph(graph) if graph is not None and len(graph) else None
+        if csr is not None:
+            logging.info(f"graph_cache loaded {kb_id}: {len(csr)} nodes, {len(csr.indices) // 2} edges in {time.time() - st:.2f}s")
+        with _cache_lock:
+            _cache.pop(kb_id, None)
+            _cache[kb_id] = (version, time.time(), csr)
+            while len(_cache) > GRAPH_CACHE_SIZE:
+                _cache.pop(next(iter(_cache)))
+        return csr
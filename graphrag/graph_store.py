@@ -0,0 +1,287 @@
+#
+#  Copyright 2025 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+"""
+Delta-encoded storage of a knowledge base's global graph.
+
+The graph lives in STORAGE_IMPL, in the knowledge base bucket, as one base segment
+(the whole graph) followed by delta segments (the nodes and edges of a GraphChange).
+The manifest listing them is kept in the `graph` chunk of the doc store, next to a
+preview of the most important nodes, which is all the knowledge graph APIs display.
+A merge therefore writes its delta and a small `graph` chunk instead of the whole
+graph; deltas are compacted into a new base once there are too many of them.
+
+The last graph committed or loaded by a process is kept in memory, so consecutive
+merges into the same knowledge base only read the manifest.
+
+When a document is removed, the graph is rebuilt from the subgraph chunks of the
+others with a GraphAccumulator, checkpointed in the same bucket.
+"""
+
+import copy
+import json
+import logging
+import os
+import threading
+import time
+import zlib
+
+import networkx as nx
+from networkx.readwrite import json_graph
+
+from api import settings
+from api.utils import get_uuid
+from graphrag import graph_cache
+from rag.nlp import search
+from rag.utils.storage_factory import STORAGE_IMPL
+
+GRAPH_STORE_MAX_DELTAS = int(os.environ.get("GRAPH_STORE_MAX_DELTAS", "32"))
+GRAPH_REBUILD_CHECKPOINT_TTL = int(os.environ.get("GRAPH_REBUILD_CHECKPOINT_TTL", "3600"))
+PREVIEW_NODES = 256
+PREVIEW_EDGES = 128
+
+# Node attributes derived from the whole graph; recomputed on load instead of being written by every delta.
+DERIVED_NODE_ATTRS = ["pagerank", "rank"]
+
+_cache = {}
+_cache_lock = threading.Lock()
+_CACHE_SIZE = 8
+
+
+def _put_segment(kb_id, kind, obj):
+    name = f"graph_store/{kind}-{get_uuid()}"
+    binary = zlib.compress(json.dumps(obj, ensure_ascii=False).encode("utf-8"))
+    STORAGE_IMPL.put(kb_id, name, binary)
+    return name, len(binary)
+
+
+def _get_segment(kb_id, name):
+    binary = STORAGE_IMPL.get(kb_id, name)
+    if not binary:
+        raise IOError(f"Graph segment {kb_id}/{name} is missing")
+    return json.loads(zlib.decompress(binary))
+
+
+def _strip(attrs):
+    return {k: v for k, v in attrs.items() if k not in DERIVED_NODE_ATTRS}
+
+
+def delta_of(graph: nx.Graph, change):
+    nodes = {n: _strip(graph.nodes[n]) for n in change.added_updated_nodes if graph.has_node(n)}
+    edges = [[s, t, graph.get_edge_data(s, t)] for s, t in change.added_updated_edges if graph.has_edge(s, t)]
+    return {
+        "graph": dict(graph.graph),
+        "nodes": nodes,
+        "edges": edges,
+        "removed_nodes": sorted(n for n in change.removed_nodes if not graph.has_node(n)),
+        "removed_edges": [[s, t] for s, t in change.removed_edges if not graph.has_edge(s, t)],
+    }
+
+
+def apply_delta(graph: nx.Graph, delta):
+    for n in delta["removed_nodes"]:
+        if graph.has_node(n):
+            graph.remove_node(n)
+    for s, t in delta["removed_edges"]:
+        if graph.has_edge(s, t):
+            graph.remove_edge(s, t)
+    for n, attrs in delta["nodes"].items():
+        if graph.has_node(n):
+            graph.nodes[n].clear()
+        graph.add_node(n, **attrs)
+    for s, t, attrs in delta["edges"]:
+        if graph.has_edge(s, t):
+            graph.edges[s, t].clear()
+        graph.add_edge(s, t, **attrs)
+    graph.graph.update(delta["graph"])
+
+
+def update_derived_attrs(graph: nx.Graph):
+    for n, degree in graph.degree:
+        graph.nodes[n]["rank"] = int(degree)
+    if graph.number_of_nodes():
+        for n, pagerank in nx.pagerank(graph).items():
+            graph.nodes[n]["pagerank"] = pagerank
+
+
+def preview(graph: nx.Graph, manifest):
+    """node_link data of the top nodes by pagerank and the heaviest edges between them, plus the manifest."""
+    nodes = sorted(graph.nodes, key=lambda n: graph.nodes[n].get("pagerank", 0), reverse=True)[:PREVIEW_NODES]
+    sub = graph.subgraph(nodes)
+    edges = sorted(((s, t) for s, t in sub.edges if s != t), key=lambda e: sub.edges[e].get("weight", 0), reverse=True)[:PREVIEW_EDGES]
+    sub = sub.edge_subgraph(edges).copy()
+    sub.add_nodes_from((n, graph.nodes[n]) for n in nodes)
+    data = nx.node_link_data(sub, edges="edges")
+    data["graph"] = {**graph.graph, "store": manifest}
+    return data
+
+
+def _cache_key(manifest):
+    # The base segment name is unique, so a graph deleted and built again never matches an old entry.
+    return manifest["base"], manifest["version"]
+
+
+def _cache_get(kb_id, manifest):
+    with _cache_lock:
+        hit = _cache.pop(kb_id, None)
+    if hit and hit[0] == _cache_key(manifest):
+        return hit[1]
+    return None
+
+
+def _cache_put(kb_id, manifest, graph):
+    with _cache_lock:
+        _cache.pop(kb_id, None)
+        _cache[kb_id] = (_cache_key(manifest), graph)
+        while len(_cache) > _CACHE_SIZE:
+            _cache.pop(next(iter(_cache)))
+
+
+def load(kb_id, manifest) -> nx.Graph:
+    """
+    Load the graph a manifest describes. The caller owns the returned graph: it is
+    taken out of the in-process cache and only put back, as a copy, by `commit`.
+    """
+    graph = _cache_get(kb_id, manifest)
+    if graph is not None:
+        return graph
+    graph = json_graph.node_link_graph(_get_segment(kb_id, manifest["base"]), edges="edges")
+    for name in manifest["deltas"]:
+        apply_delta(graph, _get_segment(kb_id, name))
+    if manifest["deltas"]:
+        update_derived_attrs(graph)
+    graph.graph["store_version"] = manifest["version"]
+    return graph
+
+
+def commit(kb_id, graph: nx.Graph, change, manifest=None, full=False):
+    """
+    Write `change` as a delta after `manifest`, or the whole graph as a new base when
+    `full` is set, there is no manifest or the deltas are due for compaction.
+    Returns (new manifest, names of the segments it no longer references).
+    """
+    version = (manifest["version"] if manifest else 0) + 1
+    graph.graph["store_version"] = version
+    # The caller goes on changing its graph (resolution, communities), the cache keeps what was committed.
+    snapshot = copy.deepcopy(graph)
+    if manifest and not full and len(manifest["deltas"]) < GRAPH_STORE_MAX_DELTAS:
+        name, size = _put_segment(kb_id, "delta", delta_of(graph, change))
+        if manifest["delta_size"] + size <= manifest["base_size"]:
+            new_manifest = {**manifest, "version": version, "deltas": manifest["deltas"] + [name],
+                            "delta_size": manifest["delta_size"] + size}
+            _cache_put(kb_id, new_manifest, snapshot)
+            return new_manifest, []
+        STORAGE_IMPL.rm(kb_id, name)
+
+    name, size = _put_segment(kb_id, "base", nx.node_link_data(graph, edges="edges"))
+    new_manifest = {"version": version, "base": name, "deltas": [], "base_size": size, "delta_size": 0}
+    _cache_put(kb_id, new_manifest, snapshot)
+    garbage = [manifest["base"]] + manifest["deltas"] if manifest else []
+    return new_manifest, garbage
+
+
+class GraphAccumulator:
+    """
+    Composes node_link subgraphs into one graph the way repeated `nx.compose` does (later
+    attributes win, node source_ids add up), but into plain dicts, building the graph once.
+    """
+
+    def __init__(self, state=None):
+        state = state or {}
+        self.nodes = state.get("nodes", {})
+        self.edges = {(s, t): attrs for s, t, attrs in state.get("edges", [])}
+        self.sources = state.get("sources", [])
+        self.done = set(state.get("done", []))
+
+    def add(self, doc_id, data):
+        for node in data["nodes"]:
+            attrs = dict(node)
+            n = attrs.pop("id")
+            cur = self.nodes.get(n)
+            if cur is None:
+                self.nodes[n] = attrs
+                continue
+            source_id = cur.get("source_id", []) + attrs.get("source_id", [])
+            cur.update(attrs)
+            cur["source_id"] = source_id
+        for edge in data["edges"]:
+            attrs = dict(edge)
+            s, t = attrs.pop("source"), attrs.pop("target")
+            key = (t, s) if (t, s) in self.edges else (s, t)
+            self.edges.setdefault(key, {}).update(attrs)
+        self.sources.extend(data.get("graph", {}).get("source_id", []))
+        self.done.add(doc_id)
+
+    def state(self):
+        return {"nodes": self.nodes, "edges": [[s, t, attrs] for (s, t), attrs in self.edges.items()],
+                "sources": self.sources, "done": sorted(self.done)}
+
+    def graph(self) -> nx.Graph:
+        graph = nx.Graph()
+        graph.add_nodes_from(self.nodes.items())
+        graph.add_edges_from((s, t, attrs) for (s, t), attrs in self.edges.items())
+        graph.graph["source_id"] = sorted(self.sources)
+        return graph
+
+
+def _checkpoint_name():
+    return "graph_store/rebuild-checkpoint"
+
+
+def save_checkpoint(kb_id, key, accumulator: GraphAccumulator):
+    binary = zlib.compress(json.dumps({"key": key, "time": time.time(), "state": accumulator.state()}, ensure_ascii=False).encode("utf-8"))
+    STORAGE_IMPL.put(kb_id, _checkpoint_name(), binary)
+
+
+def load_checkpoint(kb_id, key) -> GraphAccumulator:
+    """The accumulator of an interrupted rebuild with the same key, or an empty one."""
+    try:
+        if STORAGE_IMPL.obj_exist(kb_id, _checkpoint_name()):
+            checkpoint = json.loads(zlib.decompress(STORAGE_IMPL.get(kb_id, _checkpoint_name())))
+            if checkpoint["key"] == key and time.time() - checkpoint["time"] < GRAPH_REBUILD_CHECKPOINT_TTL:
+                return GraphAccumulator(checkpoint["state"])
+    except Exception:
+        logging.exception(f"Fail to load the graph rebuild checkpoint of {kb_id}")
+    return GraphAccumulator()
+
+
+def remove_checkpoint(kb_id):
+    try:
+        if STORAGE_IMPL.obj_exist(kb_id, _checkpoint_name()):
+            STORAGE_IMPL.rm(kb_id, _checkpoint_name())
+    except Exception:
+        logging.exception(f"Fail to remove the graph rebuild checkpoint of {kb_id}")
+
+
+def remove_segments(kb_id, names):
+    for name in names:
+        try:
+            STORAGE_IMPL.rm(kb_id, name)
+        except Exception:
+            logging.exception(f"Fail to remove graph segment {kb_id}/{name}")
+
+
+def remove_graph(tenant_id, kb_id):
+    """Remove the segments of a knowledge base's graph, before its `graph` chunks are deleted."""
+    res = settings.retrievaler.search({"fields": ["content_with_weight"], "size": 4, "knowledge_graph_kwd": ["graph"]},
+                                      search.index_name(tenant_id), [kb_id])
+    for id in res.ids:
+        try:
+            manifest = json.loads(res.field[id]["content_with_weight"]).get("graph", {}).get("store")
+        except Exception:
+            continue
+        if manifest:
+            remove_segments(kb_id, [manifest["base"]] + manifest["deltas"])
+    graph_cache.bump_version(kb_id)
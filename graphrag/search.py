@@ -15,33 +15,56 @@
 #
 import json
 import logging
+import os
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from copy import deepcopy
+from functools import partial
+from timeit import default_timer as timer
 import json_repair
 import pandas as pd
 import trio
+import xxhash
 
 from api.utils import get_uuid
+from graphrag import graph_cache
 from graphrag.query_analyze_prompt import PROMPTS
-from graphrag.utils import get_entity_type2sampels, get_llm_cache, set_llm_cache, get_relation
+from graphrag.utils import get_entity_type2sampels, get_graph_chunk, load_graph
 from rag.utils import num_tokens_from_string, get_float
 from rag.utils.doc_store_conn import OrderByExpr
+from rag.utils.redis_conn import REDIS_CONN
 
 from rag.nlp.search import Dealer, index_name
 
+# Entities of the answer types fetched to boost the matching ones, by descending pagerank.
+KG_TYPE_ENTITY_TOPN = int(os.environ.get("KG_TYPE_ENTITY_TOPN", 128))
+KG_QUERY_REWRITE_CACHE_TTL = int(os.environ.get("KG_QUERY_REWRITE_CACHE_TTL", 3600))
+# N-hop paths expanded from each entity of the query in the cached graph: length and branching.
+KG_NHOP_HOPS = int(os.environ.get("KG_NHOP_HOPS", 2))
+KG_NHOP_FANOUT = int(os.environ.get("KG_NHOP_FANOUT", 4))
+
 
 class KGSearch(Dealer):
     def _chat(self, llm_bdl, system, history, gen_conf):
-        response = get_llm_cache(llm_bdl.llm_name, system, history, gen_conf)
-        if response:
-            return response
-        response = llm_bdl.chat(system, history, gen_conf)
+        response = llm_bdl.chat(system, history, gen_conf, cache="graph")
         if response.find("**ERROR**") >= 0:
             raise Exception(response)
-        set_llm_cache(llm_bdl.llm_name, system, response, history, gen_conf)
         return response
 
     def query_rewrite(self, llm, question, idxnms, kb_ids):
+        """(answer type keywords, entities from the query); cached per question and knowledge bases."""
+        hasher = xxhash.xxh64()
+        for v in ["kg_query_rewrite", llm.llm_name, question, sorted(kb_ids)]:
+            hasher.update(str(v).encode("utf-8"))
+        k = hasher.hexdigest()
+        cached = REDIS_CONN.get(k)
+        if cached:
+            return tuple(json.loads(cached))
+        type_keywords, entities_from_query = self._query_rewrite(llm, question, idxnms, kb_ids)
+        REDIS_CONN.set(k, json.dumps([type_keywords, entities_from_query], ensure_ascii=False), KG_QUERY_REWRITE_CACHE_TTL)
+        return type_keywords, entities_from_query
+
+    def _query_rewrite(self, llm, question, idxnms, kb_ids):
         ty2ents = trio.run(lambda: get_entity_type2sampels(idxnms, kb_ids))
         hint_prompt = PROMPTS["minirag_query2kwd"].format(query=question,
                                                           TYPE_POOL=json.dumps(ty2ents, ensure_ascii=False, indent=2))
@@ -137,6 +160,56 @@ class KGSearch(Dealer):
                                        idxnms, kb_ids)
         return self._ent_info_from_(es_res, 0)
 
+    def get_relation_descriptions(self, pairs, filters, idxnms, kb_ids):
+        """Descriptions of the relations between the given entity pairs, in one search across all indices."""
+        if not pairs:
+            return {}
+        ents = sorted(set(e for pair in pairs for e in pair))
+        filters = deepcopy(filters)
+        filters["knowledge_graph_kwd"] = "relation"
+        filters["from_entity_kwd"] = ents
+        filters["to_entity_kwd"] = ents
+        flds = ["content_with_weight", "from_entity_kwd", "to_entity_kwd"]
+        es_res = self.dataStore.search(flds, [], filters, [], OrderByExpr(), 0, len(ents) * len(ents), idxnms, kb_ids)
+        wanted = {tuple(sorted(pair)) for pair in pairs}
+        res = {}
+        for _, rel in self.dataStore.getFields(es_res, flds).items():
+            f, t = rel["from_entity_kwd"], rel["to_entity_kwd"]
+            f = f[0] if isinstance(f, list) else f
+            t = t[0] if isinstance(t, list) else t
+            pair = tuple(sorted([f, t]))
+            if pair in wanted and pair not in res:
+                try:
+                    res[pair] = json.loads(rel["content_with_weight"]).get("description", "")
+                except Exception:
+                    continue
+        return res
+
+    def _load_graph(self, tenant_ids, kb_id):
+        for tid in tenant_ids:
+            header = trio.run(get_graph_chunk, tid, kb_id)
+            if header is None:
+                continue
+            # A graph being rebuilt after a document removal is not worth rebuilding here.
+            if header[2] != "N":
+                return None
+            # Raises when the graph can't be loaded, so the failure is not cached.
+            return trio.run(load_graph, tid, kb_id, header)
+        return None
+
+    def get_graphs(self, tenant_ids, kb_ids):
+        """The cached graphs of the knowledge bases that have one."""
+        graphs = []
+        for kb_id in kb_ids:
+            try:
+                g = graph_cache.get(kb_id, partial(self._load_graph, tenant_ids, kb_id))
+            except Exception:
+                logging.exception(f"KGSearch.get_graphs {kb_id} got exception")
+                continue
+            if g is not None:
+                graphs.append(g)
+        return graphs
+
     def retrieval(self, question: str,
                tenant_ids: str | list[str],
                kb_ids: list[str],
@@ -155,18 +228,40 @@ class KGSearch(Dealer):
         if isinstance(tenant_ids, str):
             tenant_ids = tenant_ids.split(",")
         idxnms = [index_name(tid) for tid in tenant_ids]
-        ty_kwds = []
-        try:
-            ty_kwds, ents = self.query_rewrite(llm, qst, [index_name(tid) for tid in tenant_ids], kb_ids)
-            logging.info(f"Q: {qst}, Types: {ty_kwds}, Entities: {ents}")
-        except Exception as e:
-            logging.exception(e)
-            ents = [qst]
-            pass
-
-        ents_from_query = self.get_relevant_ents_by_keywords(ents, filters, idxnms, kb_ids, emb_mdl, ent_sim_threshold)
-        ents_from_types = self.get_relevant_ents_by_types(ty_kwds, filters, idxnms, kb_ids, 10000)
-        rels_from_txt = self.get_relevant_relations_by_txt(qst, filters, idxnms, kb_ids, emb_mdl, rel_sim_threshold)
+        st = timer()
+
+        def rewrite():
+            try:
+                ty_kwds, ents = self.query_rewrite(llm, qst, idxnms, kb_ids)
+                logging.info(f"Q: {qst}, Types: {ty_kwds}, Entities: {ents}")
+                return ty_kwds, ents
+            except Exception as e:
+                logging.exception(e)
+                return [], [qst]
+
+        # The relation search and the graph loading only need the question, they run along with
+        # the query rewrite; both entity searches need the rewrite and run along with each other.
+        with ThreadPoolExecutor(max_workers=4) as exe:
+            rels_future = exe.submit(self.get_relevant_relations_by_txt, qst, filters, idxnms, kb_ids, emb_mdl, rel_sim_threshold)
+            graphs_future = exe.submit(self.get_graphs, tenant_ids, kb_ids)
+            ty_kwds, ents = rewrite()
+            rewrite_elapsed = timer() - st
+            ents_future = exe.submit(self.get_relevant_ents_by_keywords, ents, filters, idxnms, kb_ids, emb_mdl, ent_sim_threshold)
+            types_future = exe.submit(self.get_relevant_ents_by_types, ty_kwds, filters, idxnms, kb_ids, KG_TYPE_ENTITY_TOPN)
+            ents_from_query = ents_future.result()
+            ents_from_types = types_future.result()
+            rels_from_txt = rels_future.result()
+            graphs = graphs_future.result()
+        search_elapsed = timer() - st - rewrite_elapsed
+
+        # N-hop paths from the entities of the query, walked in the current graph.
+        if graphs:
+            seeds = {n: ent["sim"] for n, ent in ents_from_query.items()}
+            for n in seeds:
+                ents_from_query[n]["n_hop_ents"] = []
+            for g in graphs:
+                for n, paths in g.expand(seeds, KG_NHOP_HOPS, KG_NHOP_FANOUT).items():
+                    ents_from_query[n]["n_hop_ents"].extend(paths)
         nhop_pathes = defaultdict(dict)
         for _, ent in ents_from_query.items():
             nhops = ent.get("n_hop_ents", [])
@@ -224,6 +319,16 @@ class KGSearch(Dealer):
         rels_from_txt = sorted(rels_from_txt.items(), key=lambda x: x[1]["sim"] * x[1]["pagerank"], reverse=True)[
                         :rel_topn]
 
+        # Relations found by n-hop paths have no description; look them all up at once,
+        # along with the community reports of the top entities.
+        with ThreadPoolExecutor(max_workers=2) as exe:
+            missing = [(f, t) for (f, t), rel in rels_from_txt if not rel.get("description")]
+            desc_future = exe.submit(self.get_relation_descriptions, missing, filters, idxnms, kb_ids)
+            comm_future = exe.submit(self._community_retrieval_, [n for n, _ in ents_from_query], filters, kb_ids, idxnms,
+                                     comm_topn, max_token)
+            descriptions = desc_future.result()
+            community = comm_future.result()
+
         ents = []
         relas = []
         for n, ent in ents_from_query:
@@ -239,13 +344,9 @@ class KGSearch(Dealer):
 
         for (f, t), rel in rels_from_txt:
             if not rel.get("description"):
-                for tid in tenant_ids:
-                    rela = get_relation(tid, kb_ids, f, t)
-                    if rela:
-                        break
-                else:
+                if tuple(sorted([f, t])) not in descriptions:
                     continue
-                rel["description"] = rela["description"]
+                rel["description"] = descriptions[tuple(sorted([f, t]))]
             desc = rel["description"]
             try:
                 desc = json.loads(desc).get("description", "")
@@ -270,12 +371,13 @@ class KGSearch(Dealer):
             relas = "\n---- Relations ----\n{}".format(pd.DataFrame(relas).to_csv())
         else:
             relas = ""
+        logging.info(f"KG retrieval: rewrite {rewrite_elapsed * 1000:.1f}ms, searches {search_elapsed * 1000:.1f}ms, "
+                     f"graphs {len(graphs)}, total {(timer() - st) * 1000:.1f}ms")
 
         return {
                 "chunk_id": get_uuid(),
                 "content_ltks": "",
-                "content_with_weight": ents + relas + self._community_retrieval_([n for n, _ in ents_from_query], filters, kb_ids, idxnms,
-                                                        comm_topn, max_token),
+                "content_with_weight": ents + relas + community,
                 "doc_id": "",
                 "docnm_kwd": "Related content in Knowledge Graph",
                 "kb_id": kb_ids,
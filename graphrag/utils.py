@@ -28,13 +28,38 @@ from api import settings
 from api.utils import get_uuid
 from rag.nlp import search, rag_tokenizer
 from rag.utils.doc_store_conn import OrderByExpr
+from rag.settings import EMBEDDING_BATCH_SIZE
+from rag.utils import llm_cache
 from rag.utils.redis_conn import REDIS_CONN
+from graphrag import graph_cache, graph_store
 
 GRAPH_FIELD_SEP = "<SEP>"
 
 ErrorHandlerFn = Callable[[BaseException | None, str | None, dict | None], None]
 
 chat_limiter = trio.CapacityLimiter(int(os.environ.get('MAX_CONCURRENT_CHATS', 10)))
+# Documents whose subgraphs rebuild_graph composes between two checkpoints.
+GRAPH_REBUILD_CHECKPOINT_EVERY = int(os.environ.get('GRAPH_REBUILD_CHECKPOINT_EVERY', 2048))
+
+
+class TokenBudget:
+    """Bounds the prompt tokens of the LLM calls in flight; a call larger than the budget runs alone."""
+
+    def __init__(self, budget: int):
+        self.budget = budget
+        self.in_flight = 0
+        self.released = trio.Event()
+
+    async def acquire(self, tokens: int):
+        while self.in_flight and self.in_flight + tokens > self.budget:
+            await self.released.wait()
+        self.in_flight += tokens
+
+    def release(self, tokens: int):
+        self.in_flight -= tokens
+        self.released.set()
+        self.released = trio.Event()
+
 
 @dataclasses.dataclass
 class GraphChange:
@@ -92,29 +117,17 @@ def dict_has_keys_with_types(
     return True
 
 
-def get_llm_cache(llmnm, txt, history, genconf):
-    hasher = xxhash.xxh64()
-    hasher.update(str(llmnm).encode("utf-8"))
-    hasher.update(str(txt).encode("utf-8"))
-    hasher.update(str(history).encode("utf-8"))
-    hasher.update(str(genconf).encode("utf-8"))
+def get_llm_cache(llmnm, txt, history, genconf, use_case="default", tenant_id=None):
+    return llm_cache.get(use_case, llm_cache.key(use_case, tenant_id, llmnm, txt, history, genconf))
 
-    k = hasher.hexdigest()
-    bin = REDIS_CONN.get(k)
-    if not bin:
-        return
-    return bin
 
+def get_llm_cache_many(llmnm, txts, history, genconf, use_case="default", tenant_id=None):
+    """`get_llm_cache` for several texts in one round trip; None for the texts missing from the cache."""
+    return llm_cache.get_many(use_case, [llm_cache.key(use_case, tenant_id, llmnm, txt, history, genconf) for txt in txts])
 
-def set_llm_cache(llmnm, txt, v, history, genconf):
-    hasher = xxhash.xxh64()
-    hasher.update(str(llmnm).encode("utf-8"))
-    hasher.update(str(txt).encode("utf-8"))
-    hasher.update(str(history).encode("utf-8"))
-    hasher.update(str(genconf).encode("utf-8"))
 
-    k = hasher.hexdigest()
-    REDIS_CONN.set(k, v.encode("utf-8"), 24*3600)
+def set_llm_cache(llmnm, txt, v, history, genconf, use_case="default", tenant_id=None):
+    llm_cache.put(use_case, llm_cache.key(use_case, tenant_id, llmnm, txt, history, genconf), v)
 
 
 def get_embed_cache(llmnm, txt):
@@ -139,6 +152,26 @@ def set_embed_cache(llmnm, txt, arr):
     REDIS_CONN.set(k, arr.encode("utf-8"), 24*3600)
 
 
+def _embed_cache_key(llmnm, txt):
+    hasher = xxhash.xxh64()
+    hasher.update(str(llmnm).encode("utf-8"))
+    hasher.update(str(txt).encode("utf-8"))
+    return hasher.hexdigest()
+
+
+def get_embed_cache_many(llmnm, txts):
+    """`get_embed_cache` for several texts in one round trip; None for the texts missing from the cache."""
+    bins = REDIS_CONN.mget([_embed_cache_key(llmnm, txt) for txt in txts])
+    return [np.array(json.loads(bin)) if bin else None for bin in bins]
+
+
+def set_embed_cache_many(llmnm, txts, arrs):
+    REDIS_CONN.mset({
+        _embed_cache_key(llmnm, txt): json.dumps(arr.tolist() if isinstance(arr, np.ndarray) else arr).encode("utf-8")
+        for txt, arr in zip(txts, arrs)
+    }, 24*3600)
+
+
 def get_tags_from_cache(kb_ids):
     hasher = xxhash.xxh64()
     hasher.update(str(kb_ids).encode("utf-8"))
@@ -305,8 +338,7 @@ def chunk_id(chunk):
     return xxhash.xxh64((chunk["content_with_weight"] + chunk["kb_id"]).encode("utf-8")).hexdigest()
 
 
-async def graph_node_to_chunk(kb_id, embd_mdl, ent_name, meta, chunks):
-    global chat_limiter
+def graph_node_to_chunk(kb_id, ent_name, meta):
     chunk = {
         "id": get_uuid(),
         "important_kwd": [ent_name],
@@ -318,19 +350,12 @@ async def graph_node_to_chunk(kb_id, embd_mdl, ent_name, meta, chunks):
         "content_ltks": rag_tokenizer.tokenize(meta["description"]),
         "source_id": meta["source_id"],
         "kb_id": kb_id,
-        "available_int": 0
+        "available_int": 0,
+        # Entities are ranked by it, e.g. to keep the top ones of a type.
+        "rank_flt": float(meta.get("pagerank", 0)),
     }
     chunk["content_sm_ltks"] = rag_tokenizer.fine_grained_tokenize(chunk["content_ltks"])
-    ebd = get_embed_cache(embd_mdl.llm_name, ent_name)
-    if ebd is None:
-        async with chat_limiter:
-            with trio.fail_after(3):
-                ebd, _ = await trio.to_thread.run_sync(lambda: embd_mdl.encode([ent_name]))
-        ebd = ebd[0]
-        set_embed_cache(embd_mdl.llm_name, ent_name, ebd)
-    assert ebd is not None
-    chunk["q_%d_vec" % len(ebd)] = ebd
-    chunks.append(chunk)
+    return chunk
 
 
 @timeout(3, 3)
@@ -361,7 +386,7 @@ def get_relation(tenant_id, kb_id, from_ent_name, to_ent_name, size=1):
     return res
 
 
-async def graph_edge_to_chunk(kb_id, embd_mdl, from_ent_name, to_ent_name, meta, chunks):
+def graph_edge_to_chunk(kb_id, from_ent_name, to_ent_name, meta):
     chunk = {
         "id": get_uuid(),
         "from_entity_kwd": from_ent_name,
@@ -376,17 +401,38 @@ async def graph_edge_to_chunk(kb_id, embd_mdl, from_ent_name, to_ent_name, meta,
         "available_int": 0
     }
     chunk["content_sm_ltks"] = rag_tokenizer.fine_grained_tokenize(chunk["content_ltks"])
-    txt = f"{from_ent_name}->{to_ent_name}"
-    ebd = get_embed_cache(embd_mdl.llm_name, txt)
-    if ebd is None:
+    return chunk
+
+
+async def embed_with_cache(embd_mdl, keys, texts, callback=None):
+    """
+    Vectors of `texts`, cached under `keys`. Cached vectors are fetched in one round trip
+    and the others encoded EMBEDDING_BATCH_SIZE texts per request.
+    """
+    global chat_limiter
+    vectors = await trio.to_thread.run_sync(lambda: get_embed_cache_many(embd_mdl.llm_name, keys))
+    todo = [i for i, v in enumerate(vectors) if v is None]
+    batches = [todo[i:i + EMBEDDING_BATCH_SIZE] for i in range(0, len(todo), EMBEDDING_BATCH_SIZE)]
+    done = 0
+
+    async def encode(batch):
+        nonlocal done
         async with chat_limiter:
-            with trio.fail_after(3):
-                ebd, _ = await trio.to_thread.run_sync(lambda: embd_mdl.encode([txt+f": {meta['description']}"]))
-        ebd = ebd[0]
-        set_embed_cache(embd_mdl.llm_name, txt, ebd)
-    assert ebd is not None
-    chunk["q_%d_vec" % len(ebd)] = ebd
-    chunks.append(chunk)
+            with trio.fail_after(3 + len(batch)):
+                ebds, _ = await trio.to_thread.run_sync(lambda: embd_mdl.encode([texts[i] for i in batch]))
+        for i, ebd in zip(batch, ebds):
+            vectors[i] = ebd
+        await trio.to_thread.run_sync(lambda: set_embed_cache_many(embd_mdl.llm_name, [keys[i] for i in batch], [vectors[i] for i in batch]))
+        done += 1
+        if callback:
+            callback(msg=f"Get embedding batch {done}/{len(batches)}")
+
+    async with trio.open_nursery() as nursery:
+        for batch in batches:
+            nursery.start_soon(encode, batch)
+    if callback:
+        callback(msg=f"Got {len(keys)} embeddings, {len(keys) - len(todo)} from cache, {len(todo)} in {len(batches)} requests")
+    return vectors
 
 
 async def does_graph_contains(tenant_id, kb_id, doc_id):
@@ -420,65 +466,105 @@ async def get_graph_doc_ids(tenant_id, kb_id) -> list[str]:
     return doc_ids
 
 
-async def get_graph(tenant_id, kb_id, exclude_rebuild=None):
+async def get_graph_chunk(tenant_id, kb_id):
+    """Return (chunk id, parsed content, removed_kwd, source_id) of the newest `graph` chunk, or None."""
     conds = {
         "fields": ["content_with_weight", "removed_kwd", "source_id"],
-        "size": 1,
+        "size": 4,
         "knowledge_graph_kwd": ["graph"]
     }
     res = await trio.to_thread.run_sync(lambda: settings.retrievaler.search(conds, search.index_name(tenant_id), [kb_id]))
-    if not res.total == 0:
-        for id in res.ids:
-            try:
-                if res.field[id]["removed_kwd"] == "N":
-                    g = json_graph.node_link_graph(json.loads(res.field[id]["content_with_weight"]), edges="edges")
-                    if "source_id" not in g.graph:
-                        g.graph["source_id"] = res.field[id]["source_id"]
-                else:
-                    g = await rebuild_graph(tenant_id, kb_id, exclude_rebuild)
-                return g
-            except Exception:
-                continue
-    result = None
-    return result
-
+    newest = None
+    for id in res.ids:
+        try:
+            data = json.loads(res.field[id]["content_with_weight"])
+        except Exception:
+            continue
+        version = graph_chunk_version(data)
+        if newest is None or version > graph_chunk_version(newest[1]):
+            newest = (id, data, res.field[id]["removed_kwd"], res.field[id]["source_id"])
+    return newest
 
-async def set_graph(tenant_id: str, kb_id: str, embd_mdl, graph: nx.Graph, change: GraphChange, callback):
-    global chat_limiter
-    start = trio.current_time()
 
-    await trio.to_thread.run_sync(lambda: settings.docStoreConn.delete({"knowledge_graph_kwd": ["graph", "subgraph"]}, search.index_name(tenant_id), kb_id))
-
-    if change.removed_nodes:
-        await trio.to_thread.run_sync(lambda: settings.docStoreConn.delete({"knowledge_graph_kwd": ["entity"], "entity_kwd": sorted(change.removed_nodes)}, search.index_name(tenant_id), kb_id))
+def graph_chunk_version(data):
+    return (data.get("graph", {}).get("store") or {}).get("version", 0)
 
 
-    if change.removed_edges:
-        async def del_edges(from_node, to_node):
-            async with chat_limiter:
-                await trio.to_thread.run_sync(lambda: settings.docStoreConn.delete({"knowledge_graph_kwd": ["relation"], "from_entity_kwd": from_node, "to_entity_kwd": to_node}, search.index_name(tenant_id), kb_id))
-        async with trio.open_nursery() as nursery:
-            for from_node, to_node in change.removed_edges:
-                 nursery.start_soon(del_edges, from_node, to_node)
+async def load_graph(tenant_id, kb_id, header, exclude_rebuild=None):
+    """The graph of the `graph` chunk `header` (as returned by get_graph_chunk); raises when it can't be loaded."""
+    _, data, removed, source_id = header
+    if removed == "N":
+        manifest = data.get("graph", {}).get("store")
+        if manifest:
+            g = await trio.to_thread.run_sync(lambda: graph_store.load(kb_id, manifest))
+        else:
+            # A graph chunk holding the whole graph, as written before the graph store existed.
+            g = json_graph.node_link_graph(data, edges="edges")
+        if "source_id" not in g.graph:
+            g.graph["source_id"] = source_id
+    else:
+        g = await rebuild_graph(tenant_id, kb_id, exclude_rebuild, graph_chunk_version(data))
+        if g is None:
+            return None
+    g.graph["store_version"] = graph_chunk_version(data)
+    return g
 
-    now = trio.current_time()
-    if callback:
-        callback(msg=f"set_graph removed {len(change.removed_nodes)} nodes and {len(change.removed_edges)} edges from index in {now - start:.2f}s.")
-    start = now
 
-    chunks = [{
-        "id": get_uuid(),
-        "content_with_weight": json.dumps(nx.node_link_data(graph, edges="edges"), ensure_ascii=False),
-        "knowledge_graph_kwd": "graph",
-        "kb_id": kb_id,
-        "source_id": graph.graph.get("source_id", []),
-        "available_int": 0,
-        "removed_kwd": "N"
-    }]
-    
-    # generate updated subgraphs
-    for source in graph.graph["source_id"]:
-        subgraph = graph.subgraph([n for n in graph.nodes if source in graph.nodes[n]["source_id"]]).copy()
+async def get_graph(tenant_id, kb_id, exclude_rebuild=None):
+    header = await get_graph_chunk(tenant_id, kb_id)
+    if header is None:
+        return None
+    try:
+        return await load_graph(tenant_id, kb_id, header, exclude_rebuild)
+    except Exception:
+        logging.exception(f"get_graph of {kb_id} got exception")
+    return None
+
+
+async def graph_change_to_chunks(kb_id, embd_mdl, graph: nx.Graph, change: GraphChange, callback):
+    """Entity and relation chunks of the added or updated nodes and edges."""
+    chunks, keys, texts = [], [], []
+    for node in change.added_updated_nodes:
+        chunks.append(graph_node_to_chunk(kb_id, node, graph.nodes[node]))
+        keys.append(node)
+        texts.append(node)
+    for from_node, to_node in change.added_updated_edges:
+        edge_attrs = graph.get_edge_data(from_node, to_node)
+        if not edge_attrs:
+            # added_updated_edges could record a non-existing edge if both from_node and to_node participate in nodes merging.
+            continue
+        chunks.append(graph_edge_to_chunk(kb_id, from_node, to_node, edge_attrs))
+        keys.append(f"{from_node}->{to_node}")
+        texts.append(f"{from_node}->{to_node}: {edge_attrs['description']}")
+
+    vectors = await embed_with_cache(embd_mdl, keys, texts, callback)
+    for chunk, ebd in zip(chunks, vectors):
+        assert ebd is not None
+        chunk["q_%d_vec" % len(ebd)] = ebd
+    return chunks
+
+
+def _changed_sources(graph: nx.Graph, change: GraphChange):
+    sources = set()
+    for node in change.added_updated_nodes:
+        if graph.has_node(node):
+            sources.update(graph.nodes[node].get("source_id", []))
+    for from_node, to_node in change.added_updated_edges:
+        edge_attrs = graph.get_edge_data(from_node, to_node)
+        if edge_attrs:
+            sources.update(edge_attrs.get("source_id", []))
+    return sources & set(graph.graph.get("source_id", []))
+
+
+def _subgraph_chunks(kb_id, graph: nx.Graph, sources):
+    nodes_of = defaultdict(list)
+    for n, attrs in graph.nodes(data=True):
+        for source in attrs.get("source_id", []):
+            if source in sources:
+                nodes_of[source].append(n)
+    chunks = []
+    for source in sources:
+        subgraph = graph.subgraph(nodes_of[source]).copy()
         subgraph.graph["source_id"] = [source]
         for n in subgraph.nodes:
             subgraph.nodes[n]["source_id"] = [source]
@@ -491,29 +577,50 @@ async def set_graph(tenant_id: str, kb_id: str, embd_mdl, graph: nx.Graph, chang
             "available_int": 0,
             "removed_kwd": "N"
         })
+    return chunks
 
-    async with trio.open_nursery() as nursery:
-        for ii, node in enumerate(change.added_updated_nodes):
-            node_attrs = graph.nodes[node]
-            nursery.start_soon(graph_node_to_chunk, kb_id, embd_mdl, node, node_attrs, chunks)
-            if ii%100 == 9 and callback:
-                callback(msg=f"Get embedding of nodes: {ii}/{len(change.added_updated_nodes)}")
 
-    async with trio.open_nursery() as nursery:
-        for ii, (from_node, to_node) in enumerate(change.added_updated_edges):
-            edge_attrs = graph.get_edge_data(from_node, to_node)
-            if not edge_attrs:
-                # added_updated_edges could record a non-existing edge if both from_node and to_node participate in nodes merging.
-                continue
-            nursery.start_soon(graph_edge_to_chunk, kb_id, embd_mdl, from_node, to_node, edge_attrs, chunks)
-            if ii%100 == 9 and callback:
-                callback(msg=f"Get embedding of edges: {ii}/{len(change.added_updated_edges)}")
+async def commit_graph(tenant_id: str, kb_id: str, graph: nx.Graph, change: GraphChange, chunks: list, callback, subgraphs: bool = True):
+    """
+    Write a graph change: entity/relation chunks, the subgraphs of the documents it touches
+    unless `subgraphs` is False, a graph store segment and a new `graph` chunk.
+    Returns False without writing anything if the graph was committed by someone else since
+    `graph` was loaded; callers hold the graphrag_task lock around this call only.
+    """
+    global chat_limiter
+    start = trio.current_time()
+    header = await get_graph_chunk(tenant_id, kb_id)
+    current_version = graph_chunk_version(header[1]) if header else 0
+    if current_version != graph.graph.get("store_version", 0):
+        return False
+    manifest = header[1].get("graph", {}).get("store") if header else None
+    full = header is None or header[2] != "N" or not manifest
+
+    if change.removed_nodes:
+        await trio.to_thread.run_sync(lambda: settings.docStoreConn.delete({"knowledge_graph_kwd": ["entity"], "entity_kwd": sorted(change.removed_nodes)}, search.index_name(tenant_id), kb_id))
+
+    if change.removed_edges:
+        async def del_edges(from_node, to_node):
+            async with chat_limiter:
+                await trio.to_thread.run_sync(lambda: settings.docStoreConn.delete({"knowledge_graph_kwd": ["relation"], "from_entity_kwd": from_node, "to_entity_kwd": to_node}, search.index_name(tenant_id), kb_id))
+        async with trio.open_nursery() as nursery:
+            for from_node, to_node in change.removed_edges:
+                 nursery.start_soon(del_edges, from_node, to_node)
 
     now = trio.current_time()
     if callback:
-        callback(msg=f"set_graph converted graph change to {len(chunks)} chunks in {now - start:.2f}s.")
+        callback(msg=f"set_graph removed {len(change.removed_nodes)} nodes and {len(change.removed_edges)} edges from index in {now - start:.2f}s.")
     start = now
 
+    # Only the subgraphs of documents owning a changed node or edge differ from the stored ones.
+    if full:
+        sources = set(graph.graph.get("source_id", []))
+    else:
+        sources = _changed_sources(graph, change) if subgraphs else set()
+    if sources:
+        await trio.to_thread.run_sync(lambda: settings.docStoreConn.delete({"knowledge_graph_kwd": ["subgraph"], "source_id": sorted(sources)}, search.index_name(tenant_id), kb_id))
+    chunks = chunks + await trio.to_thread.run_sync(lambda: _subgraph_chunks(kb_id, graph, sources))
+
     es_bulk_size = 4
     for b in range(0, len(chunks), es_bulk_size):
         with trio.fail_after(3):
@@ -523,9 +630,40 @@ async def set_graph(tenant_id: str, kb_id: str, embd_mdl, graph: nx.Graph, chang
         if doc_store_result:
             error_message = f"Insert chunk error: {doc_store_result}, please check log file and Elasticsearch/Infinity status!"
             raise Exception(error_message)
+
+    new_manifest, garbage = await trio.to_thread.run_sync(lambda: graph_store.commit(kb_id, graph, change, manifest, full))
+    graph_chunk = {
+        "id": get_uuid(),
+        "content_with_weight": json.dumps(graph_store.preview(graph, new_manifest), ensure_ascii=False),
+        "knowledge_graph_kwd": "graph",
+        "kb_id": kb_id,
+        "source_id": graph.graph.get("source_id", []),
+        "available_int": 0,
+        "removed_kwd": "N"
+    }
+    doc_store_result = await trio.to_thread.run_sync(lambda: settings.docStoreConn.insert([graph_chunk], search.index_name(tenant_id), kb_id))
+    if doc_store_result:
+        raise Exception(f"Insert chunk error: {doc_store_result}, please check log file and Elasticsearch/Infinity status!")
+    if header:
+        await trio.to_thread.run_sync(lambda: settings.docStoreConn.delete({"id": [header[0]]}, search.index_name(tenant_id), kb_id))
+    if garbage:
+        await trio.to_thread.run_sync(lambda: graph_store.remove_segments(kb_id, garbage))
+    graph_cache.bump_version(kb_id)
+
     now = trio.current_time()
     if callback:
         callback(msg=f"set_graph added/updated {len(change.added_updated_nodes)} nodes and {len(change.added_updated_edges)} edges from index in {now - start:.2f}s.")
+    return True
+
+
+async def set_graph(tenant_id: str, kb_id: str, embd_mdl, graph: nx.Graph, change: GraphChange, callback):
+    start = trio.current_time()
+    chunks = await graph_change_to_chunks(kb_id, embd_mdl, graph, change, callback)
+    now = trio.current_time()
+    if callback:
+        callback(msg=f"set_graph converted graph change to {len(chunks)} chunks in {now - start:.2f}s.")
+    if not await commit_graph(tenant_id, kb_id, graph, change, chunks, callback):
+        raise Exception(f"The knowledge graph of {kb_id} was changed concurrently, please retry.")
 
 
 def is_continuous_subsequence(subseq, seq):
@@ -602,45 +740,62 @@ def flat_uniq_list(arr, key):
     return list(set(res))
 
 
-async def rebuild_graph(tenant_id, kb_id, exclude_rebuild=None):
-    graph = nx.Graph()
-    flds = ["knowledge_graph_kwd", "content_with_weight", "source_id"]
-    bs = 256
-    for i in range(0, 1024*bs, bs):
-        es_res = await trio.to_thread.run_sync(lambda: settings.docStoreConn.search(flds, [],
-                                 {"kb_id": kb_id, "knowledge_graph_kwd": ["subgraph"]},
-                                 [],
-                                 OrderByExpr(),
-                                 i, bs, search.index_name(tenant_id), [kb_id]
-                                 ))
-        # tot = settings.docStoreConn.getTotal(es_res)
-        es_res = settings.docStoreConn.getFields(es_res, flds)
-
-        if len(es_res) == 0:
-            break
-
-        for id, d in es_res.items():
+async def rebuild_graph(tenant_id, kb_id, exclude_rebuild=None, version=0):
+    """
+    Compose the graph from the subgraph chunks of its documents, in one pass. The progress
+    is checkpointed, so an interrupted rebuild resumes from it as long as the graph is at the
+    same `version` and made of the subgraphs of the same documents.
+    """
+    if exclude_rebuild is None:
+        exclude_rebuild = []
+    elif not isinstance(exclude_rebuild, list):
+        exclude_rebuild = [exclude_rebuild]
+
+    def subgraph_doc(d):
+        source_id = d.get("source_id") or []
+        return source_id[0] if isinstance(source_id, list) and source_id else source_id
+
+    async def subgraphs(flds):
+        bs = 256
+        for i in range(0, 1024*bs, bs):
+            es_res = await trio.to_thread.run_sync(lambda: settings.docStoreConn.search(flds, [],
+                                     {"kb_id": kb_id, "knowledge_graph_kwd": ["subgraph"]},
+                                     [],
+                                     OrderByExpr(),
+                                     i, bs, search.index_name(tenant_id), [kb_id]
+                                     ))
+            es_res = settings.docStoreConn.getFields(es_res, flds)
+            if len(es_res) == 0:
+                break
+            yield es_res
+
+    docs = set()
+    async for es_res in subgraphs(["source_id"]):
+        docs.update(subgraph_doc(d) for d in es_res.values())
+    docs -= set(exclude_rebuild)
+    checkpoint_key = {"version": version, "docs": xxhash.xxh64("\0".join(sorted(map(str, docs))).encode("utf-8")).hexdigest()}
+    acc = await trio.to_thread.run_sync(lambda: graph_store.load_checkpoint(kb_id, checkpoint_key))
+    if acc.done:
+        logging.info(f"Resume rebuilding the graph of {kb_id} from {len(acc.done)} documents")
+
+    def compose(es_res):
+        for d in es_res.values():
             assert d["knowledge_graph_kwd"] == "subgraph"
-            if isinstance(exclude_rebuild, list):
-                if sum([n in d["source_id"] for n in exclude_rebuild]):
-                    continue
-            elif exclude_rebuild in d["source_id"]:
+            doc_id = subgraph_doc(d)
+            if doc_id in acc.done or any(n in d["source_id"] for n in exclude_rebuild):
                 continue
-            
-            next_graph = json_graph.node_link_graph(json.loads(d["content_with_weight"]), edges="edges")
-            merged_graph = nx.compose(graph, next_graph)
-            merged_source = {
-                n: graph.nodes[n]["source_id"] + next_graph.nodes[n]["source_id"]
-                for n in graph.nodes & next_graph.nodes
-            }
-            nx.set_node_attributes(merged_graph, merged_source, "source_id")
-            if "source_id" in graph.graph:
-                merged_graph.graph["source_id"] = graph.graph["source_id"] + next_graph.graph["source_id"]
-            else:
-                merged_graph.graph["source_id"] = next_graph.graph["source_id"]
-            graph = merged_graph
-
+            acc.add(doc_id, json.loads(d["content_with_weight"]))
+
+    checkpointed = len(acc.done)
+    async for es_res in subgraphs(["knowledge_graph_kwd", "content_with_weight", "source_id"]):
+        await trio.to_thread.run_sync(lambda: compose(es_res))
+        if len(acc.done) - checkpointed >= GRAPH_REBUILD_CHECKPOINT_EVERY:
+            await trio.to_thread.run_sync(lambda: graph_store.save_checkpoint(kb_id, checkpoint_key, acc))
+            checkpointed = len(acc.done)
+
+    graph = await trio.to_thread.run_sync(acc.graph)
+    if checkpointed:
+        await trio.to_thread.run_sync(lambda: graph_store.remove_checkpoint(kb_id))
     if len(graph.nodes) == 0:
         return None
-    graph.graph["source_id"] = sorted(graph.graph["source_id"])
     return graph
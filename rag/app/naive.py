@@ -34,6 +34,7 @@ from deepdoc.parser import DocxParser, ExcelParser, HtmlParser, JsonParser, Mark
 from deepdoc.parser.figure_parser import VisionFigureParser, vision_figure_parser_figure_data_wrapper
 from deepdoc.parser.pdf_parser import PlainParser, VisionParser
 from rag.nlp import concat_img, find_codec, naive_merge, naive_merge_with_images, naive_merge_docx, rag_tokenizer, tokenize_chunks, tokenize_chunks_with_images, tokenize_table
+from rag.utils.parse_artifacts import section_config
 
 
 class Docx(DocxParser):
@@ -256,23 +257,27 @@ class Pdf(PdfParser):
         super().__init__()
 
     def __call__(self, filename, binary=None, from_page=0,
-                 to_page=100000, zoomin=3, callback=None, separate_tables_figures=False):
+                 to_page=100000, zoomin=3, callback=None, separate_tables_figures=False, artifacts=None):
         start = timer()
         first_start = start
         callback(msg="OCR started")
-        self.__images__(
-            filename if not binary else binary,
-            zoomin,
-            from_page,
-            to_page,
-            callback
-        )
-        callback(msg="OCR finished ({:.2f}s)".format(timer() - start))
-        logging.info("OCR({}~{}): {:.2f}s".format(from_page, to_page, timer() - start))
-
-        start = timer()
-        self._layouts_rec(zoomin)
-        callback(0.63, "Layout analysis ({:.2f}s)".format(timer() - start))
+        if self._reuse_layouts(filename if not binary else binary, artifacts, zoomin, from_page, to_page):
+            callback(0.63, "Reused OCR and layouts of a previous parse ({:.2f}s)".format(timer() - start))
+        else:
+            self.__images__(
+                filename if not binary else binary,
+                zoomin,
+                from_page,
+                to_page,
+                callback
+            )
+            callback(msg="OCR finished ({:.2f}s)".format(timer() - start))
+            logging.info("OCR({}~{}): {:.2f}s".format(from_page, to_page, timer() - start))
+
+            start = timer()
+            self._layouts_rec(zoomin)
+            callback(0.63, "Layout analysis ({:.2f}s)".format(timer() - start))
+            self._save_layouts(artifacts, zoomin)
 
         start = timer()
         self._table_transformer_job(zoomin)
@@ -448,6 +453,7 @@ def chunk(filename, binary=None, from_page=0, to_page=100000,
 
         if layout_recognizer == "DeepDOC":
             pdf_parser = Pdf()
+            artifacts = kwargs.get("artifacts")
 
             try:
                 vision_model = LLMBundle(kwargs["tenant_id"], LLMType.IMAGE2TEXT)
@@ -455,8 +461,15 @@ def chunk(filename, binary=None, from_page=0, to_page=100000,
             except Exception:
                 vision_model = None
 
-            if vision_model:
-                sections, tables, figures = pdf_parser(filename if not binary else binary, from_page=from_page, to_page=to_page, callback=callback, separate_tables_figures=True)
+            # Sections only depend on the parsing options, not on how they are merged into chunks.
+            sections_config = {"parser": "naive", "vision_model": vision_model.llm_name if vision_model else "",
+                               **section_config(parser_config)}
+            parsed = artifacts.load("sections", sections_config) if artifacts else None
+            if parsed and pdf_parser._reuse_layouts(filename if not binary else binary, artifacts, 3, from_page, to_page):
+                sections, tables = parsed
+                callback(0.8, "Reused sections of a previous parse.")
+            elif vision_model:
+                sections, tables, figures = pdf_parser(filename if not binary else binary, from_page=from_page, to_page=to_page, callback=callback, separate_tables_figures=True, artifacts=artifacts)
                 callback(0.5, "Basic parsing complete. Proceeding with figure enhancement...")
                 try:
                     pdf_vision_parser = VisionFigureParser(vision_model=vision_model, figures_data=figures, **kwargs)
@@ -466,7 +479,9 @@ def chunk(filename, binary=None, from_page=0, to_page=100000,
                     callback(0.6, f"Visual model error: {e}. Skipping figure parsing enhancement.")
                     tables.extend(figures)
             else:
-                sections, tables = pdf_parser(filename if not binary else binary, from_page=from_page, to_page=to_page, callback=callback)
+                sections, tables = pdf_parser(filename if not binary else binary, from_page=from_page, to_page=to_page, callback=callback, artifacts=artifacts)
+            if artifacts and not parsed:
+                artifacts.save("sections", (sections, tables), sections_config)
 
             res = tokenize_table(tables, doc, is_english)
             callback(0.8, "Finish parsing.")
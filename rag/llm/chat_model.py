@@ -14,6 +14,7 @@
 #  limitations under the License.
 #
 import asyncio
+import functools
 import json
 import logging
 import os
@@ -25,17 +26,19 @@ from copy import deepcopy
 from typing import Any, Protocol
 from urllib.parse import urljoin
 
+import anyio
 import json_repair
 import litellm
 import openai
 import requests
 from ollama import Client
-from openai import OpenAI
+from openai import AsyncOpenAI, OpenAI
 from openai.lib.azure import AzureOpenAI
 from strenum import StrEnum
 from zhipuai import ZhipuAI
 
 from rag.llm import FACTORY_DEFAULT_BASE_URL, LITELLM_PROVIDER_PREFIX, SupportedLiteLLMProvider
+from rag.llm.http_client import async_client, sync_client
 from rag.nlp import is_chinese, is_english
 from rag.utils import num_tokens_from_string
 
@@ -73,7 +76,9 @@ class ToolCallSession(Protocol):
 class Base(ABC):
     def __init__(self, key, model_name, base_url, **kwargs):
         timeout = int(os.environ.get("LM_TIMEOUT_SECONDS", 600))
-        self.client = OpenAI(api_key=key, base_url=base_url, timeout=timeout)
+        self.client = OpenAI(api_key=key, base_url=base_url, timeout=timeout, http_client=sync_client(base_url))
+        # Subclasses may replace the client, with settings async_chat would not know of.
+        self._base_client = self.client
         self.model_name = model_name
         # Configure retry parameters
         self.max_retries = kwargs.get("max_retries", int(os.environ.get("LLM_MAX_RETRIES", 5)))
@@ -119,7 +124,9 @@ class Base(ABC):
         if self.model_name.lower().find("qwen3") >= 0:
             kwargs["extra_body"] = {"enable_thinking": False}
         response = self.client.chat.completions.create(model=self.model_name, messages=history, **gen_conf, **kwargs)
+        return self._response_text(response)
 
+    def _response_text(self, response):
         if any([not response.choices, not response.choices[0].message, not response.choices[0].message.content]):
             return "", 0
         ans = response.choices[0].message.content.strip()
@@ -129,40 +136,44 @@ class Base(ABC):
 
     def _chat_streamly(self, history, gen_conf, **kwargs):
         logging.info("[HISTORY STREAMLY]" + json.dumps(history, ensure_ascii=False, indent=4))
-        reasoning_start = False
+        reasoning = [False]
         response = self.client.chat.completions.create(model=self.model_name, messages=history, stream=True, **gen_conf, stop=kwargs.get("stop"))
         for resp in response:
-            if not resp.choices:
-                continue
-            if not resp.choices[0].delta.content:
-                resp.choices[0].delta.content = ""
-            if kwargs.get("with_reasoning", True) and hasattr(resp.choices[0].delta, "reasoning_content") and resp.choices[0].delta.reasoning_content:
-                ans = ""
-                if not reasoning_start:
-                    reasoning_start = True
-                    ans = "<think>"
-                ans += resp.choices[0].delta.reasoning_content + "</think>"
-            else:
-                reasoning_start = False
-                ans = resp.choices[0].delta.content
+            if resp.choices:
+                yield self._delta_text(resp, reasoning, kwargs.get("with_reasoning", True))
+
+    def _delta_text(self, resp, reasoning, with_reasoning=True):
+        """The text and token count of a streamed chunk; `reasoning[0]` tells whether the chunks are in a reasoning part."""
+        if not resp.choices[0].delta.content:
+            resp.choices[0].delta.content = ""
+        if with_reasoning and hasattr(resp.choices[0].delta, "reasoning_content") and resp.choices[0].delta.reasoning_content:
+            ans = ""
+            if not reasoning[0]:
+                reasoning[0] = True
+                ans = "<think>"
+            ans += resp.choices[0].delta.reasoning_content + "</think>"
+        else:
+            reasoning[0] = False
+            ans = resp.choices[0].delta.content
 
-            tol = self.total_token_count(resp)
-            if not tol:
-                tol = num_tokens_from_string(resp.choices[0].delta.content)
+        tol = self.total_token_count(resp)
+        if not tol:
+            tol = num_tokens_from_string(resp.choices[0].delta.content)
 
-            if resp.choices[0].finish_reason == "length":
-                if is_chinese(ans):
-                    ans += LENGTH_NOTIFICATION_CN
-                else:
-                    ans += LENGTH_NOTIFICATION_EN
-            yield ans, tol
+        if resp.choices[0].finish_reason == "length":
+            if is_chinese(ans):
+                ans += LENGTH_NOTIFICATION_CN
+            else:
+                ans += LENGTH_NOTIFICATION_EN
+        return ans, tol
 
     def _length_stop(self, ans):
         if is_chinese([ans]):
             return ans + LENGTH_NOTIFICATION_CN
         return ans + LENGTH_NOTIFICATION_EN
 
-    def _exceptions(self, e, attempt):
+    def _retry_delay(self, e, attempt):
+        """The error message to give up with, or None and the delay before the next attempt."""
         logging.exception("OpenAI chat_with_tools")
         # Classify the error
         error_code = self._classify_error(e)
@@ -172,10 +183,16 @@ class Base(ABC):
         # Check if it's a rate limit error or server error and not the last attempt
         should_retry = error_code == LLMErrorCode.ERROR_RATE_LIMIT or error_code == LLMErrorCode.ERROR_SERVER
         if not should_retry:
-            return f"{ERROR_PREFIX}: {error_code} - {str(e)}"
+            return f"{ERROR_PREFIX}: {error_code} - {str(e)}", 0
 
         delay = self._get_delay()
         logging.warning(f"Error: {error_code}. Retrying in {delay:.2f} seconds... (Attempt {attempt + 1}/{self.max_retries})")
+        return None, delay
+
+    def _exceptions(self, e, attempt):
+        error, delay = self._retry_delay(e, attempt)
+        if error:
+            return error
         time.sleep(delay)
 
     def _verbose_tool_use(self, name, args, res):
@@ -416,6 +433,71 @@ class Base(ABC):
 
         yield total_tokens
 
+    def _async_native(self, *methods):
+        # Only the plain OpenAI protocol, as Base speaks it with the client it made, has requests of its own on the event loop.
+        return self.client is getattr(self, "_base_client", None) and type(self.client) is OpenAI and all(getattr(type(self), m) is getattr(Base, m) for m in methods)
+
+    def _async_client(self):
+        base_url = str(self.client.base_url)
+        return AsyncOpenAI(api_key=self.client.api_key, base_url=base_url, timeout=self.client.timeout, http_client=async_client(base_url))
+
+    async def _async_chat(self, history, gen_conf, **kwargs):
+        logging.info("[HISTORY]" + json.dumps(history, ensure_ascii=False, indent=2))
+        if self.model_name.lower().find("qwen3") >= 0:
+            kwargs["extra_body"] = {"enable_thinking": False}
+        response = await self._async_client().chat.completions.create(model=self.model_name, messages=history, **gen_conf, **kwargs)
+        return self._response_text(response)
+
+    async def async_chat(self, system, history, gen_conf={}, **kwargs):
+        """
+        `chat` awaiting the response on the running event loop (asyncio or trio) instead of holding
+        a thread. Providers with a client or protocol of their own run `chat` in a worker thread.
+        """
+        if not self._async_native("chat", "_chat"):
+            return await anyio.to_thread.run_sync(functools.partial(self.chat, system, history, gen_conf, **kwargs))
+        if system:
+            history.insert(0, {"role": "system", "content": system})
+        gen_conf = self._clean_conf(gen_conf)
+
+        for attempt in range(self.max_retries + 1):
+            try:
+                return await self._async_chat(history, gen_conf, **kwargs)
+            except Exception as e:
+                error, delay = self._retry_delay(e, attempt)
+                if error:
+                    return error, 0
+                await anyio.sleep(delay)
+        assert False, "Shouldn't be here."
+
+    async def async_chat_streamly(self, system, history, gen_conf: dict = {}, **kwargs):
+        """`chat_streamly` as an async generator, awaiting the chunks on the running event loop."""
+        if not self._async_native("chat_streamly", "_chat_streamly"):
+            stream = self.chat_streamly(system, history, gen_conf, **kwargs)
+            done = object()
+            while (txt := await anyio.to_thread.run_sync(next, stream, done)) is not done:
+                yield txt
+            return
+        if system:
+            history.insert(0, {"role": "system", "content": system})
+        gen_conf = self._clean_conf(gen_conf)
+        ans = ""
+        total_tokens = 0
+        reasoning = [False]
+        try:
+            logging.info("[HISTORY STREAMLY]" + json.dumps(history, ensure_ascii=False, indent=4))
+            response = await self._async_client().chat.completions.create(model=self.model_name, messages=history, stream=True, **gen_conf,
+                                                                          stop=kwargs.get("stop"))
+            async for resp in response:
+                if not resp.choices:
+                    continue
+                delta_ans, tol = self._delta_text(resp, reasoning, kwargs.get("with_reasoning", True))
+                yield delta_ans
+                total_tokens += tol
+        except openai.APIError as e:
+            yield ans + "\n**ERROR**: " + str(e)
+
+        yield total_tokens
+
     def total_token_count(self, resp):
         try:
             return resp.usage.total_tokens
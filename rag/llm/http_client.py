@@ -0,0 +1,89 @@
+#
+#  Copyright 2025 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+"""
+HTTP clients shared by the LLM providers, one per base URL.
+
+All the model instances of a provider endpoint send their requests through the same
+bounded pool of keep-alive connections, multiplexed over HTTP/2 when the server and
+the `h2` package allow it, instead of a client with its own connections per instance.
+Async clients are bound to the event loop (asyncio or trio) they are first used in,
+so there is one per base URL and loop.
+"""
+
+import logging
+import os
+import threading
+import weakref
+
+import httpx
+import sniffio
+
+try:
+    import h2  # noqa: F401
+
+    HTTP2 = int(os.environ.get("LLM_HTTP2", 1)) > 0
+except ImportError:
+    HTTP2 = False
+
+LLM_HTTP_MAX_CONNECTIONS = int(os.environ.get("LLM_HTTP_MAX_CONNECTIONS", 64))
+LLM_HTTP_MAX_KEEPALIVE = int(os.environ.get("LLM_HTTP_MAX_KEEPALIVE", 16))
+LM_TIMEOUT_SECONDS = int(os.environ.get("LM_TIMEOUT_SECONDS", 600))
+
+_sync_clients = {}
+_async_clients = weakref.WeakKeyDictionary()
+_lock = threading.Lock()
+
+
+def _client_args():
+    return {
+        "http2": HTTP2,
+        "limits": httpx.Limits(max_connections=LLM_HTTP_MAX_CONNECTIONS, max_keepalive_connections=LLM_HTTP_MAX_KEEPALIVE),
+        "timeout": httpx.Timeout(LM_TIMEOUT_SECONDS, connect=10),
+        "follow_redirects": True,
+    }
+
+
+def sync_client(base_url: str | None) -> httpx.Client:
+    """The client shared by the blocking requests to `base_url`."""
+    with _lock:
+        client = _sync_clients.get(base_url)
+        if client is None:
+            client = httpx.Client(**_client_args())
+            _sync_clients[base_url] = client
+            logging.debug(f"http_client: new client for {base_url}, http2={HTTP2}")
+        return client
+
+
+def _current_loop():
+    if sniffio.current_async_library() == "trio":
+        import trio
+
+        return trio.lowlevel.current_trio_token()
+    import asyncio
+
+    return asyncio.get_running_loop()
+
+
+def async_client(base_url: str | None) -> httpx.AsyncClient:
+    """The client shared by the requests to `base_url` from the running event loop."""
+    loop = _current_loop()
+    with _lock:
+        clients = _async_clients.setdefault(loop, {})
+        client = clients.get(base_url)
+        if client is None:
+            client = httpx.AsyncClient(**_client_args())
+            clients[base_url] = client
+        return client
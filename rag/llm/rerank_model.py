@@ -33,6 +33,9 @@ from api.utils.log_utils import log_exception
 from rag.utils import num_tokens_from_string, truncate
 
 class Base(ABC):
+    # The score of a text doesn't depend on the other texts scored with it, so it can be cached.
+    absolute_scores = True
+
     def __init__(self, key, model_name, **kwargs):
         """
         Abstract base class constructor.
@@ -59,6 +62,7 @@ class DefaultRerank(Base):
     _FACTORY_NAME = "BAAI"
     _model = None
     _model_lock = threading.Lock()
+    _batch_size = 4096
 
     def __init__(self, key, model_name, **kwargs):
         """
@@ -139,14 +143,20 @@ class DefaultRerank(Base):
             scores = [scores]
         return scores
 
+    @property
+    def max_length(self):
+        """Tokens of a text the model scores."""
+        return 2048
+
+    def score_pairs(self, pairs):
+        return np.array(self._process_batch(pairs, max_batch_size=self._batch_size))
+
     def similarity(self, query: str, texts: list):
-        pairs = [(query, truncate(t, 2048)) for t in texts]
+        pairs = [(query, truncate(t, self.max_length)) for t in texts]
         token_count = 0
         for _, t in pairs:
             token_count += num_tokens_from_string(t)
-        batch_size = 4096
-        res = self._process_batch(pairs, max_batch_size=batch_size)
-        return np.array(res), token_count
+        return self.score_pairs(pairs), token_count
 
 
 class JinaRerank(Base):
@@ -174,6 +184,7 @@ class YoudaoRerank(DefaultRerank):
     _FACTORY_NAME = "Youdao"
     _model = None
     _model_lock = threading.Lock()
+    _batch_size = 8
 
     def __init__(self, key=None, model_name="maidalun1020/bce-reranker-base_v1", **kwargs):
         if not settings.LIGHTEN and not YoudaoRerank._model:
@@ -190,14 +201,9 @@ class YoudaoRerank(DefaultRerank):
         self._dynamic_batch_size = 8
         self._min_batch_size = 1
 
-    def similarity(self, query: str, texts: list):
-        pairs = [(query, truncate(t, self._model.max_length)) for t in texts]
-        token_count = 0
-        for _, t in pairs:
-            token_count += num_tokens_from_string(t)
-        batch_size = 8
-        res = self._process_batch(pairs, max_batch_size=batch_size)
-        return np.array(res), token_count
+    @property
+    def max_length(self):
+        return self._model.max_length
 
 
 class XInferenceRerank(Base):
@@ -234,6 +240,8 @@ class XInferenceRerank(Base):
 
 class LocalAIRerank(Base):
     _FACTORY_NAME = "LocalAI"
+    # Scores are min-max normalised over the texts of a call.
+    absolute_scores = False
 
     def __init__(self, key, model_name, base_url):
         if base_url.find("/rerank") == -1:
@@ -328,6 +336,8 @@ class LmStudioRerank(Base):
 
 class OpenAI_APIRerank(Base):
     _FACTORY_NAME = "OpenAI-API-Compatible"
+    # Scores are min-max normalised over the texts of a call.
+    absolute_scores = False
 
     def __init__(self, key, model_name, base_url):
         if base_url.find("/rerank") == -1:
@@ -0,0 +1,183 @@
+#
+#  Copyright 2025 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+"""
+Scoring of rerank candidates shared by the requests of a process.
+
+Candidate texts are truncated to RERANK_MAX_TOKENS once, when they are collected
+(`fit_texts`). Their scores are cached in Redis for RERANK_CACHE_TTL seconds per
+model and query, by chunk id and text, so only the candidates not scored recently
+are sent to the model; except for the models normalising their scores over the
+texts of a call, whose scores can't be mixed across calls. The requests to a model running in this process are
+coalesced: the (query, text) pairs arriving within RERANK_BATCH_WINDOW_MS of each
+other are scored in one batch, up to RERANK_BATCH_MAX_PAIRS pairs.
+"""
+
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import numpy as np
+import xxhash
+
+from rag.llm.rerank_model import DefaultRerank
+from rag.utils import encoder
+from rag.utils.redis_conn import REDIS_CONN
+
+RERANK_MAX_TOKENS = int(os.environ.get("RERANK_MAX_TOKENS", 2048))
+RERANK_CACHE_TTL = int(os.environ.get("RERANK_CACHE_TTL", 300))
+RERANK_BATCH_WINDOW_MS = float(os.environ.get("RERANK_BATCH_WINDOW_MS", 5))
+RERANK_BATCH_MAX_PAIRS = int(os.environ.get("RERANK_BATCH_MAX_PAIRS", 256))
+
+_batchers = {}
+_lock = threading.Lock()
+
+
+def fit_texts(texts: list[str], max_tokens: int = RERANK_MAX_TOKENS) -> tuple[list[str], list[int]]:
+    """The texts truncated to `max_tokens`, encoding each of them once, and their token counts."""
+    fitted, counts = [], []
+    for t in texts:
+        tokens = encoder.encode(t)
+        if len(tokens) > max_tokens:
+            tokens = tokens[:max_tokens]
+            t = encoder.decode(tokens)
+        fitted.append(t)
+        counts.append(len(tokens))
+    return fitted, counts
+
+
+class _Batcher:
+    """Scores the pairs of the concurrent requests to a local model in shared batches, from one thread."""
+
+    def __init__(self, mdl: DefaultRerank):
+        self._mdl = mdl
+        self._queue = queue.Queue()
+        threading.Thread(target=self._run, name=f"rerank-batcher-{type(mdl).__name__}", daemon=True).start()
+
+    def score(self, pairs: list[tuple[str, str]]) -> np.ndarray:
+        future = Future()
+        self._queue.put((pairs, future))
+        return future.result()
+
+    def _collect(self):
+        requests = [self._queue.get()]
+        size = len(requests[0][0])
+        deadline = time.monotonic() + RERANK_BATCH_WINDOW_MS / 1000
+        while size < RERANK_BATCH_MAX_PAIRS:
+            wait = deadline - time.monotonic()
+            if wait <= 0:
+                break
+            try:
+                requests.append(self._queue.get(timeout=wait))
+            except queue.Empty:
+                break
+            size += len(requests[-1][0])
+        return requests
+
+    def _run(self):
+        while True:
+            requests = self._collect()
+            try:
+                scores = self._mdl.score_pairs([p for pairs, _ in requests for p in pairs])
+            except Exception as e:
+                for _, future in requests:
+                    future.set_exception(e)
+                continue
+            i = 0
+            for pairs, future in requests:
+                future.set_result(scores[i:i + len(pairs)])
+                i += len(pairs)
+            if len(requests) > 1:
+                logging.debug(f"rerank batcher: {len(requests)} requests scored in one batch of {i} pairs")
+
+
+def _batcher(mdl):
+    # Only the models scoring in this process, with the pairs as DefaultRerank makes them.
+    if RERANK_BATCH_WINDOW_MS <= 0 or not isinstance(mdl, DefaultRerank) or type(mdl).similarity is not DefaultRerank.similarity:
+        return None
+    # The instances of a model class share its weights, and so its batcher.
+    k = (type(mdl), id(mdl._model))
+    with _lock:
+        if k not in _batchers:
+            _batchers[k] = _Batcher(mdl)
+        return _batchers[k]
+
+
+def score(mdl, query: str, texts: list[str], token_counts: list[int]) -> tuple[np.ndarray, int]:
+    """
+    `mdl.similarity` of texts fitted by `fit_texts`, with their token counts; batched with the
+    concurrent requests when the model runs in this process.
+    """
+    batcher = _batcher(mdl)
+    if batcher is None:
+        return mdl.similarity(query, texts)
+    if mdl.max_length < RERANK_MAX_TOKENS:
+        texts, token_counts = fit_texts(texts, mdl.max_length)
+    return np.array(batcher.score([(query, t) for t in texts])), sum(token_counts)
+
+
+def _cache_key(tenant_id, llm_name, query):
+    return f"rerank_cache:{tenant_id}:{llm_name}:{xxhash.xxh64(query.encode('utf-8')).hexdigest()}"
+
+
+def _cache_fields(ids, texts):
+    return [f"{i}:{xxhash.xxh64(t.encode('utf-8')).hexdigest()}" for i, t in zip(ids, texts)]
+
+
+def cached_scores(tenant_id, llm_name, query: str, ids: list, texts: list[str]) -> list[float | None]:
+    """The scores cached for the chunks with these ids and texts, None for those not scored recently."""
+    if RERANK_CACHE_TTL <= 0 or not ids:
+        return [None] * len(texts)
+    try:
+        values = REDIS_CONN.REDIS.hmget(_cache_key(tenant_id, llm_name, query), _cache_fields(ids, texts))
+    except Exception:
+        logging.exception("rerank_service.cached_scores")
+        return [None] * len(texts)
+    return [float(v) if v is not None else None for v in values]
+
+
+def cache_scores(tenant_id, llm_name, query: str, ids: list, texts: list[str], scores):
+    if RERANK_CACHE_TTL <= 0 or not ids:
+        return
+    k = _cache_key(tenant_id, llm_name, query)
+    try:
+        pipeline = REDIS_CONN.REDIS.pipeline(transaction=False)
+        pipeline.hset(k, mapping={f: str(float(s)) for f, s in zip(_cache_fields(ids, texts), scores)})
+        pipeline.expire(k, RERANK_CACHE_TTL)
+        pipeline.execute()
+    except Exception:
+        logging.exception("rerank_service.cache_scores")
+
+
+def similarity(mdl, tenant_id, llm_name, query: str, texts: list[str], ids: list | None = None) -> tuple[np.ndarray, int]:
+    """
+    Scores of `texts` against `query`, truncated to RERANK_MAX_TOKENS, and the tokens used. With the
+    chunk `ids` of the texts, the scores cached for them are reused and only the others are scored,
+    if the model's scores are absolute.
+    """
+    texts, token_counts = fit_texts(texts)
+    if ids is None or not getattr(mdl, "absolute_scores", True):
+        return score(mdl, query, texts, token_counts)
+    sim = np.array(cached_scores(tenant_id, llm_name, query, ids, texts), dtype=float)
+    todo = [i for i in range(len(texts)) if np.isnan(sim[i])]
+    used_tokens = 0
+    if todo:
+        scores, used_tokens = score(mdl, query, [texts[i] for i in todo], [token_counts[i] for i in todo])
+        sim[todo] = scores
+        cache_scores(tenant_id, llm_name, query, [ids[i] for i in todo], [texts[i] for i in todo], scores)
+    return sim, used_tokens
@@ -17,6 +17,7 @@ import logging
 import re
 import math
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 
 from rag.settings import TAG_FLD, PAGERANK_FLD
@@ -29,6 +30,37 @@ from rag.utils.doc_store_conn import DocStoreConnection, MatchDenseExpr, FusionE
 def index_name(uid): return f"ragflow_{uid}"
 
 
+SENTENCE_END = r"([^\|][；。？!！\n]|[a-z][.?;!][ \n])"
+
+
+def split_answer(answer: str) -> list[str]:
+    """The pieces of an answer citations are put after: sentences, and code blocks kept whole."""
+    pieces = re.split(r"(```)", answer)
+    if len(pieces) >= 3:
+        i = 0
+        pieces_ = []
+        while i < len(pieces):
+            if pieces[i] == "```":
+                st = i
+                i += 1
+                while i < len(pieces) and pieces[i] != "```":
+                    i += 1
+                if i < len(pieces):
+                    i += 1
+                pieces_.append("".join(pieces[st: i]) + "\n")
+            else:
+                pieces_.extend(re.split(SENTENCE_END, pieces[i]))
+                i += 1
+        pieces = pieces_
+    else:
+        pieces = re.split(SENTENCE_END, answer)
+    for i in range(1, len(pieces)):
+        if re.match(SENTENCE_END, pieces[i]):
+            pieces[i - 1] += pieces[i][0]
+            pieces[i] = pieces[i][1:]
+    return pieces
+
+
 class Dealer:
     def __init__(self, dataStore: DocStoreConnection):
         self.qryr = query.FulltextQueryer()
@@ -160,94 +192,14 @@ class Dealer:
     def trans2floats(txt):
         return [get_float(t) for t in txt.split("\t")]
 
+    def citation_stream(self, chunks, chunk_v, embd_mdl, tkweight=0.1, vtweight=0.9):
+        """A `CitationStream` citing `chunks` (their `content_ltks`) and `chunk_v` (their vectors)."""
+        return CitationStream(self.qryr, chunks, chunk_v, embd_mdl, tkweight, vtweight)
+
     def insert_citations(self, answer, chunks, chunk_v,
                          embd_mdl, tkweight=0.1, vtweight=0.9):
         assert len(chunks) == len(chunk_v)
-        if not chunks:
-            return answer, set([])
-        pieces = re.split(r"(```)", answer)
-        if len(pieces) >= 3:
-            i = 0
-            pieces_ = []
-            while i < len(pieces):
-                if pieces[i] == "```":
-                    st = i
-                    i += 1
-                    while i < len(pieces) and pieces[i] != "```":
-                        i += 1
-                    if i < len(pieces):
-                        i += 1
-                    pieces_.append("".join(pieces[st: i]) + "\n")
-                else:
-                    pieces_.extend(
-                        re.split(
-                            r"([^\|][；。？!！\n]|[a-z][.?;!][ \n])",
-                            pieces[i]))
-                    i += 1
-            pieces = pieces_
-        else:
-            pieces = re.split(r"([^\|][；。？!！\n]|[a-z][.?;!][ \n])", answer)
-        for i in range(1, len(pieces)):
-            if re.match(r"([^\|][；。？!！\n]|[a-z][.?;!][ \n])", pieces[i]):
-                pieces[i - 1] += pieces[i][0]
-                pieces[i] = pieces[i][1:]
-        idx = []
-        pieces_ = []
-        for i, t in enumerate(pieces):
-            if len(t) < 5:
-                continue
-            idx.append(i)
-            pieces_.append(t)
-        logging.debug("{} => {}".format(answer, pieces_))
-        if not pieces_:
-            return answer, set([])
-
-        ans_v, _ = embd_mdl.encode(pieces_)
-        for i in range(len(chunk_v)):
-            if len(ans_v[0]) != len(chunk_v[i]):
-                chunk_v[i] = [0.0]*len(ans_v[0])
-                logging.warning("The dimension of query and chunk do not match: {} vs. {}".format(len(ans_v[0]), len(chunk_v[i])))
-
-        assert len(ans_v[0]) == len(chunk_v[0]), "The dimension of query and chunk do not match: {} vs. {}".format(
-            len(ans_v[0]), len(chunk_v[0]))
-
-        chunks_tks = [rag_tokenizer.tokenize(self.qryr.rmWWW(ck)).split()
-                      for ck in chunks]
-        cites = {}
-        thr = 0.63
-        while thr > 0.3 and len(cites.keys()) == 0 and pieces_ and chunks_tks:
-            for i, a in enumerate(pieces_):
-                sim, tksim, vtsim = self.qryr.hybrid_similarity(ans_v[i],
-                                                                chunk_v,
-                                                                rag_tokenizer.tokenize(
-                                                                    self.qryr.rmWWW(pieces_[i])).split(),
-                                                                chunks_tks,
-                                                                tkweight, vtweight)
-                mx = np.max(sim) * 0.99
-                logging.debug("{} SIM: {}".format(pieces_[i], mx))
-                if mx < thr:
-                    continue
-                cites[idx[i]] = list(
-                    set([str(ii) for ii in range(len(chunk_v)) if sim[ii] > mx]))[:4]
-            thr *= 0.8
-
-        res = ""
-        seted = set([])
-        for i, p in enumerate(pieces):
-            res += p
-            if i not in idx:
-                continue
-            if i not in cites:
-                continue
-            for c in cites[i]:
-                assert int(c) < len(chunk_v)
-            for c in cites[i]:
-                if c in seted:
-                    continue
-                res += f" [ID:{c}]"
-                seted.add(c)
-
-        return res, seted
+        return self.citation_stream(chunks, chunk_v, embd_mdl, tkweight, vtweight).finish(answer)
 
     def _rank_feature_scores(self, query_rfea, search_res):
         ## For rank feature(tag_fea) scores.
@@ -332,7 +284,7 @@ class Dealer:
             ins_tw.append(tks)
 
         tksim = self.qryr.token_similarity(keywords, ins_tw)
-        vtsim, _ = rerank_mdl.similarity(query, [rmSpace(" ".join(tks)) for tks in ins_tw])
+        vtsim, _ = rerank_mdl.similarity(query, [rmSpace(" ".join(tks)) for tks in ins_tw], ids=sres.ids)
         ## For rank feature(tag_fea) scores.
         rank_fea = self._rank_feature_scores(rank_feature, sres)
 
@@ -499,3 +451,151 @@ class Dealer:
         tag_fea = sorted([(a, round(0.1*(c + 1) / (cnt + S) / max(1e-6, all_tags.get(a, 0.0001)))) for a, c in aggs],
                          key=lambda x: x[1] * -1)[:topn_tags]
         return {a.replace(".", "_"): max(1, c) for a, c in tag_fea}
+
+
+class CitationStream:
+    """
+    Citations of an answer inserted while it is generated. Feed `update` the answer so
+    far: the sentences completed since the last call are embedded together in the
+    background and scored against all the chunks at once, and the answer is returned
+    with the citations known yet. `finish` takes the whole answer and waits for all of them.
+
+    A sentence cites the chunks within 1% of its best hybrid similarity if that is at
+    least THRESHOLD; when no sentence of the answer gets there, the threshold is lowered
+    for all of them, as many times as needed down to 0.3.
+    """
+
+    THRESHOLD = 0.63
+
+    def __init__(self, qryr, chunks: list[str], chunk_v: list, embd_mdl, tkweight=0.1, vtweight=0.9):
+        assert len(chunks) == len(chunk_v)
+        self.qryr = qryr
+        self.embd_mdl = embd_mdl
+        self.tkweight = tkweight
+        self.vtweight = vtweight
+        self.chunk_v = chunk_v
+        self._chunk_mat = None
+        # The chunks are tokenized once; only which tokens they have counts for the token similarity.
+        self._vocab = {}
+        chunk_tks = [set(rag_tokenizer.tokenize(qryr.rmWWW(ck)).split()) for ck in chunks]
+        for tks in chunk_tks:
+            for t in tks:
+                self._vocab.setdefault(t, len(self._vocab))
+        self._has_token = np.zeros((len(chunks), len(self._vocab)), dtype=np.float64)
+        for i, tks in enumerate(chunk_tks):
+            self._has_token[i, [self._vocab[t] for t in tks]] = 1.
+
+        self._pieces = []
+        self._consumed = ""
+        self._sims = {}
+        self._cites = {}
+        self._jobs = []
+        self._executor = None
+        self._disabled = not chunks
+
+    def _chunk_matrix(self, dim):
+        if self._chunk_mat is None:
+            vecs = []
+            for v in self.chunk_v:
+                if len(v) != dim:
+                    logging.warning("The dimension of query and chunk do not match: {} vs. {}".format(dim, len(v)))
+                    v = [0.0] * dim
+                vecs.append(v)
+            self._chunk_mat = self._normalized(np.array(vecs, dtype=np.float64))
+        return self._chunk_mat
+
+    @staticmethod
+    def _normalized(mat):
+        norms = np.linalg.norm(mat, axis=1, keepdims=True)
+        return mat / np.where(norms == 0, 1, norms)
+
+    def _score(self, idx: list[int]):
+        texts = [self._pieces[i] for i in idx]
+        ans_v, _ = self.embd_mdl.encode(texts)
+        ans_v = np.array(ans_v, dtype=np.float64)
+        vtsim = self._normalized(ans_v) @ self._chunk_matrix(ans_v.shape[1]).T
+
+        weights = np.zeros((len(texts), len(self._vocab)), dtype=np.float64)
+        totals = np.zeros(len(texts), dtype=np.float64)
+        for r, t in enumerate(texts):
+            for tk, w in self.qryr.tw.weights(rag_tokenizer.tokenize(self.qryr.rmWWW(t)).split(), preprocess=False):
+                totals[r] += w
+                if tk in self._vocab:
+                    weights[r, self._vocab[tk]] += w
+        tksim = (weights @ self._has_token.T + 1e-9) / (totals[:, None] + 1e-9)
+
+        sims = np.where(vtsim.sum(axis=1, keepdims=True) == 0, tksim, vtsim * self.vtweight + tksim * self.tkweight)
+        for i, sim in zip(idx, sims):
+            self._sims[i] = sim
+            cites = self._cite(sim, self.THRESHOLD)
+            if cites:
+                self._cites[i] = cites
+
+    @staticmethod
+    def _cite(sim, thr) -> list[str]:
+        mx = np.max(sim) * 0.99
+        if mx < thr:
+            return []
+        best = np.argsort(-sim)
+        return [str(ii) for ii in best[sim[best] > mx][:4]]
+
+    def _commit(self, answer: str, final: bool) -> list[int]:
+        """Split the new part of the answer, keep its complete pieces, and return those to score."""
+        pieces = split_answer(answer[len(self._consumed):])
+        if not final:
+            pieces = pieces[:-1]
+        idx = []
+        consumed = len(self._consumed)
+        for p in pieces:
+            if len(p) >= 5:
+                idx.append(len(self._pieces))
+            self._pieces.append(p)
+            # Code blocks are given a trailing line break.
+            consumed += len(p) - (1 if p.startswith("```") else 0)
+        self._consumed = answer[:consumed]
+        return idx
+
+    def _render(self, answer: str) -> tuple[str, set]:
+        res = ""
+        seted = set([])
+        for i, p in enumerate(self._pieces):
+            res += p
+            for c in self._cites.get(i, []):
+                if c in seted:
+                    continue
+                res += f" [ID:{c}]"
+                seted.add(c)
+        return res + answer[len(self._consumed):], seted
+
+    def update(self, answer: str) -> str:
+        if self._disabled or re.search(r"\[ID:([0-9]+)\]", answer) or not answer.startswith(self._consumed):
+            return answer
+        idx = self._commit(answer, False)
+        if idx:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=1)
+            self._jobs.append(self._executor.submit(self._score, idx))
+        return self._render(answer)[0]
+
+    def finish(self, answer: str) -> tuple[str, set]:
+        if self._disabled:
+            return answer, set([])
+        for job in self._jobs:
+            job.result()
+        if self._executor:
+            self._executor.shutdown(wait=False)
+        if not answer.startswith(self._consumed):
+            self._pieces, self._consumed, self._sims, self._cites = [], "", {}, {}
+        idx = self._commit(answer, True)
+        if idx:
+            self._score(idx)
+        logging.debug("{} => {}".format(answer, self._pieces))
+
+        thr = self.THRESHOLD * 0.8
+        while thr > 0.3 and not self._cites and self._sims:
+            for i, sim in self._sims.items():
+                cites = self._cite(sim, thr)
+                if cites:
+                    self._cites[i] = cites
+            thr *= 0.8
+        return self._render(answer)
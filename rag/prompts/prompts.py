@@ -16,11 +16,15 @@
 import datetime
 import json
 import logging
+import os
 import re
+import threading
+from collections import OrderedDict
 from copy import deepcopy
 from typing import Tuple
 import jinja2
 import json_repair
+import xxhash
 from api.utils import hash_str2int
 from rag.prompts.prompt_template import load_prompt
 from rag.settings import TAG_FLD
@@ -31,10 +35,43 @@ STOP_TOKEN="<|STOP|>"
 COMPLETE_TASK="complete_task"
 
 
+# Token counts of the texts counted lately (messages, chunks), by hash.
+TOKEN_COUNT_CACHE_SIZE = int(os.environ.get("TOKEN_COUNT_CACHE_SIZE", 8192))
+_token_counts = OrderedDict()
+_token_counts_lock = threading.Lock()
+
+
 def get_value(d, k1, k2):
     return d.get(k1, d.get(k2))
 
 
+def _token_count_key(text):
+    return xxhash.xxh64(text.encode("utf-8", "surrogatepass")).hexdigest(), len(text)
+
+
+def remember_token_count(text: str, count: int):
+    """Seed the token count of a text, e.g. with the one stored along with it."""
+    with _token_counts_lock:
+        _token_counts[_token_count_key(text)] = count
+        while len(_token_counts) > TOKEN_COUNT_CACHE_SIZE:
+            _token_counts.popitem(last=False)
+
+
+def count_tokens(text: str) -> int:
+    """num_tokens_from_string, counted once for the texts seen lately."""
+    if not text:
+        return 0
+    key = _token_count_key(text)
+    with _token_counts_lock:
+        count = _token_counts.get(key)
+        if count is not None:
+            _token_counts.move_to_end(key)
+            return count
+    count = num_tokens_from_string(text)
+    remember_token_count(text, count)
+    return count
+
+
 def chunks_format(reference):
 
     return [
@@ -56,41 +93,56 @@ def chunks_format(reference):
     ]
 
 
-def message_fit_in(msg, max_length=4000):
-    def count():
-        nonlocal msg
-        tks_cnts = []
-        for m in msg:
-            tks_cnts.append({"role": m["role"], "count": num_tokens_from_string(m["content"])})
-        total = 0
-        for m in tks_cnts:
-            total += m["count"]
-        return total
-
-    c = count()
-    if c < max_length:
-        return c, msg
-
-    msg_ = [m for m in msg if m["role"] == "system"]
-    if len(msg) > 1:
-        msg_.append(msg[-1])
-    msg = msg_
-    c = count()
-    if c < max_length:
-        return c, msg
+def fit_history(msg, max_length=4000):
+    """
+    The token count and messages of `msg` fitting in `max_length` tokens, and the messages
+    left out: the system messages, the last message, and the other messages from the newest
+    back as long as they fit, starting with a user message. When even the system and last
+    messages do not fit, the longer of them is truncated.
+    """
+    counts = [count_tokens(m["content"]) for m in msg]
+    total = sum(counts)
+    if total < max_length:
+        return total, msg, []
+
+    system = [i for i, m in enumerate(msg) if m["role"] == "system"]
+    last = len(msg) - 1 if len(msg) > 1 else None
+    used = sum(counts[i] for i in system) + (counts[last] if last is not None else 0)
+    history = []
+    for i in range(len(msg) - 2, -1, -1):
+        if msg[i]["role"] == "system":
+            continue
+        if used + counts[i] >= max_length:
+            break
+        used += counts[i]
+        history.append(i)
+    history.reverse()
+    while history and msg[history[0]]["role"] != "user":
+        used -= counts[history.pop(0)]
+    kept = sorted(system + history + ([last] if last is not None else []))
+    evicted = [m for i, m in enumerate(msg) if i not in set(kept)]
+    msg_ = [msg[i] for i in kept]
+    if used < max_length:
+        return used, msg_, evicted
 
-    ll = num_tokens_from_string(msg_[0]["content"])
-    ll2 = num_tokens_from_string(msg_[-1]["content"])
+    msg = msg_
+    ll = count_tokens(msg_[0]["content"])
+    ll2 = count_tokens(msg_[-1]["content"])
     if ll / (ll + ll2) > 0.8:
         m = msg_[0]["content"]
         m = encoder.decode(encoder.encode(m)[: max_length - ll2])
         msg[0]["content"] = m
-        return max_length, msg
+        return max_length, msg, evicted
 
     m = msg_[-1]["content"]
     m = encoder.decode(encoder.encode(m)[: max_length - ll2])
     msg[-1]["content"] = m
-    return max_length, msg
+    return max_length, msg, evicted
+
+
+def message_fit_in(msg, max_length=4000):
+    c, msg, _ = fit_history(msg, max_length)
+    return c, msg
 
 
 def kb_prompt(kbinfos, max_tokens, hash_id=False):
@@ -103,15 +155,15 @@ def kb_prompt(kbinfos, max_tokens, hash_id=False):
     for i, c in enumerate(knowledges):
         if not c:
             continue
-        used_token_count += num_tokens_from_string(c)
+        used_token_count += count_tokens(c)
         chunks_num += 1
         if max_tokens * 0.97 < used_token_count:
             knowledges = knowledges[:i]
             logging.warning(f"Not all the retrieval into prompt: {len(knowledges)}/{kwlg_len}")
             break
 
-    docs = DocumentService.get_by_ids([get_value(ck, "doc_id", "document_id") for ck in kbinfos["chunks"][:chunks_num]])
-    docs = {d.id: d.meta_fields for d in docs}
+    docs = DocumentService.get_meta_fields([(get_value(ck, "doc_id", "document_id"), get_value(ck, "kb_id", "dataset_id"))
+                                            for ck in kbinfos["chunks"][:chunks_num]])
 
     def draw_node(k, line):
         if not line:
@@ -139,7 +191,10 @@ CROSS_LANGUAGES_SYS_PROMPT_TEMPLATE = load_prompt("cross_languages_sys_prompt")
 CROSS_LANGUAGES_USER_PROMPT_TEMPLATE = load_prompt("cross_languages_user_prompt")
 FULL_QUESTION_PROMPT_TEMPLATE = load_prompt("full_question_prompt")
 KEYWORD_PROMPT_TEMPLATE = load_prompt("keyword_prompt")
+HISTORY_SUMMARY_TEMPLATE = load_prompt("history_summary")
 QUESTION_PROMPT_TEMPLATE = load_prompt("question_prompt")
+BATCH_ENRICHMENT_PROMPT_TEMPLATE = load_prompt("batch_enrichment_prompt")
+BATCH_CONTENT_TAGGING_PROMPT_TEMPLATE = load_prompt("batch_content_tagging_prompt")
 VISION_LLM_DESCRIBE_PROMPT = load_prompt("vision_llm_describe_prompt")
 VISION_LLM_FIGURE_DESCRIBE_PROMPT = load_prompt("vision_llm_figure_describe_prompt")
 
@@ -228,6 +283,21 @@ def full_question(tenant_id=None, llm_id=None, messages=[], language=None, chat_
     return ans if ans.find("**ERROR**") < 0 else messages[-1]["content"]
 
 
+def history_summary(chat_mdl, summary: str, messages: list[dict], max_tokens=512) -> str:
+    """`summary` of the earlier messages of a conversation, extended with `messages`."""
+    template = PROMPT_JINJA_ENV.from_string(HISTORY_SUMMARY_TEMPLATE)
+    rendered_prompt = template.render(summary=summary, messages=messages, max_tokens=max_tokens)
+    msg = [{"role": "system", "content": rendered_prompt}, {"role": "user", "content": "Output: "}]
+    _, msg = message_fit_in(msg, chat_mdl.max_length)
+    ans = chat_mdl.chat(msg[0]["content"], msg[1:], {"temperature": 0.2})
+    if isinstance(ans, tuple):
+        ans = ans[0]
+    ans = re.sub(r"^.*</think>", "", ans, flags=re.DOTALL).strip()
+    if not ans or ans.find("**ERROR**") >= 0:
+        return summary
+    return encoder.decode(encoder.encode(ans)[:max_tokens])
+
+
 def cross_languages(tenant_id, llm_id, query, languages=[]):
     from api.db import LLMType
     from api.db.services.llm_service import LLMBundle
@@ -290,6 +360,84 @@ def content_tagging(chat_mdl, content, all_tags, examples, topn=3):
     return res
 
 
+def _batch_results(ans, n):
+    """Map the 1-based ids of a JSON array answer to their objects, ignoring malformed entries."""
+    ans = re.sub(r"^.*</think>", "", ans, flags=re.DOTALL)
+    if ans.find("**ERROR**") >= 0:
+        return {}
+    try:
+        arr = json_repair.loads(re.sub(r"^[^\[]*", "", ans, flags=re.DOTALL))
+    except Exception as e:
+        logging.warning(f"Fail to parse batched answer: {e}")
+        return {}
+    res = {}
+    for obj in arr if isinstance(arr, list) else []:
+        try:
+            i = int(obj["id"])
+        except Exception:
+            continue
+        if 1 <= i <= n:
+            res[i] = obj
+    return res
+
+
+def batch_enrichment(chat_mdl, contents, keywords_topn=0, questions_topn=0):
+    """
+    Keywords and/or questions for several chunks in a single call.
+    Returns a list aligned with `contents` of {"keywords": str, "questions": str}, in the formats of
+    `keyword_extraction` and `question_proposal`, or None where the answer misses a chunk.
+    """
+    template = PROMPT_JINJA_ENV.from_string(BATCH_ENRICHMENT_PROMPT_TEMPLATE)
+    rendered_prompt = template.render(contents=contents, keywords_topn=keywords_topn, questions_topn=questions_topn)
+    ans = chat_mdl.chat(rendered_prompt, [{"role": "user", "content": "Output: "}], {"temperature": 0.2})
+    if isinstance(ans, tuple):
+        ans = ans[0]
+    objs = _batch_results(ans, len(contents))
+
+    res = []
+    for i in range(1, len(contents) + 1):
+        obj = objs.get(i)
+        kwd, qst = obj.get("keywords") if obj else None, obj.get("questions") if obj else None
+        if not obj or (keywords_topn and not kwd) or (questions_topn and not qst):
+            res.append(None)
+            continue
+        res.append({
+            "keywords": ",".join(kwd) if isinstance(kwd, list) else str(kwd or ""),
+            "questions": "\n".join(qst) if isinstance(qst, list) else str(qst or ""),
+        })
+    return res
+
+
+def batch_content_tagging(chat_mdl, contents, all_tags, examples, topn=3):
+    """`content_tagging` for several chunks in a single call; None where the answer misses a chunk."""
+    template = PROMPT_JINJA_ENV.from_string(BATCH_CONTENT_TAGGING_PROMPT_TEMPLATE)
+
+    for ex in examples:
+        ex["tags_json"] = json.dumps(ex[TAG_FLD], indent=2, ensure_ascii=False)
+
+    rendered_prompt = template.render(topn=topn, all_tags=all_tags, examples=examples, contents=contents)
+    ans = chat_mdl.chat(rendered_prompt, [{"role": "user", "content": "Output: "}], {"temperature": 0.5})
+    if isinstance(ans, tuple):
+        ans = ans[0]
+    objs = _batch_results(ans, len(contents))
+
+    res = []
+    for i in range(1, len(contents) + 1):
+        tags = objs.get(i, {}).get("tags")
+        if not isinstance(tags, dict):
+            res.append(None)
+            continue
+        scores = {}
+        for k, v in tags.items():
+            try:
+                if int(v) > 0:
+                    scores[str(k)] = int(v)
+            except Exception:
+                pass
+        res.append(scores)
+    return res
+
+
 def vision_llm_describe_prompt(page=None) -> str:
     template = PROMPT_JINJA_ENV.from_string(VISION_LLM_DESCRIBE_PROMPT)
 
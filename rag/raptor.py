@@ -13,22 +13,27 @@
 #  See the License for the specific language governing permissions and
 #  limitations under the License.
 #
+import json
 import logging
+import os
 import re
-import umap
 import numpy as np
-from sklearn.mixture import GaussianMixture
 import trio
+import xxhash
 
 from api.utils.api_utils import timeout
 from graphrag.utils import (
-    get_llm_cache,
-    get_embed_cache,
-    set_embed_cache,
-    set_llm_cache,
     chat_limiter,
+    embed_with_cache,
+    TokenBudget,
 )
-from rag.utils import truncate
+from rag import raptor_clustering
+from rag.utils import num_tokens_from_string, truncate
+from rag.utils.redis_conn import REDIS_CONN
+
+RAPTOR_CLUSTER_CACHE_TTL = int(os.environ.get("RAPTOR_CLUSTER_CACHE_TTL", 7 * 24 * 3600))
+# Prompt and completion tokens of the summaries in flight.
+RAPTOR_TOKEN_BUDGET = int(os.environ.get("RAPTOR_TOKEN_BUDGET", 65536))
 
 
 class RecursiveAbstractiveProcessing4TreeOrganizedRetrieval:
@@ -44,40 +49,36 @@ class RecursiveAbstractiveProcessing4TreeOrganizedRetrieval:
 
     @timeout(60)
     async def _chat(self, system, history, gen_conf):
-        response = get_llm_cache(self._llm_model.llm_name, system, history, gen_conf)
-        if response:
-            return response
-        response = await trio.to_thread.run_sync(
-            lambda: self._llm_model.chat(system, history, gen_conf)
-        )
+        response = await self._llm_model.async_chat(system, history, gen_conf, cache="raptor")
         response = re.sub(r"^.*</think>", "", response, flags=re.DOTALL)
         if response.find("**ERROR**") >= 0:
             raise Exception(response)
-        set_llm_cache(self._llm_model.llm_name, system, response, history, gen_conf)
         return response
 
-    @timeout(2)
-    async def _embedding_encode(self, txt):
-        response = get_embed_cache(self._embd_model.llm_name, txt)
-        if response is not None:
-            return response
-        embds, _ = await trio.to_thread.run_sync(lambda: self._embd_model.encode([txt]))
-        if len(embds) < 1 or len(embds[0]) < 1:
-            raise Exception("Embedding error: ")
-        embds = embds[0]
-        set_embed_cache(self._embd_model.llm_name, txt, embds)
-        return embds
-
     def _get_optimal_clusters(self, embeddings: np.ndarray, random_state: int):
-        max_clusters = min(self._max_cluster, len(embeddings))
-        n_clusters = np.arange(1, max_clusters)
-        bics = []
-        for n in n_clusters:
-            gm = GaussianMixture(n_components=n, random_state=random_state)
-            gm.fit(embeddings)
-            bics.append(gm.bic(embeddings))
-        optimal_clusters = n_clusters[np.argmin(bics)]
-        return optimal_clusters
+        return raptor_clustering.optimal_clusters(embeddings, min(self._max_cluster, len(embeddings)), random_state)
+
+    async def _cluster(self, embeddings, random_state):
+        """
+        Labels of a layer, clustered in the worker processes. Cached by the layer's embeddings:
+        as summaries and embeddings are cached too, a rerun over mostly the same chunks only
+        summarizes again the clusters whose members changed, and re-clusters the layers above them.
+        """
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        hasher = xxhash.xxh64()
+        for v in ["raptor_cluster", self._max_cluster, self._threshold, random_state, embeddings.shape]:
+            hasher.update(str(v).encode("utf-8"))
+        hasher.update(embeddings.tobytes())
+        k = hasher.hexdigest()
+        cached = REDIS_CONN.get(k)
+        if cached:
+            return json.loads(cached)
+        st = trio.current_time()
+        future = raptor_clustering.pool().submit(raptor_clustering.cluster_layer, embeddings, self._max_cluster, self._threshold, random_state)
+        lbls = await trio.to_thread.run_sync(future.result)
+        logging.info(f"RAPTOR clustered {len(embeddings)} chunks into {max(lbls) + 1} clusters in {trio.current_time() - st:.2f}s")
+        REDIS_CONN.set(k, json.dumps(lbls), RAPTOR_CLUSTER_CACHE_TTL)
+        return lbls
 
     async def __call__(self, chunks, random_state, callback=None):
         if len(chunks) <= 1:
@@ -86,9 +87,9 @@ class RecursiveAbstractiveProcessing4TreeOrganizedRetrieval:
         layers = [(0, len(chunks))]
         start, end = 0, len(chunks)
 
-        @timeout(60)
+        budget = TokenBudget(RAPTOR_TOKEN_BUDGET)
+
         async def summarize(ck_idx: list[int]):
-            nonlocal chunks
             texts = [chunks[i][0] for i in ck_idx]
             len_per_chunk = int(
                 (self._llm_model.max_length - self._max_token) / len(texts)
@@ -96,78 +97,67 @@ class RecursiveAbstractiveProcessing4TreeOrganizedRetrieval:
             cluster_content = "\n".join(
                 [truncate(t, max(1, len_per_chunk)) for t in texts]
             )
-            async with chat_limiter:
-                cnt = await self._chat(
-                    "You're a helpful assistant.",
-                    [
-                        {
-                            "role": "user",
-                            "content": self._prompt.format(
-                                cluster_content=cluster_content
-                            ),
-                        }
-                    ],
-                    {"max_tokens": self._max_token},
-                )
-                cnt = re.sub(
-                    "(······\n由于长度的原因，回答被截断了，要继续吗？|For the content length reason, it stopped, continue?)",
-                    "",
-                    cnt,
+            prompt = self._prompt.format(cluster_content=cluster_content)
+            tokens = num_tokens_from_string(prompt) + self._max_token
+            # Only the chat is timed (_chat), not the wait for the token budget and a chat slot.
+            await budget.acquire(tokens)
+            try:
+                async with chat_limiter:
+                    cnt = await self._chat(
+                        "You're a helpful assistant.",
+                        [{"role": "user", "content": prompt}],
+                        {"max_tokens": self._max_token},
+                    )
+            finally:
+                budget.release(tokens)
+            cnt = re.sub(
+                "(······\n由于长度的原因，回答被截断了，要继续吗？|For the content length reason, it stopped, continue?)",
+                "",
+                cnt,
+            )
+            logging.debug(f"SUM: {cnt}")
+            return cnt
+
+        async def summarize_layer(clusters: list[list[int]]):
+            """Summarize all the clusters of a layer at once, embed the summaries in batches and append them in cluster order."""
+            st = trio.current_time()
+            summaries = [None] * len(clusters)
+
+            async def summarize_cluster(i, ck_idx):
+                summaries[i] = await summarize(ck_idx)
+
+            async with trio.open_nursery() as nursery:
+                for i, ck_idx in enumerate(clusters):
+                    nursery.start_soon(summarize_cluster, i, ck_idx)
+            summarized = trio.current_time()
+            embds = await embed_with_cache(self._embd_model, summaries, summaries)
+            if any(e is None or len(e) < 1 for e in embds):
+                raise Exception("Embedding error: ")
+            chunks.extend((cnt, np.array(embd)) for cnt, embd in zip(summaries, embds))
+            if callback:
+                callback(
+                    msg="Cluster one layer: {} -> {}, summarized in {:.2f}s, embedded in {:.2f}s".format(
+                        end - start, len(clusters), summarized - st, trio.current_time() - summarized
+                    )
                 )
-                logging.debug(f"SUM: {cnt}")
-                embds = await self._embedding_encode(cnt)
-                chunks.append((cnt, embds))
 
         labels = []
         while end - start > 1:
             embeddings = [embd for _, embd in chunks[start:end]]
             if len(embeddings) == 2:
-                await summarize([start, start + 1])
-                if callback:
-                    callback(
-                        msg="Cluster one layer: {} -> {}".format(
-                            end - start, len(chunks) - end
-                        )
-                    )
-                labels.extend([0, 0])
-                layers.append((end, len(chunks)))
-                start = end
-                end = len(chunks)
-                continue
-
-            n_neighbors = int((len(embeddings) - 1) ** 0.8)
-            reduced_embeddings = umap.UMAP(
-                n_neighbors=max(2, n_neighbors),
-                n_components=min(12, len(embeddings) - 2),
-                metric="cosine",
-            ).fit_transform(embeddings)
-            n_clusters = self._get_optimal_clusters(reduced_embeddings, random_state)
-            if n_clusters == 1:
-                lbls = [0 for _ in range(len(reduced_embeddings))]
+                lbls = [0, 0]
             else:
-                gm = GaussianMixture(n_components=n_clusters, random_state=random_state)
-                gm.fit(reduced_embeddings)
-                probs = gm.predict_proba(reduced_embeddings)
-                lbls = [np.where(prob > self._threshold)[0] for prob in probs]
-                lbls = [lbl[0] if isinstance(lbl, np.ndarray) else lbl for lbl in lbls]
-
-            async with trio.open_nursery() as nursery:
-                for c in range(n_clusters):
-                    ck_idx = [i + start for i in range(len(lbls)) if lbls[i] == c]
-                    assert len(ck_idx) > 0
-                    nursery.start_soon(summarize, ck_idx)
+                lbls = await self._cluster(embeddings, random_state)
+            clusters = [[] for _ in range(max(lbls) + 1)]
+            for i, lbl in enumerate(lbls):
+                clusters[lbl].append(i + start)
+            await summarize_layer(clusters)
 
-            assert len(chunks) - end == n_clusters, "{} vs. {}".format(
-                len(chunks) - end, n_clusters
+            assert len(chunks) - end == len(clusters), "{} vs. {}".format(
+                len(chunks) - end, len(clusters)
             )
             labels.extend(lbls)
             layers.append((end, len(chunks)))
-            if callback:
-                callback(
-                    msg="Cluster one layer: {} -> {}".format(
-                        end - start, len(chunks) - end
-                    )
-                )
             start = end
             end = len(chunks)
 
@@ -0,0 +1,118 @@
+#
+#  Copyright 2025 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+"""
+Clustering of one RAPTOR layer, run in worker processes.
+
+UMAP and the Gaussian mixtures are fitted on at most RAPTOR_FIT_SAMPLE points of
+the layer and applied to all of them, and the number of clusters is searched on
+a doubling grid refined around its best point instead of fitting every count.
+This module only imports the numeric libraries, so the workers start quickly.
+"""
+
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import umap
+from sklearn.mixture import GaussianMixture
+
+RAPTOR_FIT_SAMPLE = int(os.environ.get("RAPTOR_FIT_SAMPLE", "2000"))
+RAPTOR_CLUSTER_WORKERS = int(os.environ.get("RAPTOR_CLUSTER_WORKERS", "2"))
+# The grid search stops after this many counts in a row without a better BIC.
+BIC_PATIENCE = 2
+
+_pool = None
+
+
+def pool() -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        # Forking a process running trio and worker threads is unsafe, start fresh interpreters.
+        _pool = ProcessPoolExecutor(max_workers=RAPTOR_CLUSTER_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    return _pool
+
+
+def _bic(sample, n, random_state, bics):
+    if n not in bics:
+        gm = GaussianMixture(n_components=n, random_state=random_state)
+        gm.fit(sample)
+        bics[n] = gm.bic(sample)
+    return bics[n]
+
+
+def optimal_clusters(sample: np.ndarray, max_clusters: int, random_state: int) -> int:
+    """
+    The count in [1, max_clusters) with the lowest BIC, as the exhaustive search finds it
+    when BIC is unimodal: counts 1, 2, 4, ... until the BIC stops improving, then a
+    binary search between the neighbours of the best of them.
+    """
+    if max_clusters <= 2:
+        return 1
+    bics = {}
+    best, worse, n = 1, 0, 1
+    while n < max_clusters:
+        if _bic(sample, n, random_state, bics) < bics[best]:
+            best, worse = n, 0
+        else:
+            worse += 1
+            if worse >= BIC_PATIENCE:
+                break
+        n *= 2
+    lo, hi = max(1, best // 2), min(max_clusters - 1, best * 2)
+    while hi - lo > 2:
+        mid = (lo + hi) // 2
+        if _bic(sample, mid, random_state, bics) < _bic(sample, mid + 1, random_state, bics):
+            hi = mid + 1
+        else:
+            lo = mid
+    for n in range(lo, hi + 1):
+        _bic(sample, n, random_state, bics)
+    return min(bics, key=lambda n: (bics[n], n))
+
+
+def cluster_layer(embeddings: np.ndarray, max_cluster: int, threshold: float, random_state: int) -> list[int]:
+    """Cluster label of each embedding of a layer; labels are 0..k-1, every cluster non-empty."""
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    rng = np.random.RandomState(random_state)
+    if len(embeddings) > RAPTOR_FIT_SAMPLE:
+        sample_idx = np.sort(rng.choice(len(embeddings), RAPTOR_FIT_SAMPLE, replace=False))
+    else:
+        sample_idx = np.arange(len(embeddings))
+
+    n_neighbors = int((len(sample_idx) - 1) ** 0.8)
+    reducer = umap.UMAP(
+        n_neighbors=max(2, n_neighbors),
+        n_components=min(12, len(sample_idx) - 2),
+        metric="cosine",
+    )
+    reduced_sample = reducer.fit_transform(embeddings[sample_idx])
+    if len(sample_idx) < len(embeddings):
+        reduced = reducer.transform(embeddings)
+    else:
+        reduced = reduced_sample
+
+    n_clusters = optimal_clusters(reduced_sample, min(max_cluster, len(sample_idx)), random_state)
+    if n_clusters == 1:
+        return [0] * len(embeddings)
+    gm = GaussianMixture(n_components=n_clusters, random_state=random_state)
+    gm.fit(reduced_sample)
+    probs = gm.predict_proba(reduced)
+    # The first cluster likely enough, or the likeliest one.
+    labels = [int(np.argmax(prob > threshold)) if (prob > threshold).any() else int(np.argmax(prob)) for prob in probs]
+    # Clusters fitted on a sample may get no point at all; renumber the others densely.
+    renumber = {c: i for i, c in enumerate(sorted(set(labels)))}
+    return [renumber[c] for c in labels]
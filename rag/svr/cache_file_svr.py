@@ -20,7 +20,6 @@ import traceback
 from api.db.db_models import close_connection
 from api.db.services.task_service import TaskService
 from rag.utils.storage_factory import STORAGE_IMPL
-from rag.utils.redis_conn import REDIS_CONN
 
 
 def collect():
@@ -37,18 +36,13 @@ def main():
     if not locations:
         return
     logging.info(f"TASKS: {len(locations)}")
+    if not hasattr(STORAGE_IMPL, "prefetch"):
+        logging.warning("Storage cache is disabled, nothing to prefetch.")
+        return
     for kb_id, loc in locations:
         try:
-            if REDIS_CONN.is_alive():
-                try:
-                    key = "{}/{}".format(kb_id, loc)
-                    if REDIS_CONN.exist(key):
-                        continue
-                    file_bin = STORAGE_IMPL.get(kb_id, loc)
-                    REDIS_CONN.transaction(key, file_bin, 12 * 60)
-                    logging.info("CACHE: {}".format(loc))
-                except Exception as e:
-                    traceback.print_stack(e)
+            if STORAGE_IMPL.prefetch(kb_id, loc):
+                logging.info("CACHE: {}".format(loc))
         except Exception as e:
             traceback.print_stack(e)
 
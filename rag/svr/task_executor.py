@@ -16,7 +16,6 @@
 # from beartype import BeartypeConf
 # from beartype.claw import beartype_all  # <-- you didn't sign up for this
 # beartype_all(conf=BeartypeConf(violation_type=UserWarning))    # <-- emit warnings from all code
-import random
 import sys
 import threading
 import time
@@ -24,8 +23,7 @@ import time
 from api.utils.api_utils import timeout, is_strong_enough
 from api.utils.log_utils import init_root_logger, get_project_base_directory
 from graphrag.general.index import run_graphrag
-from graphrag.utils import get_llm_cache, set_llm_cache, get_tags_from_cache, set_tags_to_cache
-from rag.prompts import keyword_extraction, question_proposal, content_tagging
+from graphrag.utils import get_tags_from_cache, set_tags_to_cache
 
 import logging
 import os
@@ -61,9 +59,10 @@ from rag.nlp import search, rag_tokenizer
 from rag.raptor import RecursiveAbstractiveProcessing4TreeOrganizedRetrieval as Raptor
 from rag.settings import DOC_MAXIMUM_SIZE, DOC_BULK_SIZE, EMBEDDING_BATCH_SIZE, SVR_CONSUMER_GROUP_NAME, get_svr_queue_name, get_svr_queue_names, print_rag_settings, TAG_FLD, PAGERANK_FLD
 from rag.utils import num_tokens_from_string, truncate
+from rag.utils.enrichment import EnrichmentStats, enrich_keywords_and_questions, enrich_tags
+from rag.utils.parse_artifacts import ParseArtifacts
 from rag.utils.redis_conn import REDIS_CONN, RedisDistributedLock
 from rag.utils.storage_factory import STORAGE_IMPL
-from graphrag.utils import chat_limiter
 
 BATCH_SIZE = 64
 
@@ -232,7 +231,7 @@ async def get_storage_binary(bucket, name):
 
 
 @timeout(60*80, 1)
-async def build_chunks(task, progress_callback):
+async def build_chunks(task, progress_callback, artifacts=None):
     if task["size"] > DOC_MAXIMUM_SIZE:
         set_progress(task["id"], prog=-1, msg="File size exceeds( <= %dMb )" %
                                               (int(DOC_MAXIMUM_SIZE / 1024 / 1024)))
@@ -244,6 +243,8 @@ async def build_chunks(task, progress_callback):
         bucket, name = File2DocumentService.get_storage_address(doc_id=task["doc_id"])
         binary = await get_storage_binary(bucket, name)
         logging.info("From minio({}) {}/{}".format(timer() - st, task["location"], task["name"]))
+        if artifacts and binary:
+            artifacts.bind(binary)
     except TimeoutError:
         progress_callback(-1, "Internal server error: Fetch file from minio timeout. Could you try it again.")
         logging.exception(
@@ -261,7 +262,8 @@ async def build_chunks(task, progress_callback):
         async with chunk_limiter:
             cks = await trio.to_thread.run_sync(lambda: chunker.chunk(task["name"], binary=binary, from_page=task["from_page"],
                                 to_page=task["to_page"], lang=task["language"], callback=progress_callback,
-                                kb_id=task["kb_id"], parser_config=task["parser_config"], tenant_id=task["tenant_id"]))
+                                kb_id=task["kb_id"], parser_config=task["parser_config"], tenant_id=task["tenant_id"],
+                                artifacts=artifacts))
         logging.info("Chunking({}) {}/{} done".format(timer() - st, task["location"], task["name"]))
     except TaskCanceledException:
         raise
@@ -331,44 +333,16 @@ async def build_chunks(task, progress_callback):
     el = timer() - st
     logging.info("MINIO PUT({}) cost {:.3f} s".format(task["name"], el))
 
-    if task["parser_config"].get("auto_keywords", 0):
+    auto_keywords = task["parser_config"].get("auto_keywords", 0)
+    auto_questions = task["parser_config"].get("auto_questions", 0)
+    enrichment_stats = EnrichmentStats()
+    if auto_keywords or auto_questions:
         st = timer()
-        progress_callback(msg="Start to generate keywords for every chunk ...")
+        progress_callback(msg="Start to generate {} for every chunk ...".format(
+            " and ".join([n for n, on in [("keywords", auto_keywords), ("questions", auto_questions)] if on])))
         chat_mdl = LLMBundle(task["tenant_id"], LLMType.CHAT, llm_name=task["llm_id"], lang=task["language"])
-
-        async def doc_keyword_extraction(chat_mdl, d, topn):
-            cached = get_llm_cache(chat_mdl.llm_name, d["content_with_weight"], "keywords", {"topn": topn})
-            if not cached:
-                async with chat_limiter:
-                    cached = await trio.to_thread.run_sync(lambda: keyword_extraction(chat_mdl, d["content_with_weight"], topn))
-                set_llm_cache(chat_mdl.llm_name, d["content_with_weight"], cached, "keywords", {"topn": topn})
-            if cached:
-                d["important_kwd"] = cached.split(",")
-                d["important_tks"] = rag_tokenizer.tokenize(" ".join(d["important_kwd"]))
-            return
-        async with trio.open_nursery() as nursery:
-            for d in docs:
-                nursery.start_soon(doc_keyword_extraction, chat_mdl, d, task["parser_config"]["auto_keywords"])
-        progress_callback(msg="Keywords generation {} chunks completed in {:.2f}s".format(len(docs), timer() - st))
-
-    if task["parser_config"].get("auto_questions", 0):
-        st = timer()
-        progress_callback(msg="Start to generate questions for every chunk ...")
-        chat_mdl = LLMBundle(task["tenant_id"], LLMType.CHAT, llm_name=task["llm_id"], lang=task["language"])
-
-        async def doc_question_proposal(chat_mdl, d, topn):
-            cached = get_llm_cache(chat_mdl.llm_name, d["content_with_weight"], "question", {"topn": topn})
-            if not cached:
-                async with chat_limiter:
-                    cached = await trio.to_thread.run_sync(lambda: question_proposal(chat_mdl, d["content_with_weight"], topn))
-                set_llm_cache(chat_mdl.llm_name, d["content_with_weight"], cached, "question", {"topn": topn})
-            if cached:
-                d["question_kwd"] = cached.split("\n")
-                d["question_tks"] = rag_tokenizer.tokenize("\n".join(d["question_kwd"]))
-        async with trio.open_nursery() as nursery:
-            for d in docs:
-                nursery.start_soon(doc_question_proposal, chat_mdl, d, task["parser_config"]["auto_questions"])
-        progress_callback(msg="Question generation {} chunks completed in {:.2f}s".format(len(docs), timer() - st))
+        await enrich_keywords_and_questions(chat_mdl, docs, auto_keywords, auto_questions, enrichment_stats)
+        progress_callback(msg="Keywords/questions generation {} chunks completed in {:.2f}s: {}".format(len(docs), timer() - st, enrichment_stats))
 
     if task["kb_parser_config"].get("tag_kb_ids", []):
         progress_callback(msg="Start to tag for every chunk ...")
@@ -398,23 +372,9 @@ async def build_chunks(task, progress_callback):
             else:
                 docs_to_tag.append(d)
 
-        async def doc_content_tagging(chat_mdl, d, topn_tags):
-            cached = get_llm_cache(chat_mdl.llm_name, d["content_with_weight"], all_tags, {"topn": topn_tags})
-            if not cached:
-                picked_examples = random.choices(examples, k=2) if len(examples)>2 else examples
-                if not picked_examples:
-                    picked_examples.append({"content": "This is an example", TAG_FLD: {'example': 1}})
-                async with chat_limiter:
-                    cached = await trio.to_thread.run_sync(lambda: content_tagging(chat_mdl, d["content_with_weight"], all_tags, picked_examples, topn=topn_tags))
-                if cached:
-                    cached = json.dumps(cached)
-            if cached:
-                set_llm_cache(chat_mdl.llm_name, d["content_with_weight"], cached, all_tags, {"topn": topn_tags})
-                d[TAG_FLD] = json.loads(cached)
-        async with trio.open_nursery() as nursery:
-            for d in docs_to_tag:
-                nursery.start_soon(doc_content_tagging, chat_mdl, d, topn_tags)
-        progress_callback(msg="Tagging {} chunks completed in {:.2f}s".format(len(docs), timer() - st))
+        tagging_stats = EnrichmentStats()
+        await enrich_tags(chat_mdl, docs_to_tag, all_tags, examples, topn_tags, tagging_stats)
+        progress_callback(msg="Tagging {} chunks completed in {:.2f}s: {}".format(len(docs), timer() - st, tagging_stats))
 
     return docs
 
@@ -424,7 +384,7 @@ def init_kb(row, vector_size: int):
     return settings.docStoreConn.createIdx(idxnm, row.get("kb_id", ""), vector_size)
 
 
-async def embedding(docs, mdl, parser_config=None, callback=None):
+async def embedding(docs, mdl, parser_config=None, callback=None, artifacts=None):
     if parser_config is None:
         parser_config = {}
     tts, cnts = [], []
@@ -449,17 +409,26 @@ async def embedding(docs, mdl, parser_config=None, callback=None):
         nonlocal mdl
         return mdl.encode([truncate(c, mdl.max_length-10) for c in txts])
 
-    cnts_ = np.array([])
-    for i in range(0, len(cnts), EMBEDDING_BATCH_SIZE):
+    # Vectors of a previous parse of this page range, by hash of the embedded text.
+    embd_config = {"model": mdl.llm_name, "max_length": mdl.max_length}
+    prev_vects = (artifacts.load("embedding", embd_config) if artifacts else None) or {}
+    hashes = [xxhash.xxh64(c.encode("utf-8", "surrogatepass")).hexdigest() for c in cnts]
+    todo = [i for i, h in enumerate(hashes) if h not in prev_vects]
+    if artifacts and prev_vects:
+        logging.info("Reuse {} of {} chunk vectors of a previous parse".format(len(cnts) - len(todo), len(cnts)))
+
+    new_vects = {}
+    for i in range(0, len(todo), EMBEDDING_BATCH_SIZE):
+        batch = todo[i: i + EMBEDDING_BATCH_SIZE]
         async with embed_limiter:
-            vts, c = await trio.to_thread.run_sync(lambda: batch_encode(cnts[i: i + EMBEDDING_BATCH_SIZE]))
-        if len(cnts_) == 0:
-            cnts_ = vts
-        else:
-            cnts_ = np.concatenate((cnts_, vts), axis=0)
+            vts, c = await trio.to_thread.run_sync(lambda: batch_encode([cnts[j] for j in batch]))
+        for j, v in zip(batch, vts):
+            new_vects[hashes[j]] = v
         tk_count += c
-        callback(prog=0.7 + 0.2 * (i + 1) / len(cnts), msg="")
-    cnts = cnts_
+        callback(prog=0.7 + 0.2 * (i + 1) / len(todo), msg="")
+    if artifacts and new_vects:
+        artifacts.save("embedding", {h: new_vects.get(h, prev_vects.get(h)) for h in hashes}, embd_config)
+    cnts = np.array([new_vects[h] if h in new_vects else prev_vects[h] for h in hashes])
     filename_embd_weight = parser_config.get("filename_embd_weight", 0.1) # due to the db support none value
     if not filename_embd_weight:
         filename_embd_weight = 0.1
@@ -534,6 +503,7 @@ async def do_handle_task(task):
     task_document_name = task["name"]
     task_parser_config = task["parser_config"]
     task_start_ts = timer()
+    task_begin_at = datetime.now()
 
     # prepare the progress callback function
     progress_callback = partial(set_progress, task_id, task_from_page, task_to_page)
@@ -590,7 +560,8 @@ async def do_handle_task(task):
     else:
         # Standard chunking methods
         start_ts = timer()
-        chunks = await build_chunks(task, progress_callback)
+        artifacts = ParseArtifacts(task_dataset_id, task_doc_id, task_from_page, task_to_page)
+        chunks = await build_chunks(task, progress_callback, artifacts)
         logging.info("Build document {}: {:.2f}s".format(task_document_name, timer() - start_ts))
         if not chunks:
             progress_callback(1., msg=f"No chunk built from {task_document_name}")
@@ -600,7 +571,7 @@ async def do_handle_task(task):
         progress_callback(msg="Generate {} chunks".format(len(chunks)))
         start_ts = timer()
         try:
-            token_count, vector_size = await embedding(chunks, embedding_model, task_parser_config, progress_callback)
+            token_count, vector_size = await embedding(chunks, embedding_model, task_parser_config, progress_callback, artifacts)
         except Exception as e:
             error_message = "Generate embedding error:{}".format(str(e))
             progress_callback(-1, error_message)
@@ -658,6 +629,8 @@ async def do_handle_task(task):
     time_cost = timer() - start_ts
     task_time_cost = timer() - task_start_ts
     progress_callback(prog=1.0, msg="Indexing done ({:.2f}s). Task done ({:.2f}s)".format(time_cost, task_time_cost))
+    # Recorded durations feed the task splitting simulator in rag/utils/task_scheduler.py
+    TaskService.update_by_id(task_id, {"begin_at": task_begin_at, "process_duration": task_time_cost})
     logging.info(
         "Chunk doc({}), page({}-{}), chunks({}), token({}), elapsed:{:.2f}".format(task_document_name, task_from_page,
                                                                                    task_to_page, len(chunks),
@@ -0,0 +1,275 @@
+#
+#  Copyright 2025 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+"""
+Cheap document metadata probes used to split documents into tasks.
+
+Each probe reads only what it needs from a seekable file object: the PDF trailer,
+xref and page tree for the page count, the `dimension` element of every xlsx sheet
+(or a streaming scan of its rows when the element is missing), and raw newline
+counts for csv/txt. On request, a per-page PDF profile (text layer present, content
+stream and image bytes) is derived from page resources and xref offsets without
+decoding any stream; rag.utils.task_scheduler turns it into task costs. Results are cached in-process and in Redis per file digest,
+where the digest covers the size and the first and last 64KB of the file.
+"""
+
+import bisect
+import json
+import logging
+import os
+import re
+import threading
+import zipfile
+from collections import OrderedDict
+from io import BytesIO
+
+import xxhash
+
+from rag.utils.redis_conn import REDIS_CONN
+from rag.utils.storage_cache import open_object
+
+PROBE_VERSION = 2
+PROBE_CACHE_EXPIRE = 7 * 24 * 3600
+DIGEST_BLOCK_SIZE = 64 * 1024
+STREAM_BLOCK_SIZE = 8 * 1024 * 1024
+
+_local_cache = OrderedDict()
+_local_cache_lock = threading.Lock()
+_LOCAL_CACHE_SIZE = 1024
+
+_SHEET_NAME = re.compile(r"xl/worksheets/sheet[0-9]*\.xml$")
+_DIMENSION = re.compile(rb"<(?:\w+:)?dimension\s+ref=\"([A-Z]*)([0-9]+)(?::([A-Z]*)([0-9]+))?\"")
+_ROW_TAG = re.compile(rb"<(?:\w+:)?row[\s>/]")
+_ROW_NUM = re.compile(rb"<(?:\w+:)?row\s[^>]*?\br=\"([0-9]+)\"")
+
+
+def _ext(filename):
+    return os.path.splitext(filename)[-1].lower().lstrip(".")
+
+
+def file_digest(f, size=None):
+    if size is None:
+        size = f.seek(0, os.SEEK_END)
+    hasher = xxhash.xxh64()
+    hasher.update(str(size).encode("utf-8"))
+    f.seek(0)
+    hasher.update(f.read(DIGEST_BLOCK_SIZE))
+    if size > DIGEST_BLOCK_SIZE:
+        f.seek(max(DIGEST_BLOCK_SIZE, size - DIGEST_BLOCK_SIZE))
+        hasher.update(f.read(DIGEST_BLOCK_SIZE))
+    f.seek(0)
+    return hasher.hexdigest()
+
+
+def pdf_page_number(f):
+    from pypdf import PdfReader
+
+    # Non-strict mode seeks to every xref entry to validate it, which defeats ranged reads;
+    # damaged files raise here and are handled by the full-parse fallback instead.
+    f.seek(0)
+    reader = PdfReader(f, strict=True)
+    return len(reader.pages)
+
+
+def pdf_page_profile(f):
+    """
+    Return [has_text_layer, content_bytes, image_bytes] per page. Object sizes are the
+    distance to the next object offset in the xref, so no stream is read or decoded.
+    """
+    from pypdf import PdfReader
+    from pypdf.generic import IndirectObject
+
+    size = f.seek(0, os.SEEK_END)
+    f.seek(0)
+    reader = PdfReader(f, strict=True)
+    offsets = {}
+    for gen, entries in reader.xref.items():
+        for idnum, offset in entries.items():
+            offsets[(idnum, gen)] = offset
+    ends = sorted(set(offsets.values())) + [size]
+
+    def obj_size(ref):
+        if not isinstance(ref, IndirectObject):
+            return 0
+        offset = offsets.get((ref.idnum, ref.generation))
+        if offset is None:
+            return 0
+        i = bisect.bisect_right(ends, offset)
+        return ends[i] - offset if i < len(ends) else 0
+
+    profile = []
+    for page in reader.pages:
+        res = page.get("/Resources")
+        res = res.get_object() if res is not None else {}
+        fonts = res.get("/Font")
+        has_text = int(fonts is not None and len(fonts.get_object()) > 0)
+        xobjects = res.get("/XObject")
+        xobjects = xobjects.get_object() if xobjects is not None else {}
+        image_bytes = sum(obj_size(v) for v in xobjects.values())
+        contents = page.raw_get("/Contents") if "/Contents" in page else None
+        refs = contents.get_object() if isinstance(contents, IndirectObject) else contents
+        refs = refs if isinstance(refs, list) else [contents]
+        profile.append([has_text, sum(obj_size(v) for v in refs), image_bytes])
+    return profile
+
+
+def _column_number(letters):
+    n = 0
+    for c in letters.decode("ascii"):
+        n = n * 26 + ord(c) - ord("A") + 1
+    return n
+
+
+def _sheet_dimension(zf, name):
+    with zf.open(name) as sheet:
+        head = sheet.read(DIGEST_BLOCK_SIZE)
+        m = _DIMENSION.search(head)
+        if m and m.group(4):
+            # Like openpyxl's max_row and max_column: the parser reads the sheet from A1 whatever its first cell.
+            return int(m.group(4)), _column_number(m.group(3))
+
+        # No usable dimension (absent, or a bare "A1" that some writers emit): scan rows.
+        tail, count, max_row = b"", 0, 0
+        binary = head
+        while binary:
+            buf = tail + binary
+            count += len(_ROW_TAG.findall(buf)) - len(_ROW_TAG.findall(tail))
+            for n in _ROW_NUM.findall(buf):
+                max_row = max(max_row, int(n))
+            tail = buf[-256:]
+            binary = sheet.read(STREAM_BLOCK_SIZE)
+        return max(max_row, count, 1), 0
+
+
+def xlsx_dimension(f):
+    """Return (total rows over all sheets, widest sheet's column count or 0 if unknown)."""
+    f.seek(0)
+    with zipfile.ZipFile(f) as zf:
+        rows, columns = 0, 0
+        for name in zf.namelist():
+            if _SHEET_NAME.match(name):
+                r, c = _sheet_dimension(zf, name)
+                rows += r
+                columns = max(columns, c)
+        return rows, columns
+
+
+def text_line_number(f):
+    # Counting raw b"\n" never under-counts, whatever the encoding, so no decoding is needed.
+    f.seek(0)
+    total = 1
+    while True:
+        binary = f.read(STREAM_BLOCK_SIZE)
+        if not binary:
+            break
+        total += binary.count(b"\n")
+    return total
+
+
+def _probe(filename, f, page_profile):
+    ext = _ext(filename)
+    if ext == "pdf":
+        try:
+            if page_profile:
+                profile = pdf_page_profile(f)
+                return {"pages": len(profile), "page_profile": profile}
+            return {"pages": pdf_page_number(f)}
+        except Exception as e:
+            logging.warning(f"doc_probe: fail to read page number of {filename} lazily: {e}")
+        from deepdoc.parser import PdfParser
+
+        f.seek(0)
+        return {"pages": PdfParser.total_page_number(filename, f.read())}
+
+    if ext in ["csv", "txt"]:
+        return {"rows": text_line_number(f)}
+
+    if ext.find("xls") >= 0:
+        try:
+            rows, columns = xlsx_dimension(f)
+            return {"rows": rows, "columns": columns}
+        except zipfile.BadZipFile:
+            pass
+        except Exception as e:
+            logging.warning(f"doc_probe: fail to read row number of {filename} lazily: {e}")
+        from deepdoc.parser.excel_parser import RAGFlowExcelParser
+
+        f.seek(0)
+        return {"rows": RAGFlowExcelParser.row_number(filename, f.read())}
+
+    return {}
+
+
+def _cache_key(filename, digest, page_profile):
+    return f"doc_probe:{PROBE_VERSION}:{_ext(filename)}:{int(page_profile)}:{digest}"
+
+
+def _get_cache(key):
+    with _local_cache_lock:
+        if key in _local_cache:
+            _local_cache.move_to_end(key)
+            return _local_cache[key]
+    try:
+        meta = REDIS_CONN.get(key)
+    except Exception:
+        meta = None
+    if not meta:
+        return None
+    meta = json.loads(meta)
+    _set_local_cache(key, meta)
+    return meta
+
+
+def _set_local_cache(key, meta):
+    with _local_cache_lock:
+        _local_cache[key] = meta
+        if len(_local_cache) > _LOCAL_CACHE_SIZE:
+            _local_cache.popitem(last=False)
+
+
+def _set_cache(key, meta):
+    _set_local_cache(key, meta)
+    try:
+        REDIS_CONN.set_obj(key, meta, PROBE_CACHE_EXPIRE)
+    except Exception:
+        logging.exception(f"doc_probe: fail to cache {key}")
+
+
+def probe(filename, binary=None, f=None, page_profile=False):
+    """
+    Return the metadata needed for task splitting: {"pages": int} for PDF (plus
+    "page_profile" if asked for), {"rows": int} for spreadsheets and csv/txt (plus
+    "columns" for xlsx), {} for anything else.
+    Either `binary` or a seekable binary file object `f` must be given.
+    """
+    if f is None:
+        f = BytesIO(binary)
+    key = _cache_key(filename, file_digest(f), page_profile)
+    meta = _get_cache(key)
+    if meta is not None:
+        return meta
+    meta = _probe(filename, f, page_profile)
+    if None not in meta.values():
+        _set_cache(key, meta)
+    return meta
+
+
+def probe_storage(storage, bucket, name, filename, page_profile=False):
+    """Probe a stored object, downloading only the byte ranges the probe needs when the backend supports it."""
+    f = storage.open(bucket, name) if hasattr(storage, "open") else open_object(storage, bucket, name)
+    if f is None:
+        return {}
+    with f:
+        return probe(filename, f=f, page_profile=page_profile)
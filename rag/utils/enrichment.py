@@ -0,0 +1,234 @@
+#
+#  Copyright 2025 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+"""
+Batched LLM enrichment of chunks: keywords, questions and tags.
+
+Chunks are packed into one prompt as long as their tokens, plus room for the
+answers, fit the batch budget. Keywords and questions are asked for in the same
+call when both are enabled. Answers are cached per chunk under the same keys as
+the one-chunk-per-call prompts, so both paths share the cache; all cache lookups
+of a stage go to Redis in a single MGET. A chunk that fills a batch on its own,
+or that a batched answer misses, falls back to the one-chunk prompt.
+"""
+
+import json
+import logging
+import os
+import random
+
+import trio
+
+from graphrag.utils import chat_limiter, get_llm_cache_many, set_llm_cache
+from rag.nlp import rag_tokenizer
+from rag.prompts import content_tagging, keyword_extraction, question_proposal
+from rag.prompts.prompts import (
+    BATCH_CONTENT_TAGGING_PROMPT_TEMPLATE,
+    BATCH_ENRICHMENT_PROMPT_TEMPLATE,
+    CONTENT_TAGGING_PROMPT_TEMPLATE,
+    KEYWORD_PROMPT_TEMPLATE,
+    QUESTION_PROMPT_TEMPLATE,
+    batch_content_tagging,
+    batch_enrichment,
+)
+from rag.settings import TAG_FLD
+from rag.utils import num_tokens_from_string
+
+ENRICHMENT_BATCH_TOKENS = int(os.environ.get("ENRICHMENT_BATCH_TOKENS", "4096"))
+ENRICHMENT_BATCH_SIZE = int(os.environ.get("ENRICHMENT_BATCH_SIZE", "10"))
+
+# Answer tokens reserved per chunk in a batch.
+KEYWORD_ANSWER_TOKENS = 8
+QUESTION_ANSWER_TOKENS = 32
+TAG_ANSWER_TOKENS = 12
+
+
+class EnrichmentStats:
+    def __init__(self):
+        self.cached = 0
+        self.calls = 0
+        # What one call per chunk and enrichment would have cost.
+        self.unbatched_calls = 0
+        self.saved_tokens = 0
+
+    def __str__(self):
+        return "{} LLM calls instead of {}, {} answers from cache, ~{} prompt tokens saved".format(
+            self.calls, self.unbatched_calls, self.cached, self.saved_tokens)
+
+
+def pack_batches(token_counts, budget, max_items, answer_tokens=0):
+    """Group consecutive item indices into batches whose tokens fit `budget`."""
+    batches, cur, acc = [], [], 0
+    for i, n in enumerate(token_counts):
+        n += answer_tokens
+        if cur and (acc + n > budget or len(cur) >= max_items):
+            batches.append(cur)
+            cur, acc = [], 0
+        cur.append(i)
+        acc += n
+    if cur:
+        batches.append(cur)
+    return batches
+
+
+def _budget(chat_mdl, overhead):
+    return max(0, min(ENRICHMENT_BATCH_TOKENS, int(chat_mdl.max_length * 0.8)) - overhead)
+
+
+def _set_keywords(d, kwd):
+    if kwd:
+        d["important_kwd"] = kwd.split(",")
+        d["important_tks"] = rag_tokenizer.tokenize(" ".join(d["important_kwd"]))
+
+
+def _set_questions(d, qst):
+    if qst:
+        d["question_kwd"] = qst.split("\n")
+        d["question_tks"] = rag_tokenizer.tokenize("\n".join(d["question_kwd"]))
+
+
+async def enrich_keywords_and_questions(chat_mdl, docs, keywords_topn, questions_topn, stats):
+    llm_name, tenant_id = chat_mdl.llm_name, chat_mdl.tenant_id
+    texts = [d["content_with_weight"] for d in docs]
+    none = [None] * len(docs)
+    kwd_cached = get_llm_cache_many(llm_name, texts, "keywords", {"topn": keywords_topn}, "keywords", tenant_id) if keywords_topn else none
+    qst_cached = get_llm_cache_many(llm_name, texts, "question", {"topn": questions_topn}, "question", tenant_id) if questions_topn else none
+
+    # Chunks grouped by what is still missing: (needs keywords, needs questions) -> indices.
+    groups = {}
+    for i, d in enumerate(docs):
+        if kwd_cached[i] is not None:
+            _set_keywords(d, kwd_cached[i])
+            stats.cached += 1
+        if qst_cached[i] is not None:
+            _set_questions(d, qst_cached[i])
+            stats.cached += 1
+        need = (bool(keywords_topn) and kwd_cached[i] is None, bool(questions_topn) and qst_cached[i] is None)
+        if any(need):
+            groups.setdefault(need, []).append(i)
+
+    kwd_overhead = num_tokens_from_string(KEYWORD_PROMPT_TEMPLATE)
+    qst_overhead = num_tokens_from_string(QUESTION_PROMPT_TEMPLATE)
+    batch_overhead = num_tokens_from_string(BATCH_ENRICHMENT_PROMPT_TEMPLATE)
+
+    async def one_keywords(i):
+        async with chat_limiter:
+            kwd = await trio.to_thread.run_sync(lambda: keyword_extraction(chat_mdl, texts[i], keywords_topn))
+        stats.calls += 1
+        set_llm_cache(llm_name, texts[i], kwd, "keywords", {"topn": keywords_topn}, "keywords", tenant_id)
+        _set_keywords(docs[i], kwd)
+
+    async def one_questions(i):
+        async with chat_limiter:
+            qst = await trio.to_thread.run_sync(lambda: question_proposal(chat_mdl, texts[i], questions_topn))
+        stats.calls += 1
+        set_llm_cache(llm_name, texts[i], qst, "question", {"topn": questions_topn}, "question", tenant_id)
+        _set_questions(docs[i], qst)
+
+    async def one(i, need_kwd, need_qst):
+        if need_kwd:
+            await one_keywords(i)
+        if need_qst:
+            await one_questions(i)
+
+    async def batch(idx, need_kwd, need_qst):
+        if len(idx) == 1:
+            await one(idx[0], need_kwd, need_qst)
+            return
+        kwd_topn, qst_topn = keywords_topn if need_kwd else 0, questions_topn if need_qst else 0
+        async with chat_limiter:
+            res = await trio.to_thread.run_sync(lambda: batch_enrichment(chat_mdl, [texts[i] for i in idx], kwd_topn, qst_topn))
+        stats.calls += 1
+        stats.saved_tokens += (kwd_overhead if need_kwd else 0) * len(idx) + (qst_overhead if need_qst else 0) * len(idx) - batch_overhead
+        missed = []
+        for i, r in zip(idx, res):
+            if r is None:
+                missed.append(i)
+                continue
+            if need_kwd:
+                set_llm_cache(llm_name, texts[i], r["keywords"], "keywords", {"topn": keywords_topn}, "keywords", tenant_id)
+                _set_keywords(docs[i], r["keywords"])
+            if need_qst:
+                set_llm_cache(llm_name, texts[i], r["questions"], "question", {"topn": questions_topn}, "question", tenant_id)
+                _set_questions(docs[i], r["questions"])
+        if missed:
+            logging.info(f"Batched enrichment missed {len(missed)} of {len(idx)} chunks, asking one by one")
+        for i in missed:
+            await one(i, need_kwd, need_qst)
+
+    async with trio.open_nursery() as nursery:
+        for (need_kwd, need_qst), idx in groups.items():
+            stats.unbatched_calls += len(idx) * (int(need_kwd) + int(need_qst))
+            answer_tokens = (KEYWORD_ANSWER_TOKENS * keywords_topn if need_kwd else 0) + (QUESTION_ANSWER_TOKENS * questions_topn if need_qst else 0)
+            budget = _budget(chat_mdl, batch_overhead)
+            for b in pack_batches([num_tokens_from_string(texts[i]) for i in idx], budget, ENRICHMENT_BATCH_SIZE, answer_tokens):
+                nursery.start_soon(batch, [idx[j] for j in b], need_kwd, need_qst)
+
+
+async def enrich_tags(chat_mdl, docs, all_tags, examples, topn, stats):
+    llm_name, tenant_id = chat_mdl.llm_name, chat_mdl.tenant_id
+    texts = [d["content_with_weight"] for d in docs]
+    todo = []
+    for i, cached in enumerate(get_llm_cache_many(llm_name, texts, all_tags, {"topn": topn}, "tagging", tenant_id)):
+        if cached:
+            docs[i][TAG_FLD] = json.loads(cached)
+            stats.cached += 1
+        else:
+            todo.append(i)
+    stats.unbatched_calls += len(todo)
+
+    def pick_examples():
+        picked = random.choices(examples, k=2) if len(examples) > 2 else examples
+        return picked or [{"content": "This is an example", TAG_FLD: {"example": 1}}]
+
+    def save(i, tags):
+        if tags:
+            cached = json.dumps(tags)
+            set_llm_cache(llm_name, texts[i], cached, all_tags, {"topn": topn}, "tagging", tenant_id)
+            docs[i][TAG_FLD] = json.loads(cached)
+
+    async def one(i):
+        picked = pick_examples()
+        async with chat_limiter:
+            tags = await trio.to_thread.run_sync(lambda: content_tagging(chat_mdl, texts[i], all_tags, picked, topn=topn))
+        stats.calls += 1
+        save(i, tags)
+
+    tag_overhead = num_tokens_from_string(", ".join(all_tags)) + sum(num_tokens_from_string(json.dumps(ex, ensure_ascii=False)) for ex in examples[:2])
+    single_overhead = num_tokens_from_string(CONTENT_TAGGING_PROMPT_TEMPLATE) + tag_overhead
+    batch_overhead = num_tokens_from_string(BATCH_CONTENT_TAGGING_PROMPT_TEMPLATE) + tag_overhead
+
+    async def batch(idx):
+        if len(idx) == 1:
+            await one(idx[0])
+            return
+        picked = pick_examples()
+        async with chat_limiter:
+            res = await trio.to_thread.run_sync(lambda: batch_content_tagging(chat_mdl, [texts[i] for i in idx], all_tags, picked, topn=topn))
+        stats.calls += 1
+        stats.saved_tokens += single_overhead * len(idx) - batch_overhead
+        missed = []
+        for i, tags in zip(idx, res):
+            if tags is None:
+                missed.append(i)
+            else:
+                save(i, tags)
+        for i in missed:
+            await one(i)
+
+    budget = _budget(chat_mdl, batch_overhead)
+    async with trio.open_nursery() as nursery:
+        for b in pack_batches([num_tokens_from_string(texts[i]) for i in todo], budget, ENRICHMENT_BATCH_SIZE, TAG_ANSWER_TOKENS * topn):
+            nursery.start_soon(batch, [todo[j] for j in b])
@@ -0,0 +1,186 @@
+#
+#  Copyright 2025 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+"""
+Cache of LLM responses in Redis, by use case ("chat", "keywords", "graph", ...).
+
+A response is kept under a key made of the use case, the tenant and the inputs it
+depends on (`key`), for the TTL of its use case: LLM_CACHE_TTL_<USE CASE>, or
+LLM_CACHE_TTL. Long responses are stored compressed, and responses longer than
+LLM_CACHE_MAX_VALUE are not stored.
+
+A response can also be found by the similarity of its inputs (`semantic_get`): the
+vectors of the inputs cached in a scope are indexed in a list capped at
+LLM_CACHE_SEMANTIC_SIZE entries, and the response of the most similar one is used
+when it is at least as similar as the threshold asked for.
+
+Hits and misses are counted per use case in the `llm_cache_stats` hash, see `stats`.
+"""
+
+import base64
+import json
+import logging
+import os
+import zlib
+
+import numpy as np
+import xxhash
+
+from rag.utils.redis_conn import REDIS_CONN
+
+LLM_CACHE_TTL = int(os.environ.get("LLM_CACHE_TTL", 24 * 3600))
+LLM_CACHE_MAX_VALUE = int(os.environ.get("LLM_CACHE_MAX_VALUE", 1 << 20))
+LLM_CACHE_SEMANTIC_SIZE = int(os.environ.get("LLM_CACHE_SEMANTIC_SIZE", 512))
+# Values at least this long are compressed.
+COMPRESS_MIN = 1024
+STATS_KEY = "llm_cache_stats"
+
+
+def ttl(use_case: str) -> int:
+    return int(os.environ.get(f"LLM_CACHE_TTL_{use_case.upper()}", LLM_CACHE_TTL))
+
+
+def key(use_case: str, tenant_id, *inputs) -> str:
+    """The key of the response to `inputs`, for a tenant (None for the responses shared by all)."""
+    hasher = xxhash.xxh64()
+    for v in inputs:
+        hasher.update(str(v).encode("utf-8"))
+        hasher.update(b"\0")
+    return f"llm_cache:{use_case}:{tenant_id or ''}:{hasher.hexdigest()}"
+
+
+def _encode(value: str) -> str | None:
+    if len(value) >= COMPRESS_MIN:
+        value = "z:" + base64.b64encode(zlib.compress(value.encode("utf-8"))).decode("ascii")
+    else:
+        value = "r:" + value
+    return value if len(value) <= LLM_CACHE_MAX_VALUE else None
+
+
+def _decode(value) -> str | None:
+    if not value:
+        return None
+    if value.startswith("z:"):
+        return zlib.decompress(base64.b64decode(value[2:])).decode("utf-8")
+    if value.startswith("r:"):
+        return value[2:]
+    return None
+
+
+def _count(use_case, **counts):
+    counts = {k: v for k, v in counts.items() if v}
+    if not counts:
+        return
+    try:
+        pipeline = REDIS_CONN.REDIS.pipeline(transaction=False)
+        for outcome, n in counts.items():
+            pipeline.hincrby(STATS_KEY, f"{use_case}:{outcome}", n)
+        pipeline.execute()
+    except Exception:
+        logging.exception("llm_cache._count")
+
+
+def get(use_case: str, k: str) -> str | None:
+    value = _decode(REDIS_CONN.get(k))
+    _count(use_case, hit=int(value is not None), miss=int(value is None))
+    return value
+
+
+def get_many(use_case: str, keys: list[str]) -> list[str | None]:
+    """`get` for several keys in one round trip."""
+    values = [_decode(v) for v in REDIS_CONN.mget(keys)] if keys else []
+    hits = sum(v is not None for v in values)
+    _count(use_case, hit=hits, miss=len(values) - hits)
+    return values
+
+
+def put(use_case: str, k: str, value: str, exp: int | None = None):
+    if not value:
+        return
+    value = _encode(value)
+    if value is not None:
+        REDIS_CONN.set(k, value, exp or ttl(use_case))
+
+
+def _index_key(use_case, tenant_id, scope):
+    return f"llm_cache_index:{use_case}:{tenant_id or ''}:{xxhash.xxh64(str(scope).encode('utf-8')).hexdigest()}"
+
+
+def _unit(vector):
+    vector = np.asarray(vector, dtype=np.float32).ravel()
+    return vector / (np.linalg.norm(vector) or 1)
+
+
+def semantic_get(use_case: str, tenant_id, scope, k: str, embed, threshold: float):
+    """
+    The response cached under `k`, or else the one cached in `scope` for the inputs whose vector
+    is the most similar to `embed()`, if at least `threshold` (cosine). Returns the response (None
+    if there is none) and the vector, when it was needed, to `semantic_put` a new response with.
+    """
+    value = _decode(REDIS_CONN.get(k))
+    if value is not None:
+        _count(use_case, hit=1)
+        return value, None
+    vector = _unit(embed())
+    try:
+        entries = [json.loads(e) for e in REDIS_CONN.REDIS.lrange(_index_key(use_case, tenant_id, scope), 0, -1)]
+    except Exception:
+        logging.exception("llm_cache.semantic_get")
+        entries = []
+    if entries:
+        vectors = np.stack([np.frombuffer(base64.b64decode(e["v"]), dtype=np.float16) for e in entries]).astype(np.float32)
+        if vectors.shape[1] == len(vector):
+            sims = vectors @ vector
+            best = int(np.argmax(sims))
+            if sims[best] >= threshold:
+                value = _decode(REDIS_CONN.get(entries[best]["k"]))
+                if value is not None:
+                    logging.debug(f"llm_cache semantic hit for {use_case}, similarity {sims[best]:.3f}")
+                    _count(use_case, semantic_hit=1)
+                    return value, vector
+    _count(use_case, miss=1)
+    return None, vector
+
+
+def semantic_put(use_case: str, tenant_id, scope, k: str, vector, value: str):
+    """`put`, and index the response in `scope` by the vector of its inputs."""
+    put(use_case, k, value)
+    entry = json.dumps({"k": k, "v": base64.b64encode(_unit(vector).astype(np.float16).tobytes()).decode("ascii")})
+    index = _index_key(use_case, tenant_id, scope)
+    try:
+        pipeline = REDIS_CONN.REDIS.pipeline(transaction=False)
+        pipeline.lpush(index, entry)
+        pipeline.ltrim(index, 0, LLM_CACHE_SEMANTIC_SIZE - 1)
+        pipeline.expire(index, ttl(use_case))
+        pipeline.execute()
+    except Exception:
+        logging.exception("llm_cache.semantic_put")
+
+
+def stats() -> dict:
+    """Lookups, hits and hit rate per use case."""
+    try:
+        raw = REDIS_CONN.REDIS.hgetall(STATS_KEY) or {}
+    except Exception:
+        logging.exception("llm_cache.stats")
+        return {}
+    res = {}
+    for field, n in raw.items():
+        use_case, _, outcome = field.rpartition(":")
+        res.setdefault(use_case, {"hit": 0, "semantic_hit": 0, "miss": 0})[outcome] = int(n)
+    for s in res.values():
+        lookups = s["hit"] + s["semantic_hit"] + s["miss"]
+        s["hit_rate"] = round((s["hit"] + s["semantic_hit"]) / lookups, 4) if lookups else 0.
+    return res
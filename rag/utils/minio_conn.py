@@ -93,6 +93,24 @@ class RAGFlowMinio:
                 time.sleep(1)
         return
 
+    def get_size(self, bucket, filename):
+        try:
+            return self.conn.stat_object(bucket, filename).size
+        except Exception:
+            logging.exception(f"Fail to stat {bucket}/{filename}")
+        return
+
+    def get_range(self, bucket, filename, offset, length):
+        for _ in range(2):
+            try:
+                r = self.conn.get_object(bucket, filename, offset=offset, length=length)
+                return r.read()
+            except Exception:
+                logging.exception(f"Fail to get {bucket}/{filename}[{offset}:{offset + length}]")
+                self.__open__()
+                time.sleep(1)
+        return
+
     def obj_exist(self, bucket, filename):
         try:
             if not self.conn.bucket_exists(bucket):
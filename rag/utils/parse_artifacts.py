@@ -0,0 +1,205 @@
+#
+#  Copyright 2025 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+"""
+Intermediate parsing artifacts kept per document page range, so that a re-parse only
+re-runs the stages downstream of the configuration that changed.
+
+Stages, from upstream to downstream:
+    layouts   - OCR boxes and layouts of a PDF page range, after `_layouts_rec`
+    sections  - parsed sections and tables, before they are merged into chunks
+    embedding - chunk vectors, looked up by the hash of the embedded text
+
+Each artifact is stored in STORAGE_IMPL, in the knowledge base bucket, under a name
+derived from the document content digest, the page range, the stage and only the
+configuration that stage depends on. Re-chunking at a new `chunk_token_num` therefore
+finds the sections of every page range and never runs OCR again. Artifact names are
+tracked in a Redis set per document so they are removed with the document, and saving
+an artifact removes those of the same stage and page range saved before it.
+
+Artifacts are compressed JSON, never pickles, as anyone writing to the bucket could
+otherwise run code in the task executors: numpy arrays, tuples, bytes and images are
+tagged, other objects are kept as their `str`.
+"""
+
+import base64
+import json
+import logging
+import os
+import zlib
+from decimal import Decimal
+from io import BytesIO
+
+import numpy as np
+import xxhash
+from PIL import Image
+
+from rag.utils.redis_conn import REDIS_CONN
+from rag.utils.storage_factory import STORAGE_IMPL
+
+PARSE_ARTIFACT_VERSION = 2
+PARSE_ARTIFACT_ENABLED = int(os.environ.get("PARSE_ARTIFACT_ENABLED", "1"))
+
+# Parser options that only matter once sections exist: merging them into chunks,
+# enriching or embedding the chunks, or post-processing the whole knowledge base.
+CHUNK_ONLY_CONFIG = {"chunk_token_num", "delimiter", "auto_keywords", "auto_questions", "tag_kb_ids", "topn_tags",
+                     "filename_embd_weight", "task_page_size", "pages", "raptor", "graphrag"}
+
+
+def section_config(parser_config):
+    return {k: v for k, v in (parser_config or {}).items() if k not in CHUNK_ONLY_CONFIG}
+
+
+def _index_key(doc_id):
+    return f"parse_artifacts:{doc_id}"
+
+
+def _b64(binary):
+    return base64.b64encode(binary).decode("ascii")
+
+
+def _to_json(obj):
+    if obj is None or isinstance(obj, (str, bool, int, float)):
+        return obj
+    if isinstance(obj, dict):
+        if all(isinstance(k, str) for k in obj) and "__t__" not in obj:
+            return {k: _to_json(v) for k, v in obj.items()}
+        return {"__t__": "dict", "items": [[_to_json(k), _to_json(v)] for k, v in obj.items()]}
+    if isinstance(obj, list):
+        return [_to_json(v) for v in obj]
+    if isinstance(obj, tuple):
+        return {"__t__": "tuple", "items": [_to_json(v) for v in obj]}
+    if isinstance(obj, np.ndarray):
+        return {"__t__": "ndarray", "dtype": str(obj.dtype), "shape": list(obj.shape), "data": _b64(np.ascontiguousarray(obj).tobytes())}
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, Decimal):
+        return float(obj)
+    if isinstance(obj, bytes):
+        return {"__t__": "bytes", "data": _b64(obj)}
+    if isinstance(obj, Image.Image):
+        buf = BytesIO()
+        obj.save(buf, format="PNG")
+        return {"__t__": "image", "data": _b64(buf.getvalue())}
+    return str(obj)
+
+
+def _from_json(obj):
+    t = obj.get("__t__")
+    if t == "dict":
+        return {k: v for k, v in obj["items"]}
+    if t == "tuple":
+        return tuple(obj["items"])
+    if t == "ndarray":
+        return np.frombuffer(base64.b64decode(obj["data"]), dtype=obj["dtype"]).reshape(obj["shape"]).copy()
+    if t == "bytes":
+        return base64.b64decode(obj["data"])
+    if t == "image":
+        img = Image.open(BytesIO(base64.b64decode(obj["data"])))
+        img.load()
+        return img
+    return obj
+
+
+def dumps(obj) -> bytes:
+    return zlib.compress(json.dumps(_to_json(obj), ensure_ascii=False).encode("utf-8"))
+
+
+def loads(binary: bytes):
+    return json.loads(zlib.decompress(binary), object_hook=_from_json)
+
+
+class ParseArtifacts:
+    """Artifact store of one task: a document page range of a given file content."""
+
+    def __init__(self, kb_id, doc_id, from_page=0, to_page=100000, binary=None):
+        self.kb_id = kb_id
+        self.doc_id = doc_id
+        self.from_page = from_page
+        self.to_page = to_page
+        self.content_digest = ""
+        self.hits = []
+        if binary:
+            self.bind(binary)
+
+    def bind(self, binary):
+        """Artifacts are only found again for the very same file content."""
+        self.content_digest = xxhash.xxh64(binary).hexdigest()
+
+    def _prefix(self, stage):
+        return f"{self.doc_id}_artifacts/{stage}/{self.from_page}-{self.to_page}/"
+
+    def name(self, stage, config=None):
+        hasher = xxhash.xxh64()
+        for v in [PARSE_ARTIFACT_VERSION, self.content_digest, self.from_page, self.to_page, stage]:
+            hasher.update(str(v).encode("utf-8"))
+        for k in sorted((config or {}).keys()):
+            hasher.update(f"{k}={config[k]}".encode("utf-8"))
+        return self._prefix(stage) + hasher.hexdigest()
+
+    def load(self, stage, config=None):
+        if not PARSE_ARTIFACT_ENABLED or not self.content_digest:
+            return None
+        name = self.name(stage, config)
+        try:
+            if not STORAGE_IMPL.obj_exist(self.kb_id, name):
+                return None
+            binary = STORAGE_IMPL.get(self.kb_id, name)
+            if not binary:
+                return None
+            obj = loads(binary)
+        except Exception:
+            logging.exception(f"Fail to load parse artifact {self.kb_id}/{name}")
+            return None
+        self.hits.append(stage)
+        return obj
+
+    def save(self, stage, obj, config=None):
+        if not PARSE_ARTIFACT_ENABLED or not self.content_digest:
+            return
+        name = self.name(stage, config)
+        try:
+            STORAGE_IMPL.put(self.kb_id, name, dumps(obj))
+            REDIS_CONN.sadd(_index_key(self.doc_id), name)
+        except Exception:
+            logging.exception(f"Fail to save parse artifact {self.kb_id}/{name}")
+            return
+        self._remove_stale(stage, name)
+
+    def _remove_stale(self, stage, name):
+        """Remove the artifacts of this stage and page range other than `name`, and those of an older format."""
+        prefix, legacy = self._prefix(stage), f"{self.doc_id}_artifacts/{stage}/"
+        for old in REDIS_CONN.smembers(_index_key(self.doc_id)) or []:
+            old = old.decode("utf-8") if isinstance(old, bytes) else old
+            if old == name or not (old.startswith(prefix) or (old.startswith(legacy) and old.count("/") == 2)):
+                continue
+            try:
+                if STORAGE_IMPL.obj_exist(self.kb_id, old):
+                    STORAGE_IMPL.rm(self.kb_id, old)
+                REDIS_CONN.srem(_index_key(self.doc_id), old)
+            except Exception:
+                logging.exception(f"Fail to remove parse artifact {self.kb_id}/{old}")
+
+
+def remove_artifacts(kb_id, doc_id):
+    names = REDIS_CONN.smembers(_index_key(doc_id)) or []
+    for name in names:
+        name = name.decode("utf-8") if isinstance(name, bytes) else name
+        try:
+            if STORAGE_IMPL.obj_exist(kb_id, name):
+                STORAGE_IMPL.rm(kb_id, name)
+        except Exception:
+            logging.exception(f"Fail to remove parse artifact {kb_id}/{name}")
+    REDIS_CONN.delete(_index_key(doc_id))
@@ -112,6 +112,39 @@ class RedisDB:
             logging.warning("RedisDB.get " + str(k) + " got exception: " + str(e))
             self.__open__()
 
+    def mget(self, keys: list[str]):
+        if not self.REDIS or not keys:
+            return [None] * len(keys)
+        try:
+            return self.REDIS.mget(keys)
+        except Exception as e:
+            logging.warning("RedisDB.mget " + str(keys[:3]) + " got exception: " + str(e))
+            self.__open__()
+        return [None] * len(keys)
+
+    def mset(self, mapping: dict, exp=3600):
+        if not self.REDIS or not mapping:
+            return False
+        try:
+            pipeline = self.REDIS.pipeline(transaction=False)
+            for k, v in mapping.items():
+                pipeline.set(k, v, exp)
+            pipeline.execute()
+            return True
+        except Exception as e:
+            logging.warning("RedisDB.mset " + str(list(mapping.keys())[:3]) + " got exception: " + str(e))
+            self.__open__()
+        return False
+
+    def incr(self, k):
+        if not self.REDIS:
+            return
+        try:
+            return self.REDIS.incr(k)
+        except Exception as e:
+            logging.warning("RedisDB.incr " + str(k) + " got exception: " + str(e))
+            self.__open__()
+
     def set_obj(self, k, obj, exp=3600):
         try:
             self.REDIS.set(k, json.dumps(obj, ensure_ascii=False), exp)
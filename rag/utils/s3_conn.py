@@ -162,6 +162,28 @@ class RAGFlowS3:
                 time.sleep(1)
         return
 
+    @use_prefix_path
+    @use_default_bucket
+    def get_size(self, bucket, fnm, *args, **kwargs):
+        try:
+            return self.conn[0].head_object(Bucket=bucket, Key=fnm)['ContentLength']
+        except Exception:
+            logging.exception(f"fail head {bucket}/{fnm}")
+        return
+
+    @use_prefix_path
+    @use_default_bucket
+    def get_range(self, bucket, fnm, offset, length, *args, **kwargs):
+        for _ in range(2):
+            try:
+                r = self.conn[0].get_object(Bucket=bucket, Key=fnm, Range=f"bytes={offset}-{offset + length - 1}")
+                return r['Body'].read()
+            except Exception:
+                logging.exception(f"fail get {bucket}/{fnm}[{offset}:{offset + length}]")
+                self.__open__()
+                time.sleep(1)
+        return
+
     @use_prefix_path
     @use_default_bucket
     def obj_exist(self, bucket, fnm, *args, **kwargs):
@@ -0,0 +1,360 @@
+#
+#  Copyright 2025 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+import io
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import xxhash
+from filelock import FileLock
+
+from rag.utils.redis_conn import REDIS_CONN
+
+
+class RangedReader(io.RawIOBase):
+    """
+    Seekable read-only view of a stored object backed by `get_range` requests.
+
+    Small reads are served from a bounded LRU of fixed-size blocks, so parsers that
+    jump between the header, trailer and a few objects only download those blocks;
+    large sequential reads are fetched in one request and not retained.
+    """
+
+    BLOCK_SIZE = 64 * 1024
+    MAX_BLOCKS = 256
+
+    def __init__(self, storage, bucket, fnm, size):
+        self.storage = storage
+        self.bucket = bucket
+        self.fnm = fnm
+        self.size = size
+        self.pos = 0
+        self.requests = 0
+        self._blocks = OrderedDict()
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.pos
+        elif whence == io.SEEK_END:
+            offset += self.size
+        self.pos = max(0, offset)
+        return self.pos
+
+    def _range(self, offset, length):
+        self.requests += 1
+        binary = self.storage.get_range(self.bucket, self.fnm, offset, length)
+        if binary is None:
+            raise IOError(f"Fail to get {self.bucket}/{self.fnm}[{offset}:{offset + length}]")
+        return binary
+
+    def _block(self, no):
+        if no in self._blocks:
+            self._blocks.move_to_end(no)
+            return self._blocks[no]
+        offset = no * self.BLOCK_SIZE
+        binary = self._range(offset, min(self.BLOCK_SIZE, self.size - offset))
+        self._blocks[no] = binary
+        if len(self._blocks) > self.MAX_BLOCKS:
+            self._blocks.popitem(last=False)
+        return binary
+
+    def readinto(self, b):
+        length = min(len(b), self.size - self.pos)
+        if length <= 0:
+            return 0
+        if length > self.BLOCK_SIZE:
+            binary = self._range(self.pos, length)
+        else:
+            binary = b""
+            offset = self.pos
+            while len(binary) < length:
+                no, start = divmod(offset, self.BLOCK_SIZE)
+                block = self._block(no)[start:start + length - len(binary)]
+                if not block:
+                    break
+                binary += block
+                offset += len(block)
+        n = len(binary)
+        b[:n] = binary
+        self.pos += n
+        return n
+
+
+def open_object(storage, bucket, fnm):
+    """
+    Return a seekable binary file object for a stored object, or None if it is missing.
+    Backends exposing `get_size`/`get_range` are read lazily, the others are fetched whole.
+    """
+    if hasattr(storage, "get_range") and hasattr(storage, "get_size"):
+        size = storage.get_size(bucket, fnm)
+        if size is not None:
+            return io.BufferedReader(RangedReader(storage, bucket, fnm, size), buffer_size=RangedReader.BLOCK_SIZE)
+    binary = storage.get(bucket, fnm)
+    if binary is None:
+        return None
+    return io.BytesIO(binary)
+
+
+class _Flight:
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+
+
+class RAGFlowStorageCache:
+    """
+    Node-local, size-bounded, read-through disk cache in front of a storage backend.
+
+    Objects are written under `cache_dir` keyed by the hash of `bucket/fnm`. The access
+    time of a file records its LRU position and its modification time records when it
+    was downloaded, so several processes on the same node share the cache without any
+    in-memory index. Concurrent fetches of the same object are collapsed into one
+    download: threads of a process wait on an in-flight event, processes of a node wait
+    on a file lock. `open` serves a local copy when there is one and otherwise falls back
+    to ranged reads without filling the cache. Every other method is delegated to the backend.
+
+    `put` and `rm` give the object a new version token in Redis, and a local copy is only
+    read under the token it was downloaded with, so a write on one node invalidates the
+    copies of every node. When Redis can't be read the backend is read directly.
+    """
+
+    SWEEP_INTERVAL = 300
+    # Eviction frees this much of `max_bytes`, so the files written until it fills again don't sweep.
+    EVICT_TO = 0.9
+
+    def __init__(self, storage, cache_dir, max_bytes, ttl=3600):
+        self.storage = storage
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._inflight = {}
+        self._sweep_lock = threading.Lock()
+        # Bytes of the cached files, counted by a sweep and kept up by this process' writes and removals.
+        self._bytes = 0
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self._sweep()
+        threading.Thread(target=self._sweeper, name="storage-cache-sweeper", daemon=True).start()
+
+    def __getattr__(self, name):
+        if name == "storage":
+            raise AttributeError(name)
+        return getattr(self.storage, name)
+
+    @staticmethod
+    def _key(bucket, fnm):
+        return xxhash.xxh64(f"{bucket}/{fnm}".encode("utf-8", "surrogatepass")).hexdigest()
+
+    def _path(self, bucket, fnm):
+        """The path of the local copy of the current version of an object, None if the version can't be read."""
+        key = self._key(bucket, fnm)
+        try:
+            version = REDIS_CONN.REDIS.get(f"storage_cache:{key}") or "0"
+        except Exception as e:
+            logging.warning(f"RAGFlowStorageCache can't read the version of {bucket}/{fnm}: {e}")
+            return None
+        return os.path.join(self.cache_dir, key[:2], f"{key}.{version}")
+
+    def _invalidate(self, bucket, fnm):
+        # Outlives the local copies downloaded before, so the old version is never read again.
+        key = self._key(bucket, fnm)
+        if not REDIS_CONN.set(f"storage_cache:{key}", os.urandom(8).hex(), self.ttl):
+            logging.error(f"Fail to invalidate storage cache of {bucket}/{fnm}")
+
+    def _read(self, path):
+        try:
+            st = os.stat(path)
+            if time.time() - st.st_mtime > self.ttl:
+                self._drop(path)
+                return None
+            with open(path, "rb") as f:
+                binary = f.read()
+            os.utime(path, (time.time(), st.st_mtime))
+            return binary
+        except FileNotFoundError:
+            return None
+        except Exception:
+            logging.exception(f"Fail to read storage cache {path}")
+            return None
+
+    def _write(self, path, binary):
+        if len(binary) > self.max_bytes:
+            return
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp, "wb") as f:
+                f.write(binary)
+            os.replace(tmp, path)
+        except Exception:
+            logging.exception(f"Fail to write storage cache {path}")
+            return
+        with self._lock:
+            self._bytes += len(binary)
+            full = self._bytes > self.max_bytes
+        if full:
+            self._sweep()
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+            return True
+        except FileNotFoundError:
+            pass
+        except Exception:
+            logging.exception(f"Fail to remove storage cache {path}")
+        return False
+
+    def _drop(self, path):
+        """Remove a cached file, and its bytes from the total."""
+        try:
+            size = os.stat(path).st_size
+        except FileNotFoundError:
+            return
+        if self._remove(path):
+            with self._lock:
+                self._bytes -= size
+
+    def _sweeper(self):
+        while True:
+            time.sleep(self.SWEEP_INTERVAL)
+            try:
+                self._sweep()
+            except Exception:
+                logging.exception("Storage cache sweep")
+
+    def _sweep(self):
+        """
+        Count the cached files, evict the least recently used ones when beyond `max_bytes` and remove
+        stale lock files. Runs when the total goes over `max_bytes` and every SWEEP_INTERVAL
+        seconds, which also catches up with the files the other processes of the node wrote.
+        """
+        if not self._sweep_lock.acquire(blocking=False):
+            return
+        try:
+            self._evict()
+        finally:
+            self._sweep_lock.release()
+
+    def _evict(self):
+        entries = []
+        total = 0
+        for sub in os.scandir(self.cache_dir):
+            if not sub.is_dir():
+                continue
+            for ent in os.scandir(sub.path):
+                if ent.name.endswith(".tmp"):
+                    continue
+                try:
+                    st = ent.stat()
+                except FileNotFoundError:
+                    continue
+                if ent.name.endswith(".lock"):
+                    if time.time() - st.st_mtime > self.ttl:
+                        self._remove(ent.path)
+                    continue
+                entries.append((st.st_atime, st.st_size, ent.path))
+                total += st.st_size
+        if total > self.max_bytes:
+            entries.sort()
+            for _, size, path in entries:
+                if total <= self.max_bytes * self.EVICT_TO:
+                    break
+                self._remove(path)
+                total -= size
+            logging.debug(f"Storage cache evicted down to {total} bytes")
+        with self._lock:
+            self._bytes = total
+
+    def _fetch(self, bucket, fnm, path, *args, **kwargs):
+        with FileLock(path + ".lock"):
+            binary = self._read(path)
+            if binary is not None:
+                self.hits += 1
+                return binary
+            self.misses += 1
+            binary = self.storage.get(bucket, fnm, *args, **kwargs)
+            if binary:
+                self._write(path, binary)
+            return binary
+
+    def get(self, bucket, fnm, *args, **kwargs):
+        path = self._path(bucket, fnm)
+        if path is None:
+            return self.storage.get(bucket, fnm, *args, **kwargs)
+        binary = self._read(path)
+        if binary is not None:
+            self.hits += 1
+            return binary
+
+        with self._lock:
+            flight = self._inflight.get(path)
+            leader = flight is None
+            if leader:
+                flight = _Flight()
+                self._inflight[path] = flight
+        if not leader:
+            flight.event.wait()
+            return flight.result
+
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            flight.result = self._fetch(bucket, fnm, path, *args, **kwargs)
+            return flight.result
+        finally:
+            with self._lock:
+                self._inflight.pop(path, None)
+            flight.event.set()
+
+    def open(self, bucket, fnm):
+        path = self._path(bucket, fnm)
+        try:
+            if path and time.time() - os.stat(path).st_mtime <= self.ttl:
+                self.hits += 1
+                return open(path, "rb")
+        except FileNotFoundError:
+            pass
+        return open_object(self.storage, bucket, fnm)
+
+    def prefetch(self, bucket, fnm):
+        path = self._path(bucket, fnm)
+        if path is None or os.path.exists(path):
+            return False
+        return self.get(bucket, fnm) is not None
+
+    def put(self, bucket, fnm, binary, *args, **kwargs):
+        res = self.storage.put(bucket, fnm, binary, *args, **kwargs)
+        self._invalidate(bucket, fnm)
+        return res
+
+    def rm(self, bucket, fnm, *args, **kwargs):
+        res = self.storage.rm(bucket, fnm, *args, **kwargs)
+        self._invalidate(bucket, fnm)
+        return res
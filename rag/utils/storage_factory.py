@@ -15,6 +15,7 @@
 #
 
 import os
+import tempfile
 from enum import Enum
 
 from rag.utils.azure_sas_conn import RAGFlowAzureSasBlob
@@ -23,6 +24,7 @@ from rag.utils.minio_conn import RAGFlowMinio
 from rag.utils.opendal_conn import OpenDALStorage
 from rag.utils.s3_conn import RAGFlowS3
 from rag.utils.oss_conn import RAGFlowOSS
+from rag.utils.storage_cache import RAGFlowStorageCache
 
 
 class Storage(Enum):
@@ -51,3 +53,13 @@ class StorageFactory:
 
 STORAGE_IMPL_TYPE = os.getenv('STORAGE_IMPL', 'MINIO')
 STORAGE_IMPL = StorageFactory.create(Storage[STORAGE_IMPL_TYPE])
+
+# Node-local read-through cache for document binaries, set STORAGE_CACHE_MAX_SIZE=0 to disable.
+STORAGE_CACHE_MAX_SIZE = int(os.environ.get("STORAGE_CACHE_MAX_SIZE", 2 * 1024 * 1024 * 1024))
+if STORAGE_CACHE_MAX_SIZE > 0:
+    STORAGE_IMPL = RAGFlowStorageCache(
+        STORAGE_IMPL,
+        os.environ.get("STORAGE_CACHE_DIR", os.path.join(tempfile.gettempdir(), "ragflow_storage_cache")),
+        STORAGE_CACHE_MAX_SIZE,
+        int(os.environ.get("STORAGE_CACHE_TTL", 3600)),
+    )
@@ -0,0 +1,194 @@
+#
+#  Copyright 2025 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+"""
+Cost-aware splitting and ordering of parsing tasks.
+
+Costs are expressed in "text page" units: a PDF page with a text layer and ordinary
+content costs 1, a page without a text layer pays for OCR, and pages with dense
+content streams (tables, vector drawings) or large images pay extra for layout and
+table structure recognition. A task's budget is the configured `task_page_size`, so
+plain-text documents get as many tasks as before (with evened-out sizes) while scanned
+or table-heavy ranges get smaller tasks.
+
+Run as a script to replay a recorded task log and compare makespans:
+
+    python rag/utils/task_scheduler.py task_log.jsonl --workers 8
+"""
+
+import argparse
+import heapq
+import json
+import math
+import os
+import sys
+from collections import defaultdict
+
+TASK_COST_AWARE_SPLIT = int(os.environ.get("TASK_COST_AWARE_SPLIT", "1"))
+
+OCR_PAGE_COST = 3.0
+DENSE_CONTENT_BYTES = 16 * 1024
+DENSE_CONTENT_COST = 1.0
+IMAGE_BYTES = 512 * 1024
+IMAGE_COST = 1.0
+
+TABLE_ROWS_PER_TASK = 3000
+TABLE_REFERENCE_COLUMNS = 8
+TABLE_MIN_ROWS_PER_TASK = 300
+
+
+def page_cost(profile):
+    """Estimated cost of one PDF page from its [has_text_layer, content_bytes, image_bytes] profile."""
+    has_text, content_bytes, image_bytes = profile
+    cost = 1.0
+    if not has_text:
+        cost += OCR_PAGE_COST
+    cost += DENSE_CONTENT_COST * min(max(content_bytes - DENSE_CONTENT_BYTES, 0) / (2 * DENSE_CONTENT_BYTES), 1.0)
+    cost += IMAGE_COST * min(image_bytes / IMAGE_BYTES, 1.0)
+    return cost
+
+
+def split_by_cost(costs, start, end, budget):
+    """
+    Split pages [start, end) into the fewest consecutive ranges whose average cost fits
+    `budget`, keeping their costs as even as page boundaries allow.
+    Returns [(from_page, to_page, cost)].
+    """
+    if end <= start:
+        return []
+
+    def target_of(remaining):
+        return remaining / max(1, math.ceil(remaining / budget))
+
+    remaining = sum(costs[start:end])
+    target = target_of(remaining)
+    ranges = []
+    s, acc = start, 0.0
+    for p in range(start, end):
+        c = costs[p]
+        if p > s and (acc + c > budget or acc + c - target > target - acc):
+            ranges.append((s, p, acc))
+            remaining -= acc
+            target = target_of(remaining)
+            s, acc = p, 0.0
+        acc += c
+    ranges.append((s, end, acc))
+    return ranges
+
+
+def split_fixed(start, end, page_size, costs=None):
+    """The original policy: fixed-size page ranges."""
+    ranges = []
+    for p in range(start, end, page_size):
+        e = min(p + page_size, end)
+        ranges.append((p, e, sum(costs[p:e]) if costs else float(e - p)))
+    return ranges
+
+
+def table_rows_per_task(columns):
+    if not TASK_COST_AWARE_SPLIT or not columns or columns <= TABLE_REFERENCE_COLUMNS:
+        return TABLE_ROWS_PER_TASK
+    return max(TABLE_MIN_ROWS_PER_TASK, int(TABLE_ROWS_PER_TASK * TABLE_REFERENCE_COLUMNS / columns))
+
+
+def order_by_expected_cost(tasks, costs):
+    """Shortest expected job first; `costs` maps task id to its estimated cost."""
+    return sorted(tasks, key=lambda t: costs.get(t["id"], 0.0))
+
+
+def simulate(jobs, workers):
+    """
+    List-schedule `jobs` ([(priority, duration)] in queue order) on `workers` executors,
+    higher priority first as task executors consume the priority queue before the default one.
+    Returns the makespan.
+    """
+    queue = sorted(range(len(jobs)), key=lambda i: (-jobs[i][0], i))
+    free_at = [0.0] * workers
+    makespan = 0.0
+    for i in queue:
+        start = heapq.heappop(free_at)
+        finish = start + jobs[i][1]
+        makespan = max(makespan, finish)
+        heapq.heappush(free_at, finish)
+    return makespan
+
+
+def replay(records, workers, page_size=12):
+    """
+    Replay a task log and compare the fixed page-size policy with the cost-aware one.
+
+    Each record describes one finished task, as stored in the task table: doc_id, from_page,
+    to_page, process_duration (seconds) and optionally priority and page_profile (the
+    doc_probe profiles of the pages of the task, recorded by queue_tasks).
+    Per-page durations are recovered by spreading each task's duration over its pages in
+    proportion to their estimated cost, then both policies re-split every document and
+    are list-scheduled on the same number of workers.
+    """
+    docs = defaultdict(list)
+    for r in records:
+        docs[r["doc_id"]].append(r)
+
+    fixed, aware = [], []
+    for doc_id, tasks in docs.items():
+        priority = tasks[0].get("priority", 0)
+        pages = max(t["to_page"] for t in tasks)
+        # Pages of no recorded profile cost 1.
+        costs = [1.0] * pages
+        for t in tasks:
+            profile = t.get("page_profile")
+            if isinstance(profile, str):
+                profile = json.loads(profile)
+            for p, page in enumerate((profile or [])[:t["to_page"] - t["from_page"]], t["from_page"]):
+                costs[p] = page_cost(page)
+        durations = [0.0] * pages
+        for t in tasks:
+            s, e = t["from_page"], t["to_page"]
+            weight = sum(costs[s:e]) or 1.0
+            for p in range(s, e):
+                durations[p] = t["process_duration"] * costs[p] / weight
+
+        for s, e, _ in split_fixed(0, pages, page_size):
+            fixed.append((priority, sum(durations[s:e])))
+        # queue_tasks can only reorder the tasks of the document it is queueing.
+        doc_jobs = sorted(split_by_cost(costs, 0, pages, page_size), key=lambda r: r[2])
+        aware.extend((priority, sum(durations[s:e])) for s, e, _ in doc_jobs)
+
+    return {
+        "documents": len(docs),
+        "fixed_tasks": len(fixed),
+        "fixed_makespan": simulate(fixed, workers),
+        "cost_aware_tasks": len(aware),
+        "cost_aware_makespan": simulate(aware, workers),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay a recorded task log to compare task splitting policies")
+    parser.add_argument("task_log", help="JSON lines file, one finished task per line")
+    parser.add_argument("--workers", type=int, default=int(os.environ.get("MAX_CONCURRENT_TASKS", "5")), help="number of concurrent task executors")
+    parser.add_argument("--page_size", type=int, default=12, help="task_page_size used by both policies")
+    args = parser.parse_args()
+
+    with open(args.task_log) as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    if not records:
+        print("No task record found.")
+        sys.exit(1)
+    res = replay(records, args.workers, args.page_size)
+    print(json.dumps(res, indent=2))
+    if res["fixed_makespan"]:
+        print("Makespan: {:.1f}s -> {:.1f}s ({:+.1f}%)".format(
+            res["fixed_makespan"], res["cost_aware_makespan"],
+            100.0 * (res["cost_aware_makespan"] - res["fixed_makespan"]) / res["fixed_makespan"]))
@@ -241,6 +241,12 @@ def delete_session_with_chat_assistants(auth, chat_assistant_id, payload=None):
     return res.json()
 
 
+def chat_completions(auth, chat_assistant_id, payload=None):
+    url = f"{HOST_ADDRESS}{CHAT_ASSISTANT_API_URL}/{chat_assistant_id}/completions"
+    res = requests.post(url=url, headers=HEADERS, auth=auth, json=payload)
+    return res.json()
+
+
 def batch_add_sessions_with_chat_assistant(auth, chat_assistant_id, num):
     session_ids = []
     for i in range(num):
@@ -0,0 +1,42 @@
+#
+#  Copyright 2025 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+import pytest
+from common import chat_completions, list_session_with_chat_assistants
+
+
+class TestChatCompletionsWithSession:
+    @pytest.mark.p1
+    def test_multi_turn_history_round_trip(self, HttpApiAuth, add_sessions_with_chat_assistant_func):
+        chat_assistant_id, session_ids = add_sessions_with_chat_assistant_func
+        session_id = session_ids[0]
+        questions = ["What is the capital of France?", "And of Italy?", "Which of the two is larger?"]
+        answers = []
+        for question in questions:
+            res = chat_completions(HttpApiAuth, chat_assistant_id, {"question": question, "session_id": session_id, "stream": False})
+            assert res["code"] == 0, res
+            assert res["data"]["answer"], res
+            answers.append(res["data"])
+
+        res = list_session_with_chat_assistants(HttpApiAuth, chat_assistant_id, {"id": session_id})
+        assert res["code"] == 0, res
+        messages = res["data"][0]["messages"]
+        assert messages[0]["role"] == "assistant", res
+        turns = messages[1:]
+        assert [m["role"] for m in turns] == ["user", "assistant"] * len(questions), res
+        assert [m["content"] for m in turns[::2]] == questions, res
+        assert [m["content"] for m in turns[1::2]] == [a["answer"] for a in answers], res
+        assert [m["id"] for m in turns[1::2]] == [a["id"] for a in answers], res
+        assert [m["id"] for m in turns[::2]] == [a["id"] for a in answers], res
@@ -26,6 +26,7 @@ KB_APP_URL = f"/{VERSION}/kb"
 DOCUMENT_APP_URL = f"/{VERSION}/document"
 CHUNK_API_URL = f"/{VERSION}/chunk"
 DIALOG_APP_URL = f"/{VERSION}/dialog"
+CONVERSATION_APP_URL = f"/{VERSION}/conversation"
 # SESSION_WITH_CHAT_ASSISTANT_API_URL = "/api/v1/chats/{chat_id}/sessions"
 # SESSION_WITH_AGENT_API_URL = "/api/v1/agents/{agent_id}/sessions"
 
@@ -258,3 +259,39 @@ def delete_dialogs(auth):
         dialog_ids = [dialog["id"] for dialog in res["data"]]
         if dialog_ids:
             delete_dialog(auth, {"dialog_ids": dialog_ids})
+
+
+# CONVERSATION APP
+def set_conversation(auth, payload=None, *, headers=HEADERS, data=None):
+    res = requests.post(url=f"{HOST_ADDRESS}{CONVERSATION_APP_URL}/set", headers=headers, auth=auth, json=payload, data=data)
+    return res.json()
+
+
+def get_conversation(auth, params=None, *, headers=HEADERS):
+    res = requests.get(url=f"{HOST_ADDRESS}{CONVERSATION_APP_URL}/get", headers=headers, auth=auth, params=params)
+    return res.json()
+
+
+def list_conversations(auth, params=None, *, headers=HEADERS):
+    res = requests.get(url=f"{HOST_ADDRESS}{CONVERSATION_APP_URL}/list", headers=headers, auth=auth, params=params)
+    return res.json()
+
+
+def delete_conversations(auth, payload=None, *, headers=HEADERS, data=None):
+    res = requests.post(url=f"{HOST_ADDRESS}{CONVERSATION_APP_URL}/rm", headers=headers, auth=auth, json=payload, data=data)
+    return res.json()
+
+
+def conversation_completion(auth, payload=None, *, headers=HEADERS, data=None):
+    res = requests.post(url=f"{HOST_ADDRESS}{CONVERSATION_APP_URL}/completion", headers=headers, auth=auth, json=payload, data=data)
+    return res.json()
+
+
+def delete_message(auth, payload=None, *, headers=HEADERS, data=None):
+    res = requests.post(url=f"{HOST_ADDRESS}{CONVERSATION_APP_URL}/delete_msg", headers=headers, auth=auth, json=payload, data=data)
+    return res.json()
+
+
+def thumbup_message(auth, payload=None, *, headers=HEADERS, data=None):
+    res = requests.post(url=f"{HOST_ADDRESS}{CONVERSATION_APP_URL}/thumbup", headers=headers, auth=auth, json=payload, data=data)
+    return res.json()
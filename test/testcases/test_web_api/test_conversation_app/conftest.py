@@ -0,0 +1,53 @@
+#
+#  Copyright 2025 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+from uuid import uuid4
+
+import pytest
+from common import create_dialog, delete_conversations, delete_dialogs, list_conversations, set_conversation
+
+PROLOGUE = "Hi! I'm your assistant, what can I do for you?"
+
+
+@pytest.fixture(scope="class")
+def add_dialog(request, WebApiAuth):
+    def cleanup():
+        delete_dialogs(WebApiAuth)
+
+    request.addfinalizer(cleanup)
+
+    # Without a knowledge base, the questions are answered by the chat model alone.
+    payload = {
+        "name": "conversation_dialog",
+        "prompt_config": {"system": "You are a helpful assistant. Answer in one short sentence.", "parameters": [], "prologue": PROLOGUE},
+    }
+    res = create_dialog(WebApiAuth, payload)
+    assert res["code"] == 0, res
+    return res["data"]["id"]
+
+
+@pytest.fixture(scope="function")
+def add_conversation_func(request, WebApiAuth, add_dialog):
+    def cleanup():
+        res = list_conversations(WebApiAuth, {"dialog_id": dialog_id})
+        if res["code"] == 0 and res["data"]:
+            delete_conversations(WebApiAuth, {"conversation_ids": [conv["id"] for conv in res["data"]]})
+
+    request.addfinalizer(cleanup)
+
+    dialog_id = add_dialog
+    res = set_conversation(WebApiAuth, {"conversation_id": uuid4().hex, "dialog_id": dialog_id, "is_new": True, "name": "conversation"})
+    assert res["code"] == 0, res
+    return dialog_id, res["data"]["id"]
@@ -0,0 +1,152 @@
+#
+#  Copyright 2025 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+from uuid import uuid4
+
+import pytest
+from common import conversation_completion, delete_message, get_conversation, list_conversations, set_conversation, thumbup_message
+
+
+def ask(auth, conversation_id, messages, question):
+    """The conversation as the web client keeps it, after asking `question`."""
+    message_id = uuid4().hex
+    messages = messages + [{"id": message_id, "role": "user", "content": question}]
+    res = conversation_completion(auth, {"conversation_id": conversation_id, "messages": messages, "stream": False})
+    assert res["code"] == 0, res
+    assert res["data"]["answer"], res
+    return messages + [{"id": message_id, "role": "assistant", "content": res["data"]["answer"]}]
+
+
+def stored(auth, conversation_id):
+    res = get_conversation(auth, {"conversation_id": conversation_id})
+    assert res["code"] == 0, res
+    return res["data"]
+
+
+def summary(messages):
+    return [(m["role"], m["content"], m.get("id")) for m in messages]
+
+
+class TestConversationMessages:
+    @pytest.mark.p1
+    def test_multi_turn_history_round_trip(self, WebApiAuth, add_conversation_func):
+        dialog_id, conversation_id = add_conversation_func
+        messages = stored(WebApiAuth, conversation_id)["message"]
+        for question in ["What is the capital of France?", "And of Italy?", "Which of the two is larger?"]:
+            messages = ask(WebApiAuth, conversation_id, messages, question)
+
+        conv = stored(WebApiAuth, conversation_id)
+        assert summary(conv["message"]) == summary(messages), conv
+        assert len(conv["reference"]) == 3, conv
+
+        res = list_conversations(WebApiAuth, {"dialog_id": dialog_id})
+        assert res["code"] == 0, res
+        listed = next(c for c in res["data"] if c["id"] == conversation_id)
+        assert summary(listed["message"]) == summary(messages), listed
+        assert len(listed["reference"]) == 3, listed
+
+    @pytest.mark.p1
+    def test_regenerate_answer(self, WebApiAuth, add_conversation_func):
+        _, conversation_id = add_conversation_func
+        messages = stored(WebApiAuth, conversation_id)["message"]
+        messages = ask(WebApiAuth, conversation_id, messages, "What is the capital of France?")
+        messages = ask(WebApiAuth, conversation_id, messages, "And of Italy?")
+
+        # The client drops the answer and sends its question again.
+        question = messages[-2]
+        res = conversation_completion(WebApiAuth, {"conversation_id": conversation_id, "messages": messages[:-1], "stream": False})
+        assert res["code"] == 0, res
+        messages = messages[:-1] + [{"id": question["id"], "role": "assistant", "content": res["data"]["answer"]}]
+
+        conv = stored(WebApiAuth, conversation_id)
+        assert summary(conv["message"]) == summary(messages), conv
+        assert len(conv["reference"]) == 2, conv
+
+    @pytest.mark.p2
+    def test_replace_last_turn(self, WebApiAuth, add_conversation_func):
+        _, conversation_id = add_conversation_func
+        messages = stored(WebApiAuth, conversation_id)["message"]
+        messages = ask(WebApiAuth, conversation_id, messages, "What is the capital of France?")
+        dropped = ask(WebApiAuth, conversation_id, messages, "And of Italy?")
+        messages = ask(WebApiAuth, conversation_id, messages, "And of Spain?")
+
+        conv = stored(WebApiAuth, conversation_id)
+        assert summary(conv["message"]) == summary(messages), conv
+        assert dropped[-2]["content"] not in [m["content"] for m in conv["message"]], conv
+        assert len(conv["reference"]) == 2, conv
+
+    @pytest.mark.p1
+    def test_delete_message(self, WebApiAuth, add_conversation_func):
+        _, conversation_id = add_conversation_func
+        messages = stored(WebApiAuth, conversation_id)["message"]
+        messages = ask(WebApiAuth, conversation_id, messages, "What is the capital of France?")
+        messages = ask(WebApiAuth, conversation_id, messages, "What is the capital of Italy?")
+
+        res = delete_message(WebApiAuth, {"conversation_id": conversation_id, "message_id": messages[1]["id"]})
+        assert res["code"] == 0, res
+        remaining = messages[:1] + messages[3:]
+        assert summary(res["data"]["message"]) == summary(remaining), res
+
+        conv = stored(WebApiAuth, conversation_id)
+        assert summary(conv["message"]) == summary(remaining), conv
+        assert len(conv["reference"]) == 1, conv
+
+    @pytest.mark.p1
+    def test_thumbup(self, WebApiAuth, add_conversation_func):
+        _, conversation_id = add_conversation_func
+        messages = stored(WebApiAuth, conversation_id)["message"]
+        messages = ask(WebApiAuth, conversation_id, messages, "What is the capital of France?")
+        message_id = messages[-1]["id"]
+
+        res = thumbup_message(WebApiAuth, {"conversation_id": conversation_id, "message_id": message_id, "thumbup": False, "feedback": "Too short"})
+        assert res["code"] == 0, res
+        answer = stored(WebApiAuth, conversation_id)["message"][-1]
+        assert answer["thumbup"] is False, answer
+        assert answer["feedback"] == "Too short", answer
+
+        res = thumbup_message(WebApiAuth, {"conversation_id": conversation_id, "message_id": message_id, "thumbup": True})
+        assert res["code"] == 0, res
+        conv = stored(WebApiAuth, conversation_id)
+        answer = conv["message"][-1]
+        assert answer["thumbup"] is True, answer
+        assert "feedback" not in answer, answer
+        assert summary(conv["message"]) == summary(messages), conv
+
+    @pytest.mark.p2
+    def test_legacy_conversation_migrates_on_new_turn(self, WebApiAuth, add_conversation_func):
+        _, conversation_id = add_conversation_func
+        # A conversation written as a whole is kept in its columns, as before conversations were stored by turn.
+        message_id = uuid4().hex
+        messages = stored(WebApiAuth, conversation_id)["message"] + [
+            {"id": message_id, "role": "user", "content": "What is the capital of France?"},
+            {"id": message_id, "role": "assistant", "content": "Paris."},
+        ]
+        res = set_conversation(WebApiAuth, {"conversation_id": conversation_id, "is_new": False, "message": messages, "reference": [{"chunks": [], "doc_aggs": []}]})
+        assert res["code"] == 0, res
+        assert summary(res["data"]["message"]) == summary(messages), res
+
+        messages = ask(WebApiAuth, conversation_id, messages, "And of Italy?")
+        conv = stored(WebApiAuth, conversation_id)
+        assert summary(conv["message"]) == summary(messages), conv
+        assert len(conv["reference"]) == 2, conv
+
+        res = thumbup_message(WebApiAuth, {"conversation_id": conversation_id, "message_id": message_id, "thumbup": True})
+        assert res["code"] == 0, res
+        assert stored(WebApiAuth, conversation_id)["message"][2]["thumbup"] is True
+
+        messages = ask(WebApiAuth, conversation_id, messages, "And of Spain?")
+        conv = stored(WebApiAuth, conversation_id)
+        assert summary(conv["message"]) == summary(messages), conv
+        assert len(conv["reference"]) == 3, conv
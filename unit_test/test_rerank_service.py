@@ -0,0 +1,100 @@
+#
+#  Copyright 2025 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+import numpy as np
+import pytest
+
+from rag.llm import rerank_service
+from rag.llm.rerank_model import Base
+
+QUERY = "query"
+TEXTS = ["a", "bbb", "cc", "dddddd", "eeee"]
+IDS = [f"chunk{i}" for i in range(len(TEXTS))]
+
+
+class FakeRedis:
+    def __init__(self):
+        self.hashes = {}
+
+    def hmget(self, k, fields):
+        h = self.hashes.get(k, {})
+        return [h.get(f) for f in fields]
+
+    def pipeline(self, transaction=True):
+        return self
+
+    def hset(self, k, mapping):
+        self.hashes.setdefault(k, {}).update(mapping)
+
+    def expire(self, k, ttl):
+        pass
+
+    def execute(self):
+        pass
+
+
+class FakeRedisConn:
+    def __init__(self):
+        self.REDIS = FakeRedis()
+
+
+class AbsoluteRerank(Base):
+    def __init__(self):
+        self.calls = []
+
+    def similarity(self, query: str, texts: list):
+        self.calls.append(list(texts))
+        return np.array([len(t) / 10 for t in texts]), len(texts)
+
+
+class NormalisingRerank(AbsoluteRerank):
+    absolute_scores = False
+
+    def similarity(self, query: str, texts: list):
+        rank, token_count = super().similarity(query, texts)
+        lo, hi = np.min(rank), np.max(rank)
+        return (rank - lo) / (hi - lo) if hi > lo else np.zeros_like(rank), token_count
+
+
+@pytest.fixture(autouse=True)
+def score_cache(monkeypatch):
+    monkeypatch.setattr(rerank_service, "REDIS_CONN", FakeRedisConn())
+    monkeypatch.setattr(rerank_service, "RERANK_CACHE_TTL", 300)
+    monkeypatch.setattr(rerank_service, "fit_texts", lambda texts, max_tokens=0: (list(texts), [1] * len(texts)))
+
+
+@pytest.mark.parametrize("mdl_class", [AbsoluteRerank, NormalisingRerank])
+def test_cached_and_fresh_scores_equal_a_full_call(mdl_class):
+    mdl = mdl_class()
+    rerank_service.similarity(mdl, "tenant", "model", QUERY, TEXTS[:3], IDS[:3])
+    sim, _ = rerank_service.similarity(mdl, "tenant", "model", QUERY, TEXTS[1:], IDS[1:])
+
+    full, _ = mdl_class().similarity(QUERY, TEXTS[1:])
+    np.testing.assert_allclose(sim, full)
+
+
+def test_only_uncached_texts_are_scored_by_absolute_models():
+    mdl = AbsoluteRerank()
+    rerank_service.similarity(mdl, "tenant", "model", QUERY, TEXTS[:3], IDS[:3])
+    rerank_service.similarity(mdl, "tenant", "model", QUERY, TEXTS[1:], IDS[1:])
+    assert mdl.calls[-1] == TEXTS[3:]
+
+
+def test_normalising_models_score_all_the_texts():
+    mdl = NormalisingRerank()
+    rerank_service.similarity(mdl, "tenant", "model", QUERY, TEXTS[:3], IDS[:3])
+    rerank_service.similarity(mdl, "tenant", "model", QUERY, TEXTS[1:], IDS[1:])
+    assert mdl.calls[-1] == TEXTS[1:]